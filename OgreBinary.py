@@ -0,0 +1,374 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8-80 compliant>
+
+"""
+Writes the collected export data (the meshData dictionary built by
+OgreExport.bCollectMeshData) straight to a binary .mesh file, without going
+through OgreXMLConverter, so vertex attributes can use compact types.
+
+Chunk layout follows MeshSerializer_v1.100 (Ogre 1.10 and later).
+"""
+
+import math
+import struct
+import numpy as np
+
+MESH_VERSION = "[MeshSerializer_v1.100]"
+
+# chunk ids
+M_HEADER = 0x1000
+M_MESH = 0x3000
+M_SUBMESH = 0x4000
+M_SUBMESH_OPERATION = 0x4010
+M_SUBMESH_BONE_ASSIGNMENT = 0x4100
+M_GEOMETRY = 0x5000
+M_GEOMETRY_VERTEX_DECLARATION = 0x5100
+M_GEOMETRY_VERTEX_ELEMENT = 0x5110
+M_GEOMETRY_VERTEX_BUFFER = 0x5200
+M_GEOMETRY_VERTEX_BUFFER_DATA = 0x5210
+M_MESH_SKELETON_LINK = 0x6000
+M_MESH_BONE_ASSIGNMENT = 0x7000
+M_MESH_BOUNDS = 0x9000
+M_POSES = 0xC000
+M_POSE = 0xC100
+M_POSE_VERTEX = 0xC111
+
+# VertexElementSemantic
+VES_POSITION = 1
+VES_NORMAL = 4
+VES_DIFFUSE = 5
+VES_TEXTURE_COORDINATES = 7
+VES_BINORMAL = 8
+VES_TANGENT = 9
+
+OT_TRIANGLE_LIST = 4
+
+# format name: (VertexElementType, components, bytes)
+VERTEX_FORMATS = {
+    'float2': (1, 2, 8),
+    'float3': (2, 3, 12),
+    'float4': (3, 4, 16),
+    'colour_abgr': (11, 4, 4),
+    'byte4n': (29, 4, 4),
+    'ubyte4n': (30, 4, 4),
+    'short2n': (31, 2, 4),
+    'short4n': (32, 4, 8),
+    'int1010102n': (35, 4, 4),
+    'half2': (37, 2, 4),
+}
+
+# oldest Ogre that can load each format, the others load everywhere
+FORMAT_MIN_VERSION = {
+    'byte4n': "1.12",
+    'ubyte4n': "1.12",
+    'short2n': "1.12",
+    'short4n': "1.12",
+    'int1010102n': "1.12",
+    'half2': "13",
+}
+
+
+class ChunkWriter:
+    '''Little endian serializer keeping track of open chunks so their length
+    can be filled in when they are closed'''
+
+    def __init__(self):
+        self.data = bytearray()
+        self.open = []
+
+    def begin(self, chunkId):
+        self.open.append(len(self.data))
+        self.data += struct.pack('<HI', chunkId, 0)
+
+    def end(self):
+        start = self.open.pop()
+        struct.pack_into('<I', self.data, start + 2, len(self.data) - start)
+
+    def write(self, fmt, *values):
+        self.data += struct.pack('<' + fmt, *values)
+
+    def string(self, text):
+        self.data += text.encode('utf-8') + b'\n'
+
+    def raw(self, data):
+        self.data += data
+
+
+def toOgre(vectors):
+    # blender z up to ogre y up, as the xml writer does
+    v = np.asarray(vectors, dtype=np.float64).reshape(len(vectors), -1)
+    result = v.copy()
+    result[:, 1] = v[:, 2]
+    result[:, 2] = -v[:, 1]
+    return result
+
+
+def encode(values, fmt):
+    '''Encodes an (n, components) float array into the given format.
+    Returns the bytes of each vertex as an (n, size) uint8 array and the
+    values as the runtime will decode them.'''
+    components, size = VERTEX_FORMATS[fmt][1:]
+    count = len(values)
+    v = np.zeros((count, components))
+    width = min(components, values.shape[1])
+    v[:, :width] = values[:, :width]
+
+    if fmt.startswith('float'):
+        packed = v.astype('<f4')
+        decoded = packed.astype(np.float64)
+    elif fmt == 'half2':
+        packed = v.astype('<f2')
+        decoded = packed.astype(np.float64)
+    elif fmt in ('byte4n', 'short2n', 'short4n'):
+        scale = 127 if fmt == 'byte4n' else 32767
+        packed = np.round(np.clip(v, -1, 1) * scale).astype('<i1' if fmt == 'byte4n' else '<i2')
+        decoded = packed / scale
+    elif fmt in ('ubyte4n', 'colour_abgr'):
+        # packed abgr colours are r, g, b, a bytes in memory
+        packed = np.round(np.clip(v, 0, 1) * 255).astype('<u1')
+        decoded = packed / 255
+    elif fmt == 'int1010102n':
+        xyz = np.round(np.clip(v[:, :3], -1, 1) * 511).astype(np.int64)
+        w = np.round(np.clip(v[:, 3], -1, 1)).astype(np.int64)
+        bits = ((xyz[:, 0] & 0x3FF) | (xyz[:, 1] & 0x3FF) << 10 |
+                (xyz[:, 2] & 0x3FF) << 20 | (w & 0x3) << 30)
+        packed = bits.astype('<u4')
+        decoded = np.column_stack((xyz / 511, w))
+    return packed.view(np.uint8).reshape(count, size), decoded
+
+
+def angularError(original, decoded):
+    # largest angle in degrees between the original and decoded directions
+    a = original[:, :3]
+    b = decoded[:, :3]
+    lengths = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    valid = lengths > 0
+    if not valid.any():
+        return 0.0
+    cosines = np.einsum('ij,ij->i', a[valid], b[valid]) / lengths[valid]
+    return math.degrees(float(np.arccos(np.clip(cosines, -1, 1)).max()))
+
+
+def vertexElements(geometry, formats):
+    '''List of (semantic, format, values) for the vertex buffer, values in
+    ogre space'''
+    elements = [(VES_POSITION, 'float3', toOgre(geometry['positions']))]
+    if 'normals' in geometry:
+        elements.append((VES_NORMAL, formats['normal'], toOgre(geometry['normals'])))
+    if geometry['texcoordsets'] > 0 and 'uvsets' in geometry:
+        uvs = np.array([uv[0] for uv in geometry['uvsets']], dtype=np.float64)
+        uvs[:, 1] = 1.0 - uvs[:, 1]
+        elements.append((VES_TEXTURE_COORDINATES, formats['uv'], uvs))
+    if 'colours' in geometry:
+        elements.append((VES_DIFFUSE, formats['colour'], np.array(geometry['colours'], dtype=np.float64)))
+    if 'tangents' in geometry:
+        tangents = np.array(geometry['tangents'], dtype=np.float64)
+        values = toOgre(tangents[:, :3])
+        fmt = formats['normal']
+        if geometry['parity']:
+            values = np.column_stack((values, tangents[:, 3]))
+            if fmt == 'float3':
+                fmt = 'float4'
+        elements.append((VES_TANGENT, fmt, values))
+    if 'binormals' in geometry:
+        elements.append((VES_BINORMAL, formats['normal'], toOgre(geometry['binormals'])))
+    return elements
+
+
+def writeGeometry(writer, geometry, vertexLayout, formats, errors):
+    vertexCount = len(geometry['positions'])
+    elements = vertexElements(geometry, formats)
+
+    # positions alone in stream 0 for the split layout
+    if vertexLayout == 'split' and len(elements) > 1:
+        streams = [elements[:1], elements[1:]]
+    else:
+        streams = [elements]
+
+    declaration = []
+    buffers = []
+    for source, stream in enumerate(streams):
+        offset = 0
+        columns = []
+        for semantic, fmt, values in stream:
+            elementType = VERTEX_FORMATS[fmt][0]
+            packed, decoded = encode(values, fmt)
+            declaration.append((source, elementType, semantic, offset))
+            columns.append(packed)
+            offset += packed.shape[1]
+            recordError(errors, semantic, fmt, values, decoded)
+        buffers.append((source, offset, np.hstack(columns)))
+
+    writer.begin(M_GEOMETRY)
+    writer.write('I', vertexCount)
+    writer.begin(M_GEOMETRY_VERTEX_DECLARATION)
+    for source, elementType, semantic, offset in declaration:
+        writer.begin(M_GEOMETRY_VERTEX_ELEMENT)
+        writer.write('5H', source, elementType, semantic, offset, 0)
+        writer.end()
+    writer.end()
+    for source, vertexSize, data in buffers:
+        writer.begin(M_GEOMETRY_VERTEX_BUFFER)
+        writer.write('2H', source, vertexSize)
+        writer.begin(M_GEOMETRY_VERTEX_BUFFER_DATA)
+        writer.raw(data.tobytes())
+        writer.end()
+        writer.end()
+    writer.end()
+
+
+def recordError(errors, semantic, fmt, values, decoded):
+    if semantic in (VES_NORMAL, VES_TANGENT, VES_BINORMAL):
+        error = angularError(values, decoded)
+    elif semantic == VES_POSITION:
+        return
+    else:
+        width = min(values.shape[1], decoded.shape[1])
+        error = float(np.abs(values[:, :width] - decoded[:, :width]).max()) if len(values) else 0.0
+    errors[semantic] = (max(errors.get(semantic, (0.0,))[0], error), fmt)
+
+
+def writeBoneAssignments(writer, chunkId, skeleton, boneAssignments):
+    for vertex, weights in enumerate(boneAssignments):
+        for bone, weight in weights:
+            writer.begin(chunkId)
+            writer.write('IHf', vertex, skeleton.bone_id(bone), weight)
+            writer.end()
+
+
+def writePoses(writer, meshData):
+    poses = []
+    if meshData.get('poses'):
+        poses += [(name, 0, pose) for name, pose in meshData['poses'].items()]
+    for index, submesh in enumerate(meshData['submeshes']):
+        if submesh['poses']:
+            # pose targets are the submesh index + 1, 0 is shared geometry
+            poses += [(name, index + 1, pose) for name, pose in submesh['poses'].items()]
+    if not poses:
+        return
+
+    writer.begin(M_POSES)
+    for name, target, pose in poses:
+        writer.begin(M_POSE)
+        writer.string(name)
+        writer.write('H?', target, False)
+        for v in pose:
+            writer.begin(M_POSE_VERTEX)
+            writer.write('I3f', v[0], v[1], v[3], -v[2])
+            writer.end()
+        writer.end()
+    writer.end()
+
+
+def writeMesh(operator, meshData, filepath, skeletonLink, vertexLayout, formats):
+    '''Writes meshData to filepath as a binary mesh. skeletonLink is the
+    name of the linked .skeleton, formats maps 'normal', 'uv' and 'colour'
+    to one of VERTEX_FORMATS.'''
+    print("Writing binary " + filepath)
+    writer = ChunkWriter()
+    writer.write('H', M_HEADER)
+    writer.string(MESH_VERSION)
+
+    skeleton = meshData.get('skeleton')
+    shared = meshData.get('sharedgeometry')
+    errors = {}
+
+    writer.begin(M_MESH)
+    writer.write('?', skeleton is not None)
+
+    if shared:
+        writeGeometry(writer, shared, vertexLayout, formats, errors)
+
+    for submesh in meshData['submeshes']:
+        geometry = submesh.get('geometry') or shared
+        faces = submesh['faces']
+        use32bit = len(geometry['positions']) > 65535
+        writer.begin(M_SUBMESH)
+        writer.string(submesh['material'])
+        writer.write('?I?', shared is not None, len(faces) * 3, use32bit)
+        indices = np.asarray(faces, dtype='<u4' if use32bit else '<u2').reshape(-1)
+        writer.raw(indices.tobytes())
+        if 'geometry' in submesh:
+            writeGeometry(writer, geometry, vertexLayout, formats, errors)
+        writer.begin(M_SUBMESH_OPERATION)
+        writer.write('H', OT_TRIANGLE_LIST)
+        writer.end()
+        if skeleton and 'geometry' in submesh:
+            writeBoneAssignments(writer, M_SUBMESH_BONE_ASSIGNMENT, skeleton, geometry['boneassignments'])
+        writer.end()
+
+    if skeleton:
+        writer.begin(M_MESH_SKELETON_LINK)
+        writer.string(skeletonLink)
+        writer.end()
+        if shared:
+            writeBoneAssignments(writer, M_MESH_BONE_ASSIGNMENT, skeleton, shared['boneassignments'])
+
+    if 'levelsofdetail' in meshData:
+        operator.report({'WARNING'}, "Levels of detail are only written to XML meshes, the binary mesh has none")
+
+    # bounds
+    geometries = [shared] if shared else [s['geometry'] for s in meshData['submeshes']]
+    positions = [toOgre(g['positions']) for g in geometries if g['positions']]
+    if positions:
+        positions = np.vstack(positions)
+        low = positions.min(axis=0)
+        high = positions.max(axis=0)
+        radius = float(np.linalg.norm(positions, axis=1).max())
+    else:
+        low = high = np.zeros(3)
+        radius = 0.0
+    writer.begin(M_MESH_BOUNDS)
+    writer.write('7f', *low, *high, radius)
+    writer.end()
+
+    writePoses(writer, meshData)
+    writer.end()
+
+    with open(filepath, 'wb') as f:
+        f.write(writer.data)
+
+    reportErrors(operator, errors)
+    return True
+
+
+def versionWarnings(formats):
+    '''Warnings for chosen formats that older Ogre versions, like the one
+    Kenshi ships, can't load'''
+    return ["%s as %s needs Ogre %s or later" % (name, fmt, FORMAT_MIN_VERSION[fmt])
+            for name, fmt in sorted(formats.items()) if fmt in FORMAT_MIN_VERSION]
+
+
+def reportErrors(operator, errors):
+    names = {
+        VES_NORMAL: ("normals", "%.3f degrees"),
+        VES_TANGENT: ("tangents", "%.3f degrees"),
+        VES_BINORMAL: ("binormals", "%.3f degrees"),
+        VES_TEXTURE_COORDINATES: ("uvs", "%.6f"),
+        VES_DIFFUSE: ("colours", "%.4f"),
+    }
+    report = []
+    for semantic, (error, fmt) in sorted(errors.items()):
+        name, unit = names[semantic]
+        report.append(("%s as %s: max error " + unit) % (name, fmt, error))
+    for line in report:
+        print(line)
+    if report:
+        operator.report({'INFO'}, ", ".join(report))
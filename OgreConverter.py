@@ -0,0 +1,312 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8-80 compliant>
+
+"""
+Runs OgreXMLConverter processes. Every run records its exit code, stderr
+and duration, and a ConverterPool runs conversions on a bounded number of
+worker threads so the exporter can keep writing XML while they finish.
+
+On Linux a native OgreXMLConverter is preferred when installed, otherwise the
+bundled Windows converter runs under a wineserver kept alive for the session.
+
+Nothing in here touches bpy, so the jobs are safe to run off the main thread.
+"""
+
+import errno
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class ConversionResult(object):
+
+    def __init__(self, filename, returncode, stderr, seconds):
+        self.filename = filename
+        self.returncode = returncode
+        self.stderr = stderr
+        self.seconds = seconds
+
+    @property
+    def success(self):
+        return self.returncode == 0
+
+
+class ConversionLog(object):
+    '''Thread safe list of the conversions run during one import or export'''
+
+    def __init__(self):
+        self.results = []
+        self.lock = threading.Lock()
+
+    def add(self, result):
+        with self.lock:
+            self.results.append(result)
+
+    def failures(self):
+        with self.lock:
+            return [r for r in self.results if not r.success]
+
+    def report(self, operator):
+        with self.lock:
+            results = list(self.results)
+        if not results:
+            return
+        failed = [r for r in results if not r.success]
+        for r in failed:
+            print("Conversion failed (exit code %s): %s" % (r.returncode, r.filename))
+            if r.stderr:
+                print(r.stderr.rstrip())
+        total = sum(r.seconds for r in results)
+        print("Converted %d files in %.2fs converter time, %d failed" % (len(results), total, len(failed)))
+        # per file latency, and how much of it is just launching the converter
+        for r in results:
+            print("  %.2fs %s" % (r.seconds, os.path.basename(r.filename)))
+        launch = wineServer.startupSeconds
+        if launch is not None:
+            print("Average %.2fs per file, of which about %.2fs is Wine and converter startup "
+                  "(%.2fs once to warm up)" % (total / len(results), launch, wineServer.warmUpSeconds))
+        else:
+            print("Average %.2fs per file" % (total / len(results)))
+        if failed:
+            operator.report({'WARNING'}, "%d of %d conversions failed, see the console for details" %
+                            (len(failed), len(results)))
+        else:
+            operator.report({'INFO'}, "Converted %d files" % len(results))
+
+
+class DeferredReports(object):
+    '''Stands in for the operator on worker threads, reports are passed on
+    from the main thread'''
+
+    def __init__(self):
+        self.reports = []
+        self.lock = threading.Lock()
+
+    def report(self, type, message):
+        with self.lock:
+            self.reports.append((type, message))
+
+    def flush(self, operator):
+        with self.lock:
+            reports, self.reports = self.reports, []
+        for type, message in reports:
+            operator.report(type, message)
+
+
+def runConverter(converter, args, filename, log=None, destination=None):
+    '''Runs the converter on one file, returning a ConversionResult'''
+    command = [converter] + args + [filename]
+    if destination:
+        command.append(destination)
+    start = time.perf_counter()
+    try:
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout = proc.stdout.decode(errors='replace')
+        stderr = proc.stderr.decode(errors='replace')
+        returncode = proc.returncode
+    except OSError as e:
+        stdout = ""
+        stderr = str(e)
+        returncode = None
+    result = ConversionResult(filename, returncode, stderr, time.perf_counter() - start)
+    if stdout:
+        print(stdout.rstrip())
+    if log is not None:
+        log.add(result)
+    return result
+
+
+def convertFile(converter, args, filename, output, keepInput=True, log=None):
+    '''Converts filename and checks the converter wrote output. The input is
+    removed afterwards unless keepInput is set'''
+    result = runConverter(converter, args, filename, log)
+    if result.success and not os.path.isfile(output):
+        print("Could not find", output)
+        result.returncode = -1
+        result.stderr += "\nConverter did not write %s" % output
+    if not keepInput and os.path.isfile(filename):
+        os.unlink(filename)
+    return result.success
+
+
+def scratchRoot(path=""):
+    '''Directory for intermediate files, a tmpfs on Linux unless set'''
+    if path:
+        return path
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class ScratchSpace(object):
+    '''Private directory for the intermediate files of one import or export.
+    The directory is only created once a path in it is asked for'''
+
+    def __init__(self, root=""):
+        self.root = scratchRoot(root)
+        self.directory = None
+
+    def path(self, filename):
+        if self.directory is None:
+            os.makedirs(self.root, exist_ok=True)
+            self.directory = tempfile.mkdtemp(prefix="kenshi_io_", dir=self.root)
+        return os.path.join(self.directory, os.path.basename(filename))
+
+    def contains(self, path):
+        return self.directory is not None and os.path.dirname(path) == self.directory
+
+    def cleanup(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+def removeFile(path):
+    '''Deletes path if it is still there'''
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def moveIntoPlace(source, target):
+    '''Replaces target with source atomically, so readers only ever see the
+    old or the complete new file, even when source is on another file system'''
+    try:
+        os.replace(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # copy next to the target first, the rename there is atomic
+        partial = target + ".partial"
+        shutil.copyfile(source, partial)
+        os.replace(partial, target)
+        os.unlink(source)
+
+
+class ConverterPool(object):
+    '''Runs jobs on up to jobs worker threads. With a single job everything
+    runs synchronously on the calling thread, unless background is set'''
+
+    def __init__(self, jobs=1, background=False):
+        self.executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 or background else None
+
+    def submit(self, fn, *args, **kwargs):
+        if self.executor:
+            return self.executor.submit(fn, *args, **kwargs)
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, cancel=False):
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=cancel)
+            self.executor = None
+
+
+def findNativeConverter():
+    '''OgreXMLConverter built for this system, e.g. from the distribution's
+    Ogre tools package, which runs without Wine'''
+    if platform.system() == "Windows":
+        return None
+    return shutil.which("OgreXMLConverter")
+
+
+def usesWine(converter):
+    if converter is None or platform.system() == "Windows":
+        return False
+    return converter.lower().endswith((".bash", ".exe"))
+
+
+class WineServer(object):
+    '''Keeps a wineserver running for the whole session so converter runs
+    don't each pay for starting Wine. Only a server started here is stopped'''
+
+    def __init__(self):
+        self.process = None
+        self.thread = None
+        # first launch, and a launch once the server and dlls are warm
+        self.warmUpSeconds = None
+        self.startupSeconds = None
+        self.lock = threading.Lock()
+
+    def start(self, converter):
+        with self.lock:
+            if self.thread is not None or shutil.which("wineserver") is None:
+                return
+            self.thread = threading.Thread(target=self.warmUp, args=(converter,), daemon=True)
+            self.thread.start()
+
+    def warmUp(self, converter):
+        try:
+            # stays in the foreground so it can be stopped, exits at once if a server is already running
+            process = subprocess.Popen(["wineserver", "--foreground", "--persistent"],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            time.sleep(0.5)
+            if process.poll() is None:
+                self.process = process
+            # running the converter without arguments loads Wine and the converter's dlls
+            command = ["wine", converter] if converter.lower().endswith(".exe") else [converter]
+            self.warmUpSeconds = self.timeLaunch(command)
+            # what is left of the startup for every file converted from now on
+            self.startupSeconds = self.timeLaunch(command)
+            print("Wine converter warmed up in %.2fs, launch now takes %.2fs" %
+                  (self.warmUpSeconds, self.startupSeconds))
+        except OSError as e:
+            print("Could not start wineserver", e)
+
+    def timeLaunch(self, command):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+    def wait(self, timeout=None):
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stop(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(5)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+            self.process = None
+            self.thread = None
+            self.warmUpSeconds = None
+            self.startupSeconds = None
+
+
+wineServer = WineServer()
+
+
+def warmUpConverter(converter):
+    if usesWine(converter):
+        wineServer.start(converter)
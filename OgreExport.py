@@ -104,8 +104,18 @@ import bpy
 from mathutils import Vector, Matrix, Quaternion
 import math
 import os
-import subprocess
 import shutil
+import hashlib
+import json
+import struct
+import sys
+from array import array
+from concurrent import futures
+import numpy as np
+from . import OgreOptimize
+from . import OgreBinary
+from . import OgreConverter
+from . import OgreMeshModel
 
 SHOW_EXPORT_DUMPS = False
 SHOW_EXPORT_TRACE = False
@@ -116,6 +126,9 @@ blender_version = 259
 
 rounding_epsilon = 1e-3
 
+# shape key offsets smaller than this are not exported
+pose_epsilon = 1e-6
+
 def hash_combine(x, y):
     return x ^ y + 0x9e3779b9 + (x << 6) + (x >> 2)
 
@@ -304,7 +317,284 @@ class Skeleton(object):
 # -------------------------------------------------------------------- #
 
 
-def bCollectAnimationData(meshData):
+def flattenValue(value):
+    # turn rna arrays, vectors and matrices into nested tuples
+    if isinstance(value, str):
+        return value
+    try:
+        return tuple(flattenValue(v) for v in value)
+    except TypeError:
+        return value
+
+
+# ui state that doesn't affect the baked result
+FINGERPRINT_IGNORED_PROPERTIES = {'rna_type', 'select', 'active', 'show_expanded'}
+
+
+def rnaFingerprint(struct):
+    # all plain rna properties of a struct, ID pointers by name
+    values = []
+    for prop in struct.bl_rna.properties:
+        if prop.identifier in FINGERPRINT_IGNORED_PROPERTIES:
+            continue
+        if prop.type in {'BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM'}:
+            value = getattr(struct, prop.identifier, None)
+            if prop.type == 'ENUM' and prop.is_enum_flag:
+                value = tuple(sorted(value))
+            values.append((prop.identifier, flattenValue(value)))
+        elif prop.type == 'POINTER':
+            value = getattr(struct, prop.identifier, None)
+            if isinstance(value, bpy.types.ID):
+                values.append((prop.identifier, value.name_full))
+    return repr(values)
+
+
+def fcurveFingerprint(hash, fcurve):
+    hash.update(repr((fcurve.data_path, fcurve.array_index, fcurve.mute,
+                      fcurve.extrapolation)).encode())
+    points = fcurve.keyframe_points
+    for attr in ('co', 'handle_left', 'handle_right'):
+        values = array('f', [0.0]) * (len(points) * 2)
+        points.foreach_get(attr, values)
+        hash.update(values.tobytes())
+    hash.update(repr([(p.interpolation, p.easing) for p in points]).encode())
+    for modifier in fcurve.modifiers:
+        hash.update(rnaFingerprint(modifier).encode())
+
+
+def driverFingerprint(hash, animdata):
+    if not animdata:
+        return
+    for fcurve in animdata.drivers:
+        fcurveFingerprint(hash, fcurve)
+        driver = fcurve.driver
+        hash.update(repr((driver.type, driver.expression)).encode())
+        for variable in driver.variables:
+            hash.update(repr((variable.name, variable.type)).encode())
+            for target in variable.targets:
+                hash.update(rnaFingerprint(target).encode())
+
+
+def bakeCacheKey(armature, action, fps, step):
+    # everything that changes the result of collectAnimationData
+    hash = hashlib.sha1()
+    hash.update(repr((action.name, tuple(action.frame_range), fps, step)).encode())
+    for fcurve in action.fcurves:
+        fcurveFingerprint(hash, fcurve)
+
+    # rest pose and bone settings
+    hash.update(repr(skeletonFingerprint(armature)).encode())
+    for bone in armature.data.bones:
+        hash.update(repr((bone.use_inherit_rotation, bone.inherit_scale,
+                          bone.use_local_location, bone.use_connect)).encode())
+
+    # constraints, including where their targets are
+    for poseBone in armature.pose.bones:
+        hash.update(repr((poseBone.name, poseBone.rotation_mode)).encode())
+        for constraint in poseBone.constraints:
+            hash.update(rnaFingerprint(constraint).encode())
+            for target in [getattr(constraint, 'target', None)] + \
+                    [t.target for t in getattr(constraint, 'targets', [])]:
+                if target:
+                    hash.update(repr(flattenValue(target.matrix_world)).encode())
+                    if target.animation_data and target.animation_data.action:
+                        for fcurve in target.animation_data.action.fcurves:
+                            fcurveFingerprint(hash, fcurve)
+    for constraint in armature.constraints:
+        hash.update(rnaFingerprint(constraint).encode())
+
+    # drivers and the nla stack evaluated on top of the action
+    driverFingerprint(hash, armature.animation_data)
+    driverFingerprint(hash, armature.data.animation_data)
+    for track in armature.animation_data.nla_tracks:
+        hash.update(repr((track.name, track.mute, track.is_solo)).encode())
+        for strip in track.strips:
+            hash.update(rnaFingerprint(strip).encode())
+
+    return hash.digest()
+
+
+class AnimationBakeCache(object):
+    '''Baked animations keyed by bakeCacheKey, stored in a binary sidecar
+    file (<armature>.bakecache) next to the exported mesh'''
+
+    MAGIC = b'KBAK'
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}     # sidecar path -> {key: keyframes}
+        self.used = {}      # sidecar path -> keys used in this export
+
+    def path(self, armature):
+        name = bpy.path.clean_name(armature.name)
+        return os.path.join(self.directory, name + ".bakecache")
+
+    def entries(self, path):
+        if path not in self.files:
+            self.files[path] = self.read(path)
+            self.used[path] = set()
+        return self.files[path]
+
+    def get(self, armature, key):
+        path = self.path(armature)
+        keyframes = self.entries(path).get(key)
+        if keyframes is not None:
+            self.used[path].add(key)
+        return keyframes
+
+    def put(self, armature, key, keyframes):
+        path = self.path(armature)
+        self.entries(path)[key] = keyframes
+        self.used[path].add(key)
+
+    def save(self):
+        # only keep entries that are still in use
+        for path, entries in self.files.items():
+            used = self.used[path]
+            if used:
+                self.write(path, {k: v for k, v in entries.items() if k in used})
+
+    @staticmethod
+    def packFloats(values):
+        data = array('f', values)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return data.tobytes()
+
+    @staticmethod
+    def unpackFloats(buffer, offset, count):
+        data = array('f')
+        data.frombytes(buffer[offset:offset + count * 4])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return data, offset + count * 4
+
+    def write(self, path, entries):
+        chunks = [self.MAGIC, struct.pack('<HI', self.VERSION, len(entries))]
+        for key, keyframes in entries.items():
+            times = []
+            for data in keyframes.values():
+                times = [k[0] for k in data[0]]
+                break
+            chunks.append(key)
+            chunks.append(struct.pack('<IH', len(times), len(keyframes)))
+            chunks.append(self.packFloats(times))
+            for bone, data in keyframes.items():
+                name = bone.encode('utf-8')
+                chunks.append(struct.pack('<H', len(name)))
+                chunks.append(name)
+                for channel in data:
+                    chunks.append(self.packFloats(
+                        [v for k in channel for v in k[1]]))
+        try:
+            with open(path, 'wb') as f:
+                f.write(b''.join(chunks))
+        except OSError as e:
+            print("Could not write animation cache", path, e)
+
+    def read(self, path):
+        entries = {}
+        if not os.path.isfile(path):
+            return entries
+        try:
+            with open(path, 'rb') as f:
+                buffer = f.read()
+            if buffer[:4] != self.MAGIC:
+                return entries
+            version, count = struct.unpack_from('<HI', buffer, 4)
+            if version != self.VERSION:
+                return entries
+            offset = 10
+            for entry in range(count):
+                key = buffer[offset:offset + 20]
+                frames, bones = struct.unpack_from('<IH', buffer, offset + 20)
+                offset += 26
+                times, offset = self.unpackFloats(buffer, offset, frames)
+                keyframes = {}
+                for b in range(bones):
+                    length, = struct.unpack_from('<H', buffer, offset)
+                    bone = buffer[offset + 2:offset + 2 + length].decode('utf-8')
+                    offset += 2 + length
+                    data = []
+                    for size in (3, 4, 3):  # pos, rot, scl
+                        values, offset = self.unpackFloats(buffer, offset, frames * size)
+                        data.append([(times[i], tuple(values[i * size:(i + 1) * size]))
+                                     for i in range(frames)])
+                    keyframes[bone] = data
+                entries[key] = keyframes
+        except (OSError, struct.error, UnicodeDecodeError) as e:
+            print("Ignoring invalid animation cache", path, e)
+            return {}
+        return entries
+
+
+def bakeDependencies(armature):
+    # objects the pose of the armature depends on: parents, constraint
+    # targets and driver targets
+    found = set()
+    stack = [armature]
+    while stack:
+        ob = stack.pop()
+        if ob is None or ob in found:
+            continue
+        found.add(ob)
+        stack.append(ob.parent)
+
+        constraints = list(ob.constraints)
+        if ob.pose:
+            for poseBone in ob.pose.bones:
+                constraints.extend(poseBone.constraints)
+        for constraint in constraints:
+            stack.append(getattr(constraint, 'target', None))
+            stack.append(getattr(constraint, 'pole_target', None))
+            for target in getattr(constraint, 'targets', []):
+                stack.append(target.target)
+
+        for animdata in (ob.animation_data, getattr(ob.data, 'animation_data', None)):
+            if not animdata:
+                continue
+            for fcurve in animdata.drivers:
+                for variable in fcurve.driver.variables:
+                    for target in variable.targets:
+                        if isinstance(target.id, bpy.types.Object):
+                            stack.append(target.id)
+    return found
+
+
+class IsolatedBakeScene(object):
+    '''Temporary scene holding only an armature and what it depends on, so
+    changing frames does not evaluate the rest of the file'''
+
+    def __init__(self, armature, source):
+        self.scene = bpy.data.scenes.new("KenshiAnimationBake")
+        self.scene.render.fps = source.render.fps
+        self.scene.render.fps_base = source.render.fps_base
+        for ob in bakeDependencies(armature):
+            self.scene.collection.objects.link(ob)
+        # a view layer only has a depsgraph once it has been evaluated
+        self.scene.view_layers[0].update()
+
+    def frame_set(self, frame):
+        self.scene.frame_set(frame)
+
+    def evaluated(self, ob):
+        return ob.evaluated_get(self.scene.view_layers[0].depsgraph)
+
+    def remove(self):
+        bpy.data.scenes.remove(self.scene)
+        self.scene = None
+
+
+def bCollectAnimationData(meshData, export_params, bakeCache=None):
+    for progress in bCollectAnimationSteps(meshData, export_params, bakeCache):
+        pass
+
+
+def bCollectAnimationSteps(meshData, export_params, bakeCache=None):
+    '''bCollectAnimationData as a generator, yielding the fraction of actions
+    done after each one so a background export doesn't bake them all in one
+    step. Stops early if the armature is removed in between'''
     if 'skeleton' not in meshData:
         return
     armature = meshData['skeleton'].armature
@@ -318,89 +608,245 @@ def bCollectAnimationData(meshData):
         fps = scene.render.fps
         frame_step = scene.frame_step
         meshData['animations'] = []
-
-        for track in animdata.nla_tracks.values():
-            for strip in track.strips.values():
-                if strip.action:
-                    print('Action', strip.action.name)
-                    action = strip.action
+        bakeScene = None
+        actions = [strip.action for track in animdata.nla_tracks.values()
+                   for strip in track.strips.values() if strip.action]
+
+        try:
+            for done, action in enumerate(actions):
+                if done:
+                    yield done / len(actions)
+                    if objectRemoved(armature):
+                        print('Armature was removed during export, stopped collecting animations')
+                        return
+                print('Action', action.name)
+
+                animation = {}
+                keyframes = None
+                if bakeCache is not None:
+                    key = bakeCacheKey(armature, action, fps, frame_step)
+                    keyframes = bakeCache.get(armature, key)
+                    if keyframes is not None:
+                        print('Using cached bake for', action.name)
+                if keyframes is None:
+                    if export_params["isolate_animation_bake"] and bakeScene is None:
+                        bakeScene = IsolatedBakeScene(armature, scene)
                     animdata.action = action
+                    keyframes = collectAnimationData(
+                        armature, action.frame_range, fps, frame_step, bakeScene)
+                    if bakeCache is not None:
+                        bakeCache.put(armature, key, keyframes)
+                if export_params["reduce_keyframes"]:
+                    reduced = reduceKeyframes(keyframes,
+                                              export_params["reduce_translation_tolerance"],
+                                              export_params["reduce_angle_tolerance"])
+                    print('Reduced keys from', sum(len(c) for d in keyframes.values() for c in d),
+                          'to', sum(len(c) for d in reduced.values() for c in d))
+                    keyframes = reduced
+                animation['keyframes'] = keyframes
+                animation['name'] = action.name
+                animation['length'] = (
+                    action.frame_range[1] - action.frame_range[0]) / fps
+                meshData['animations'].append(animation)
+
+        finally:
+            # don't leave the bake scene or a changed action in the file if anything fails
+            if bakeScene:
+                bakeScene.remove()
+
+            # Restore original action and frame
+            if not objectRemoved(armature):
+                animdata.action = currentAction
+            scene.frame_set(currentFrame)
+
+
+def matricesToLocRotScale(matrices):
+    # batched Matrix.decompose() for an (..., 4, 4) array
+    loc = matrices[..., :3, 3]
+    rot = matrices[..., :3, :3]
+    scl = np.linalg.norm(rot, axis=-2)
+    rot = rot / np.where(scl == 0, 1, scl)[..., np.newaxis, :]
+    negative = np.linalg.det(rot) < 0
+    rot = np.where(negative[..., np.newaxis, np.newaxis], -rot, rot)
+    scl = np.where(negative[..., np.newaxis], -scl, scl)
+    return loc, matricesToQuaternions(rot), scl
+
+
+def matricesToQuaternions(rot):
+    # batched rotation matrix to (w, x, y, z) quaternion, picking the most
+    # stable of the four solutions for each matrix
+    m00, m01, m02 = rot[..., 0, 0], rot[..., 0, 1], rot[..., 0, 2]
+    m10, m11, m12 = rot[..., 1, 0], rot[..., 1, 1], rot[..., 1, 2]
+    m20, m21, m22 = rot[..., 2, 0], rot[..., 2, 1], rot[..., 2, 2]
+    candidates = np.stack([
+        np.stack([1 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01], -1),
+        np.stack([m21 - m12, 1 + m00 - m11 - m22, m01 + m10, m02 + m20], -1),
+        np.stack([m02 - m20, m01 + m10, 1 - m00 + m11 - m22, m12 + m21], -1),
+        np.stack([m10 - m01, m02 + m20, m12 + m21, 1 - m00 - m11 + m22], -1),
+    ], -2)
+    best = np.argmax(np.stack([m00 + m11 + m22, m00, m11, m22], -1), axis=-1)
+    q = np.take_along_axis(candidates, best[..., np.newaxis, np.newaxis], -2)[..., 0, :]
+    q /= np.linalg.norm(q, axis=-1)[..., np.newaxis]
+    # same sign convention as mathutils, w is never negative
+    return np.where(q[..., :1] < 0, -q, q)
+
+
+def collectAnimationData(armature, frame_range, fps, step=1, bakeScene=None):
+    start, end = frame_range
+    frames = range(int(start), int(end)+1, step)
 
-                    animation = {}
-                    animation['keyframes'] = collectAnimationData(
-                        armature, action.frame_range, fps, frame_step)
-                    animation['name'] = action.name
-                    animation['length'] = (
-                        action.frame_range[1] - action.frame_range[0]) / fps
-                    meshData['animations'].append(animation)
-
-        # Restore original action and frame
-        animdata.action = currentAction
-        scene.frame_set(currentFrame)
-
+    poseBones = armature.pose.bones
+    names = [bone.name for bone in poseBones]
+    index = {name: i for i, name in enumerate(names)}
+    parents = np.array([index[bone.parent.name] if bone.parent else -1 for bone in poseBones])
+    exported = [i for i, name in enumerate(names) if not name.startswith("H_")]
 
-def collectAnimationData(armature, frame_range, fps, step=1):
-    scene = bpy.context.scene
-    start, end = frame_range
+    # bones with non default inheritance need blender to do the conversion
+    vectorized = np.array([bone.bone.use_inherit_rotation and bone.bone.inherit_scale == 'FULL'
+                           and bone.bone.use_local_location for bone in poseBones])
 
-    keyframes = {bone.name: [[], [], []] for bone in armature.pose.bones if not bone.name.startswith("H_")} # pos, rot, scl
+    # Rest matrices in armature space, in pose bone order
+    rest = np.empty((len(poseBones), 4, 4))
+    for i, bone in enumerate(poseBones):
+        rest[i] = bone.bone.matrix_local
 
     # Swap YZ and negate some matrices
-    fix1 = Matrix([(1, 0, 0), (0, 0, 1), (0, -1, 0)])
-    fix2 = Matrix([(0, 1, 0), (0, 0, 1), (1, 0, 0)])
+    fix1 = np.array([(1, 0, 0), (0, 0, 1), (0, -1, 0)])
+    fix2 = np.array([(0, 1, 0), (0, 0, 1), (1, 0, 0)])
 
     # Get base matrices
-    mat = {}
-    hidden = armature.hide_viewport
-    armature.hide_viewport = False
-    prev = bpy.context.view_layer.objects.active
-    bpy.context.view_layer.objects.active = armature
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.mode_set(mode='EDIT')
-    for b in armature.data.edit_bones:
-        if b.name.startswith("H_"):
-            continue
-        if b.parent:
-            mat[b.name] = fix2 @ b.parent.matrix.to_3x3().transposed() @ b.matrix.to_3x3()
-        else:
-            mat[b.name] = fix1 @  b.matrix.to_3x3()
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.context.view_layer.objects.active = prev
-    armature.hide_viewport = hidden
+    hasParent = parents >= 0
+    parentRest = rest[np.where(hasParent, parents, 0)]
+    mat = np.where(hasParent[:, np.newaxis, np.newaxis],
+                   fix2 @ parentRest[:, :3, :3].transpose(0, 2, 1) @ rest[:, :3, :3],
+                   fix1 @ rest[:, :3, :3])
+
+    # pose to local: rest^-1 @ parentRest @ parentPose^-1 @ pose
+    restInverse = np.linalg.inv(rest)
+    offset = np.where(hasParent[:, np.newaxis, np.newaxis], restInverse @ parentRest, restInverse)
 
     # Reset pose
     iQ = Quaternion((0, 0, 0), 1)
     Scale = Vector((1, 1, 1))
-    for poseBone in armature.pose.bones:
+    for poseBone in poseBones:
         poseBone.rotation_quaternion = iQ
         poseBone.scale = Scale
         poseBone.location = poseBone.bone.head
 
     bpy.ops.object.mode_set(mode='OBJECT')
 
-    # Collect data
-    obj = bpy.context.object
-    for frame in range(int(start), int(end)+1, step):
-        time = (frame - start) / fps
-        bpy.context.scene.frame_set(frame)
-        for bone in armature.pose.bones:
-            if bone.name.startswith("H_"):
-                continue
-            loc, rot, scl = bone.matrix.decompose()
+    # Collect pose matrices of all bones, one bulk read per frame
+    pose = np.empty((len(frames), len(poseBones), 4, 4))
+    buffer = np.empty(len(poseBones) * 16, dtype=np.float32)
+    fallback = {}
+    for f, frame in enumerate(frames):
+        if bakeScene:
+            # only the armature and its dependencies are evaluated, read the
+            # pose from the evaluated copy as it isn't flushed back
+            bakeScene.frame_set(frame)
+            evaluated = bakeScene.evaluated(armature)
+        else:
+            bpy.context.scene.frame_set(frame)
+            evaluated = armature
+        evaluated.pose.bones.foreach_get('matrix', buffer)
+        # rna matrices are column major
+        pose[f] = buffer.reshape(-1, 4, 4).transpose(0, 2, 1)
+
+        for i in exported:
+            if not vectorized[i]:
+                bone = evaluated.pose.bones[i]
+                fallback[f, i] = evaluated.convert_space(pose_bone=bone,
+                                                         matrix=bone.matrix,
+                                                         from_space='POSE',
+                                                         to_space='LOCAL')
+
+    # pinv so bones scaled to zero don't break the whole bake
+    parentPoseInverse = np.linalg.pinv(pose)[:, np.where(hasParent, parents, 0)]
+    local = np.where(hasParent[np.newaxis, :, np.newaxis, np.newaxis],
+                     offset @ parentPoseInverse @ pose, offset @ pose)
+    for (f, i), matrix in fallback.items():
+        local[f, i] = matrix
+
+    loc, rot, scl = matricesToLocRotScale(local)
+    loc = (mat[np.newaxis] @ loc[..., np.newaxis])[..., 0]
+
+    times = [(frame - start) / fps for frame in frames]
+    keyframes = {}  # pos, rot, scl
+    for i in exported:
+        keyframes[names[i]] = [list(zip(times, map(tuple, loc[:, i].tolist()))),
+                               list(zip(times, map(tuple, rot[:, i].tolist()))),
+                               list(zip(times, map(tuple, scl[:, i].tolist())))]
 
-            pbMatrix = armature.convert_space(pose_bone=bone,
-                                              matrix=bone.matrix,
-                                              from_space='POSE',
-                                              to_space='LOCAL')
+    return keyframes
 
-            loc, rot, scl = pbMatrix.decompose()
-            loc = mat[bone.name] @ loc
 
-            keyframes[bone.name][0].append((time, (loc[0], loc[1], loc[2])))
-            keyframes[bone.name][1].append((time, (rot[0], rot[1], rot[2], rot[3])))
-            keyframes[bone.name][2].append((time, (scl[0], scl[1], scl[2])))
+def isRestChannel(channel, values, translationTolerance, angleTolerance):
+    # a channel that never leaves the rest pose doesn't need exporting
+    if channel == 1:
+        return np.all(2 * np.arccos(np.clip(np.abs(values[:, 0]), 0, 1)) <= angleTolerance)
+    rest = 1 if channel == 2 else 0
+    return np.all(np.abs(values - rest) <= translationTolerance)
+
+
+def interpolationError(channel, values, times, a, b):
+    # error of the keys between a and b when interpolating from a to b
+    t = ((times[a+1:b] - times[a]) / (times[b] - times[a]))[:, np.newaxis]
+    if channel == 1:
+        # slerp
+        q0, q1 = values[a], values[b]
+        dot = np.dot(q0, q1)
+        if dot < 0:
+            q1, dot = -q1, -dot
+        theta = math.acos(min(dot, 1.0))
+        if theta < 1e-6:
+            interpolated = q0 + (q1 - q0) * t
+        else:
+            interpolated = (np.sin((1 - t) * theta) * q0 + np.sin(t * theta) * q1) / math.sin(theta)
+        interpolated /= np.linalg.norm(interpolated, axis=1)[:, np.newaxis]
+        dots = np.abs(np.sum(interpolated * values[a+1:b], axis=1))
+        return np.max(2 * np.arccos(np.clip(dots, 0, 1)))
+    interpolated = values[a] + (values[b] - values[a]) * t
+    return np.max(np.abs(interpolated - values[a+1:b]))
+
+
+def reduceChannel(channel, values, times, tolerance):
+    # greedy: extend each segment as far as interpolation stays in tolerance
+    keep = [0]
+    anchor = 0
+    for end in range(2, len(values)):
+        if interpolationError(channel, values, times, anchor, end) > tolerance:
+            anchor = end - 1
+            keep.append(anchor)
+    if len(values) > 1:
+        keep.append(len(values) - 1)
+    return keep
+
+
+def reduceKeyframes(keyframes, translationTolerance, angleTolerance):
+    '''Drops channels that stay at rest and keys that linear/slerp
+    interpolation reproduces within tolerance. Scale uses the translation
+    tolerance. Returns a new keyframes dictionary.'''
+    reduced = {}
+    for bone, data in keyframes.items():
+        if not any(data):
+            continue
+        times = np.array([key[0] for key in next(c for c in data if c)])
+        channels = []
+        keep = set()
+        for channel, keys in enumerate(data):
+            values = np.array([key[1] for key in keys])
+            if not keys or isRestChannel(channel, values, translationTolerance, angleTolerance):
+                channels.append(None)
+                continue
+            tolerance = angleTolerance if channel == 1 else translationTolerance
+            keep.update(reduceChannel(channel, values, times, tolerance))
+            channels.append(keys)
 
-    return keyframes
+        # all channels of a track share key times
+        keep = sorted(keep)
+        if keep:
+            reduced[bone] = [[keys[i] for i in keep] if keys else [] for keys in channels]
+    return reduced
 
 
 def xSaveAnimations(meshData, xNode, xDoc):
@@ -421,7 +867,7 @@ def xSaveAnimation(animation, xDoc, xAnimations):
     anim.setAttribute('length', '%6f' % animation['length'])
     keyframes = animation['keyframes']
     for bone, data in keyframes.items():
-        if not data:
+        if not any(data):
             continue
         track = xDoc.createElement('track')
         keyframes = xDoc.createElement('keyframes')
@@ -446,13 +892,13 @@ def xSaveAnimation(animation, xDoc, xAnimations):
 
             if data[1]:
                 rot = data[1][frame][1]
-                angle = math.acos(rot[0]) * 2
+                angle = math.acos(max(-1.0, min(1.0, rot[0]))) * 2
                 l = math.sqrt(rot[1]*rot[1] + rot[2]*rot[2] + rot[3]*rot[3])
                 
                 if math.isclose(l, 0.0, abs_tol=rounding_epsilon):#prevent rounding errors
                     axis = (1, 0, 0)
                 else:
-                    (rot[1]/l, rot[2]/l, rot[3]/l)
+                    axis = (rot[1]/l, rot[2]/l, rot[3]/l)
 
                 rotate = xDoc.createElement('rotate')
                 raxis = xDoc.createElement('axis')
@@ -497,7 +943,7 @@ def indent(indent):
     return "        "*indent
 
 
-def xSaveGeometry(geometry, xDoc, xMesh, isShared):
+def xSaveGeometry(geometry, xDoc, xMesh, isShared, vertexLayout='interleaved'):
     # I guess positions (vertices) must be there always
     vertices = geometry['positions']
 
@@ -537,80 +983,102 @@ def xSaveGeometry(geometry, xDoc, xMesh, isShared):
     xGeometry.setAttribute("vertexcount", str(len(vertices)))
     xMesh.appendChild(xGeometry)
 
-    xVertexBuffer = xDoc.createElement("vertexbuffer")
-    xVertexBuffer.setAttribute("positions", "true")
-    if isNormals:
-        xVertexBuffer.setAttribute("normals", "true")
-    if isTexCoordsSets:
-        xVertexBuffer.setAttribute("texture_coord_dimensions_0", "2")
-        # str(texCoordSets)) # Only export one set
-        xVertexBuffer.setAttribute("texture_coords", "1")
-
-    if isColours:
-        xVertexBuffer.setAttribute("colours_diffuse", "true")
-    if isTangents:
-        xVertexBuffer.setAttribute("tangents", "true")
-        if isParity:
-            xVertexBuffer.setAttribute("tangent_dimensions", "4")
-    if isBinormals:
-        xVertexBuffer.setAttribute("binormals", "true")
-
-    xGeometry.appendChild(xVertexBuffer)
-
-    for i, vx in enumerate(vertices):
-        xVertex = xDoc.createElement("vertex")
-        xVertexBuffer.appendChild(xVertex)
-        xPosition = xDoc.createElement("position")
-        xPosition.setAttribute("x", toFmtStr(vx[0]))
-        xPosition.setAttribute("y", toFmtStr(vx[2]))
-        xPosition.setAttribute("z", toFmtStr(-vx[1]))
-        xVertex.appendChild(xPosition)
-
-        if isNormals:
-            xNormal = xDoc.createElement("normal")
-            xNormal.setAttribute("x", toFmtStr(normals[i][0]))
-            xNormal.setAttribute("y", toFmtStr(normals[i][2]))
-            xNormal.setAttribute("z", toFmtStr(-normals[i][1]))
-            xVertex.appendChild(xNormal)
-
-        if isTexCoordsSets:
-            xUVSet = xDoc.createElement("texcoord")
-            # take only 1st set for now
-            xUVSet.setAttribute("u", toFmtStr(uvSets[i][0][0]))
-            xUVSet.setAttribute("v", toFmtStr(1.0 - uvSets[i][0][1]))
-            xVertex.appendChild(xUVSet)
-
-        if isColours:
-            xColour = xDoc.createElement("colour_diffuse")
-            xColour.setAttribute("value", '%g %g %g %g' % (
-                colours[i][0], colours[i][1], colours[i][2], colours[i][3]))
-            xVertex.appendChild(xColour)
-
-        if isTangents:
-            xTangent = xDoc.createElement("tangent")
-            xTangent.setAttribute("x", toFmtStr(tangents[i][0]))
-            xTangent.setAttribute("y", toFmtStr(tangents[i][2]))
-            xTangent.setAttribute("z", toFmtStr(-tangents[i][1]))
-            if isParity:
-                xTangent.setAttribute("w", toFmtStr(tangents[i][3]))
-            xVertex.appendChild(xTangent)
-
-        if isBinormals:
-            xBinormal = xDoc.createElement("binormal")
-            xBinormal.setAttribute("x", toFmtStr(binormals[i][0]))
-            xBinormal.setAttribute("y", toFmtStr(binormals[i][2]))
-            xBinormal.setAttribute("z", toFmtStr(-binormals[i][1]))
-            xVertex.appendChild(xBinormal)
-
+    # each buffer is a separate stream, split puts positions in one of
+    # their own so depth and shadow passes only fetch those
+    if vertexLayout == 'split':
+        streams = [('position',), ('normal', 'texcoord', 'colour', 'tangent', 'binormal')]
+    else:
+        streams = [('position', 'normal', 'texcoord', 'colour', 'tangent', 'binormal')]
+
+    for stream in streams:
+        hasPositions = 'position' in stream
+        hasNormals = isNormals and 'normal' in stream
+        hasTexCoords = isTexCoordsSets and 'texcoord' in stream
+        hasColours = isColours and 'colour' in stream
+        hasTangents = isTangents and 'tangent' in stream
+        hasBinormals = isBinormals and 'binormal' in stream
+        if not (hasPositions or hasNormals or hasTexCoords or hasColours or hasTangents or hasBinormals):
+            continue
 
-def xSaveSubMeshes(meshData, xDoc, xMesh, hasSharedGeometry):
+        xVertexBuffer = xDoc.createElement("vertexbuffer")
+        if hasPositions:
+            xVertexBuffer.setAttribute("positions", "true")
+        if hasNormals:
+            xVertexBuffer.setAttribute("normals", "true")
+        if hasTexCoords:
+            xVertexBuffer.setAttribute("texture_coord_dimensions_0", "2")
+            # str(texCoordSets)) # Only export one set
+            xVertexBuffer.setAttribute("texture_coords", "1")
+
+        if hasColours:
+            xVertexBuffer.setAttribute("colours_diffuse", "true")
+        if hasTangents:
+            xVertexBuffer.setAttribute("tangents", "true")
+            if isParity:
+                xVertexBuffer.setAttribute("tangent_dimensions", "4")
+        if hasBinormals:
+            xVertexBuffer.setAttribute("binormals", "true")
+
+        xGeometry.appendChild(xVertexBuffer)
+
+        for i, vx in enumerate(vertices):
+            xVertex = xDoc.createElement("vertex")
+            xVertexBuffer.appendChild(xVertex)
+            if hasPositions:
+                xPosition = xDoc.createElement("position")
+                xPosition.setAttribute("x", toFmtStr(vx[0]))
+                xPosition.setAttribute("y", toFmtStr(vx[2]))
+                xPosition.setAttribute("z", toFmtStr(-vx[1]))
+                xVertex.appendChild(xPosition)
+
+            if hasNormals:
+                xNormal = xDoc.createElement("normal")
+                xNormal.setAttribute("x", toFmtStr(normals[i][0]))
+                xNormal.setAttribute("y", toFmtStr(normals[i][2]))
+                xNormal.setAttribute("z", toFmtStr(-normals[i][1]))
+                xVertex.appendChild(xNormal)
+
+            if hasTexCoords:
+                xUVSet = xDoc.createElement("texcoord")
+                # take only 1st set for now
+                xUVSet.setAttribute("u", toFmtStr(uvSets[i][0][0]))
+                xUVSet.setAttribute("v", toFmtStr(1.0 - uvSets[i][0][1]))
+                xVertex.appendChild(xUVSet)
+
+            if hasColours:
+                xColour = xDoc.createElement("colour_diffuse")
+                xColour.setAttribute("value", '%g %g %g %g' % (
+                    colours[i][0], colours[i][1], colours[i][2], colours[i][3]))
+                xVertex.appendChild(xColour)
+
+            if hasTangents:
+                xTangent = xDoc.createElement("tangent")
+                xTangent.setAttribute("x", toFmtStr(tangents[i][0]))
+                xTangent.setAttribute("y", toFmtStr(tangents[i][2]))
+                xTangent.setAttribute("z", toFmtStr(-tangents[i][1]))
+                if isParity:
+                    xTangent.setAttribute("w", toFmtStr(tangents[i][3]))
+                xVertex.appendChild(xTangent)
+
+            if hasBinormals:
+                xBinormal = xDoc.createElement("binormal")
+                xBinormal.setAttribute("x", toFmtStr(binormals[i][0]))
+                xBinormal.setAttribute("y", toFmtStr(binormals[i][2]))
+                xBinormal.setAttribute("z", toFmtStr(-binormals[i][1]))
+                xVertex.appendChild(xBinormal)
+
+
+def xSaveSubMeshes(meshData, xDoc, xMesh, hasSharedGeometry, vertexLayout='interleaved'):
 
     xSubMeshes = xDoc.createElement("submeshes")
     xMesh.appendChild(xSubMeshes)
 
     for submesh in meshData['submeshes']:
 
-        numVerts = len(submesh['geometry']['positions'])
+        if hasSharedGeometry:
+            numVerts = len(meshData['sharedgeometry']['positions'])
+        else:
+            numVerts = len(submesh['geometry']['positions'])
 
         xSubMesh = xDoc.createElement("submesh")
         xSubMesh.setAttribute("material", submesh['material'])
@@ -636,46 +1104,82 @@ def xSaveSubMeshes(meshData, xDoc, xMesh, hasSharedGeometry):
         # if there is geometry per sub mesh
         if 'geometry' in submesh:
             geometry = submesh['geometry']
-            xSaveGeometry(geometry, xDoc, xSubMesh, hasSharedGeometry)
+            xSaveGeometry(geometry, xDoc, xSubMesh, hasSharedGeometry, vertexLayout)
         # boneassignments
-        if 'skeleton' in meshData:
-            skeleton = meshData['skeleton']
-            xBoneAssignments = xDoc.createElement("boneassignments")
-            for vxIdx, vxBoneAsg in enumerate(submesh['geometry']['boneassignments']):
-                for boneAndWeight in vxBoneAsg:
-                    boneName = boneAndWeight[0]
-                    boneWeight = boneAndWeight[1]
-                    xVxBoneassignment = xDoc.createElement(
-                        "vertexboneassignment")
-                    xVxBoneassignment.setAttribute("vertexindex", str(vxIdx))
-                    xVxBoneassignment.setAttribute(
-                        "boneindex", str(skeleton.bone_id(boneName)))
-                    xVxBoneassignment.setAttribute(
-                        "weight", '%6f' % boneWeight)
-                    xBoneAssignments.appendChild(xVxBoneassignment)
-            xSubMesh.appendChild(xBoneAssignments)
+        if 'skeleton' in meshData and 'geometry' in submesh:
+            xSaveBoneAssignments(meshData['skeleton'], submesh['geometry'], xDoc, xSubMesh)
+
+
+def xSaveBoneAssignments(skeleton, geometry, xDoc, xParent):
+    xBoneAssignments = xDoc.createElement("boneassignments")
+    for vxIdx, vxBoneAsg in enumerate(geometry['boneassignments']):
+        for boneAndWeight in vxBoneAsg:
+            boneName = boneAndWeight[0]
+            boneWeight = boneAndWeight[1]
+            xVxBoneassignment = xDoc.createElement(
+                "vertexboneassignment")
+            xVxBoneassignment.setAttribute("vertexindex", str(vxIdx))
+            xVxBoneassignment.setAttribute(
+                "boneindex", str(skeleton.bone_id(boneName)))
+            xVxBoneassignment.setAttribute(
+                "weight", '%6f' % boneWeight)
+            xBoneAssignments.appendChild(xVxBoneassignment)
+    xParent.appendChild(xBoneAssignments)
 
 
 def xSavePoses(meshData, xDoc, xMesh):
     xPoses = xDoc.createElement("poses")
     xMesh.appendChild(xPoses)
+    # poses of shared geometry target the mesh itself
+    if meshData.get('poses'):
+        for name, pose in meshData['poses'].items():
+            xSavePose(name, pose, xDoc, xPoses, 'mesh')
     for index, submesh in enumerate(meshData['submeshes']):
         if not submesh['poses']:
             continue
         for name in submesh['poses']:
-            xPose = xDoc.createElement("pose")
-            xPose.setAttribute('target', 'submesh')
-            xPose.setAttribute('index', str(index))
-            xPose.setAttribute('name', name)
-            xPoses.appendChild(xPose)
-            pose = submesh['poses'][name]
-            for v in pose:
-                xPoseVertex = xDoc.createElement('poseoffset')
-                xPoseVertex.setAttribute('index', str(v[0]))
-                xPoseVertex.setAttribute('x', '%6f' % v[1])
-                xPoseVertex.setAttribute('y', '%6f' % v[3])
-                xPoseVertex.setAttribute('z', '%6f' % -v[2])
-                xPose.appendChild(xPoseVertex)
+            xSavePose(name, submesh['poses'][name], xDoc, xPoses, 'submesh', index)
+
+
+def xSavePose(name, pose, xDoc, xPoses, target, index=None):
+    xPose = xDoc.createElement("pose")
+    xPose.setAttribute('target', target)
+    if index is not None:
+        xPose.setAttribute('index', str(index))
+    xPose.setAttribute('name', name)
+    xPoses.appendChild(xPose)
+    for v in pose:
+        xPoseVertex = xDoc.createElement('poseoffset')
+        xPoseVertex.setAttribute('index', str(v[0]))
+        xPoseVertex.setAttribute('x', '%6f' % v[1])
+        xPoseVertex.setAttribute('y', '%6f' % v[3])
+        xPoseVertex.setAttribute('z', '%6f' % -v[2])
+        xPose.appendChild(xPoseVertex)
+
+
+def xSaveLevelsOfDetail(meshData, xDoc, xMesh):
+    lod = meshData['levelsofdetail']
+    xLod = xDoc.createElement("levelofdetail")
+    xLod.setAttribute("strategy", lod['strategy'])
+    xLod.setAttribute("numlevels", str(len(lod['values']) + 1))
+    xLod.setAttribute("manual", "false")
+    xMesh.appendChild(xLod)
+    for level, value in enumerate(lod['values']):
+        xLodGenerated = xDoc.createElement("lodgenerated")
+        xLodGenerated.setAttribute("value", '%6f' % value)
+        xLod.appendChild(xLodGenerated)
+        for index, submesh in enumerate(meshData['submeshes']):
+            faces = submesh['lodfaces'][level]
+            xLodFaceList = xDoc.createElement("lodfacelist")
+            xLodFaceList.setAttribute("submeshindex", str(index))
+            xLodFaceList.setAttribute("numfaces", str(len(faces)))
+            xLodGenerated.appendChild(xLodFaceList)
+            for face in faces:
+                xFace = xDoc.createElement("face")
+                xFace.setAttribute("v1", str(face[0]))
+                xFace.setAttribute("v2", str(face[1]))
+                xFace.setAttribute("v3", str(face[2]))
+                xLodFaceList.appendChild(xFace)
 
 
 def xSaveSkeletonData(blenderMeshData, filepath):
@@ -701,7 +1205,16 @@ def xSaveSkeletonData(blenderMeshData, filepath):
         f.close()
 
 
-def xSaveMeshData(meshData, filepath, export_skeleton):
+def skeletonLinkName(meshData, filepath, export_skeleton):
+    # default skeleton
+    linkSkeletonName = meshData['skeleton'].name
+    if(export_skeleton):
+        nameDotMesh = os.path.split(filepath)[1].lower()
+        linkSkeletonName = os.path.splitext(nameDotMesh)[0]
+    return linkSkeletonName + ".skeleton"
+
+
+def xSaveMeshData(meshData, filepath, export_skeleton, vertexLayout='interleaved'):
     from xml.dom.minidom import Document
 
     hasSharedGeometry = False
@@ -717,9 +1230,9 @@ def xSaveMeshData(meshData, filepath, export_skeleton):
 
     if hasSharedGeometry:
         geometry = meshData['sharedgeometry']
-        xSaveGeometry(geometry, xDoc, xMesh, hasSharedGeometry)
+        xSaveGeometry(geometry, xDoc, xMesh, hasSharedGeometry, vertexLayout)
 
-    xSaveSubMeshes(meshData, xDoc, xMesh, hasSharedGeometry)
+    xSaveSubMeshes(meshData, xDoc, xMesh, hasSharedGeometry, vertexLayout)
 
     if 'has_poses' in meshData:
         xSavePoses(meshData, xDoc, xMesh)
@@ -727,16 +1240,16 @@ def xSaveMeshData(meshData, filepath, export_skeleton):
     # skeleton link only
     if 'skeleton' in meshData:
         xSkeletonlink = xDoc.createElement("skeletonlink")
-        # default skeleton
-        linkSkeletonName = meshData['skeleton'].name
-        if(export_skeleton):
-            nameDotMeshDotXml = os.path.split(filepath)[1].lower()
-            nameDotMesh = os.path.splitext(nameDotMeshDotXml)[0]
-            linkSkeletonName = os.path.splitext(nameDotMesh)[0]
         #xSkeletonlink.setAttribute("name", meshData['skeleton']['name']+".skeleton")
-        xSkeletonlink.setAttribute("name", linkSkeletonName+".skeleton")
+        xSkeletonlink.setAttribute("name", skeletonLinkName(meshData, filepath, export_skeleton))
         xMesh.appendChild(xSkeletonlink)
 
+        if hasSharedGeometry:
+            xSaveBoneAssignments(meshData['skeleton'], meshData['sharedgeometry'], xDoc, xMesh)
+
+    if 'levelsofdetail' in meshData:
+        xSaveLevelsOfDetail(meshData, xDoc, xMesh)
+
     # Print our newly created XML
     fileWr = open(filepath + ".xml", 'w')
     fileWr.write(xDoc.toprettyxml(indent="    "))  # 4 spaces
@@ -793,13 +1306,8 @@ def xSaveMaterialData(filepath, meshData, overwriteMaterialFlag, copyTextures):
         for matName, matInfo in allMatData.items():
             if 'texture' in matInfo:
                 if 'texture_path' in matInfo:
+                    # made absolute by bCollectMaterialData
                     srcTextureFile = matInfo['texture_path']
-                    baseDirName = os.path.dirname(bpy.data.filepath)
-                    if (srcTextureFile[0:2] == "//"):
-                        print("Converting relative image name \"%s\"" %
-                              srcTextureFile)
-                        srcTextureFile = os.path.join(
-                            baseDirName, srcTextureFile[2:])
                     if fileExist(srcTextureFile):
                         # copy texture to dir
                         print("Copying texture \"%s\"" % srcTextureFile)
@@ -831,6 +1339,14 @@ def luminosity(c):
     return c[0] * 0.25 + c[1] * 0.5 + c[2] * 0.25
 
 
+def slotMaterialName(ob, slot, default):
+    # the slot's material, whether it is linked to the object or the mesh
+    slots = ob.material_slots
+    if slot < len(slots) and slots[slot].material:
+        return slots[slot].material.name
+    return default
+
+
 def bCollectMeshData(operator, meshData, selectedObjects, export_params):
     import bmesh
     subMeshesData = []
@@ -847,21 +1363,36 @@ def bCollectMeshData(operator, meshData, selectedObjects, export_params):
             bpy.context.evaluated_depsgraph_get()) if export_params['apply_modifiers'] else ob
         mesh = tobj.to_mesh()
 
-        # use bmesh to triangulate
-        bm = bmesh.new()
-        bm.from_mesh(mesh)
-        bmesh.ops.triangulate(bm, faces=bm.faces)
-        bm.to_mesh(mesh)
-        bm.free()
+        # apply object rotation and scale to the temporary mesh only, so the
+        # scene (and any mesh data shared with other objects) is left untouched
+        transform = None
+        mirrored = False
+        if export_params["apply_transform"]:
+            transform = ob.matrix_world.to_3x3()
+            mesh.transform(transform.to_4x4())
+            # negative scale turns the winding inside out
+            mirrored = transform.determinant() < 0
 
         # Calculate normals and tangents
         if not mesh.uv_layers.active:
             export_params["export_tangents"] = export_params["export_binormals"] = False
         if export_params["export_tangents"]:
+            # tangents can only be calculated on tris and quads, so ngons
+            # still need a bmesh triangulation first
+            if max((p.loop_total for p in mesh.polygons), default=0) > 4:
+                bm = bmesh.new()
+                bm.from_mesh(mesh)
+                bmesh.ops.triangulate(bm, faces=[f for f in bm.faces if len(f.verts) > 4])
+                bm.to_mesh(mesh)
+                bm.free()
             mesh.calc_tangents(uvmap=mesh.uv_layers.active.name)
         else:
             mesh.calc_normals_split()
 
+        # triangles are read straight from the tessellation, loop indices
+        # still refer to the original loops (split normals, tangents, uvs)
+        mesh.calc_loop_triangles()
+
         # pick uv data
         uvData = mesh.uv_layers.active.data if mesh.uv_layers.active else None
 
@@ -884,18 +1415,14 @@ def bCollectMeshData(operator, meshData, selectedObjects, export_params):
 
         vertexList = []
         newFaces = []
+        faceMaterials = []
         map = {}
 
         import sys
-        progressScale = 1.0 / (len(mesh.polygons) - 1)
-        for fidx, face in enumerate(mesh.polygons):
-            tris = []
-            tris.append((face.vertices[0], face.vertices[1], face.vertices[2]))
-            if(len(face.vertices) >= 4):
-                tris.append(
-                    (face.vertices[0], face.vertices[2], face.vertices[3]))
+        progressScale = 1.0 / max(len(mesh.loop_triangles) - 1, 1)
+        for fidx, face in enumerate(mesh.loop_triangles):
             if SHOW_EXPORT_TRACE_VX:
-                print("_face: " + str(fidx) +
+                print("_face: " + str(fidx) + " polygon: " + str(face.polygon_index) +
                       " indices [" + str(list(face.vertices)) + "]")
 
             # Progress
@@ -904,18 +1431,16 @@ def bCollectMeshData(operator, meshData, selectedObjects, export_params):
                 50-percent*50) + "] " + str(int(percent*10000)/100.0) + "%   ")
             sys.stdout.flush()
 
-            # should be triangles
-            if len(face.vertices) != 3:
-                raise ValueError('Polygon not a triangle')
-
             # Add triangle
             newFaceVx = []
             for i in range(3):
                 vertex = face.vertices[i]
-                loop = face.loop_indices[i]
+                loop = face.loops[i]
 
                 px, py, pz = mesh.vertices[vertex].co
                 nx, ny, nz = mesh.loops[loop].normal
+                if mirrored:
+                    nx, ny, nz = -nx, -ny, -nz
                 u, v = uvData[loop].uv if uvData else (0, 0)
                 r, g, b, a = colourData[loop].color if colourData else (
                     1, 1, 1, 1)
@@ -926,7 +1451,7 @@ def bCollectMeshData(operator, meshData, selectedObjects, export_params):
                     a = alphaData[loop].color[0]
 
                 tangent = mesh.loops[loop].tangent[:] + \
-                    (mesh.loops[loop].bitangent_sign,
+                    (-mesh.loops[loop].bitangent_sign if mirrored else mesh.loops[loop].bitangent_sign,
                      ) if export_params["export_tangents"] else None
                 binormal = mesh.loops[loop].bitangent * - \
                     1 if export_params["export_binormals"] else None
@@ -1011,7 +1536,10 @@ def bCollectMeshData(operator, meshData, selectedObjects, export_params):
                     map[vert] = newVxIdx
                 newFaceVx.append(newVxIdx)
 
+            if mirrored:
+                newFaceVx[1], newFaceVx[2] = newFaceVx[2], newFaceVx[1]
             newFaces.append(newFaceVx)
+            faceMaterials.append(face.material_index)
 
         # geometry
         geometry = {}
@@ -1059,19 +1587,29 @@ def bCollectMeshData(operator, meshData, selectedObjects, export_params):
         poses = None
         if export_params["export_poses"] and mesh.shape_keys and mesh.shape_keys.key_blocks:
             poses = {}
+            # exported vertex -> original vertex
+            original = np.array([v.original for v in vertexList], dtype=np.int64)
+            matrix = np.array(transform) if transform is not None else None
+
+            # bulk read key block coordinates, each block only once
+            coordinates = {}
+            def keyBlockCoordinates(block):
+                if block.name not in coordinates:
+                    co = np.empty(len(block.data) * 3, dtype=np.float32)
+                    block.data.foreach_get('co', co)
+                    coordinates[block.name] = co.reshape(-1, 3).astype(np.float64)
+                return coordinates[block.name]
+
             for pose in mesh.shape_keys.key_blocks:
                 if pose.relative_key:
-                    poseData = []
-                    for index, v in enumerate(vertexList):
-                        base = pose.relative_key.data[v.original].co
-                        pos = pose.data[v.original].co
-                        x = pos[0] - base[0]
-                        y = pos[1] - base[1]
-                        z = pos[2] - base[2]
-                        if x != 0 or y != 0 or z != 0:
-                            poseData.append((index, x, y, z))
-                    if poseData:
-                        poses[pose.name] = poseData
+                    delta = keyBlockCoordinates(pose) - keyBlockCoordinates(pose.relative_key)
+                    delta = delta[original]
+                    if matrix is not None:
+                        delta = delta @ matrix.T
+                    moved = np.flatnonzero(np.any(np.abs(delta) > pose_epsilon, axis=1))
+                    if len(moved):
+                        poses[pose.name] = [(index, x, y, z) for index, (x, y, z)
+                                            in zip(moved.tolist(), delta[moved].tolist())]
 
         geometry['positions'] = positions
         geometry['normals'] = normals
@@ -1095,7 +1633,19 @@ def bCollectMeshData(operator, meshData, selectedObjects, export_params):
         subMeshData['faces'] = faces
         subMeshData['geometry'] = geometry
         subMeshData['poses'] = poses
-        subMeshesData.append(subMeshData)
+
+        # one submesh per material used by the object's polygons
+        slots = sorted(set(faceMaterials))
+        if len(slots) > 1:
+            for slot in slots:
+                slotFaces = [f for f, m in zip(faces, faceMaterials) if m == slot]
+                slotMeshData = OgreOptimize.extractSubmesh(subMeshData, slotFaces)
+                slotMeshData['material'] = slotMaterialName(ob, slot, materialName)
+                subMeshesData.append(slotMeshData)
+        else:
+            if slots:
+                subMeshData['material'] = slotMaterialName(ob, slots[0], materialName)
+            subMeshesData.append(subMeshData)
 
         if poses:
             meshData['has_poses'] = True
@@ -1108,14 +1658,241 @@ def bCollectMeshData(operator, meshData, selectedObjects, export_params):
     return meshData
 
 
-def bCollectSkeletonData(blenderMeshData, selectedObjects):
+def bGenerateLevelsOfDetail(operator, meshData, export_params):
+    levels = export_params["lod_levels"]
+    OgreOptimize.generateLevelsOfDetail(operator, meshData, levels, export_params["lod_reduction"])
+
+    # distances grow with each level, pixel counts shrink
+    step = export_params["lod_value_step"]
+    if export_params["lod_strategy"] == 'pixel_count':
+        step = 1.0 / step
+    values = [export_params["lod_value"] * step ** level for level in range(levels)]
+    meshData['levelsofdetail'] = {'strategy': export_params["lod_strategy"], 'values': values}
+
+
+def skeletonFingerprint(armature):
+    # rest pose and ogre ids, read from data.bones so no mode switch is needed
+    fingerprint = []
+    for bone in armature.data.bones:
+        fingerprint.append((bone.name,
+                            bone.parent.name if bone.parent else None,
+                            bone.get('OGREID'),
+                            tuple(v for row in bone.matrix_local for v in row)))
+    return tuple(fingerprint)
+
+
+def collectionBytes(collection, attr, typecode, size):
+    values = array(typecode, [0]) * (len(collection) * size)
+    collection.foreach_get(attr, values)
+    return values.tobytes()
+
+
+def meshFingerprint(hash, mesh):
+    # mesh is a temporary one from to_mesh, like bCollectMeshData reads
+    hash.update(collectionBytes(mesh.vertices, 'co', 'f', 3))
+    hash.update(collectionBytes(mesh.loops, 'vertex_index', 'i', 1))
+    hash.update(collectionBytes(mesh.edges, 'vertices', 'i', 2))
+    hash.update(collectionBytes(mesh.edges, 'use_edge_sharp', 'i', 1))
+    for attr in ('loop_start', 'loop_total', 'material_index', 'use_smooth'):
+        hash.update(collectionBytes(mesh.polygons, attr, 'i', 1))
+    # split normals cover smoothing and custom normals, safe on the temporary mesh
+    mesh.calc_normals_split()
+    hash.update(collectionBytes(mesh.loops, 'normal', 'f', 3))
+    for layer in mesh.uv_layers:
+        hash.update(repr((layer.name, layer.active)).encode())
+        hash.update(collectionBytes(layer.data, 'uv', 'f', 2))
+    for layer in mesh.vertex_colors:
+        hash.update(repr((layer.name, layer.active)).encode())
+        hash.update(collectionBytes(layer.data, 'color', 'f', 4))
+    for vertex in mesh.vertices:
+        hash.update(repr([(g.group, g.weight) for g in vertex.groups]).encode())
+    if mesh.shape_keys:
+        for block in mesh.shape_keys.key_blocks:
+            hash.update(repr((block.name, block.relative_key.name if block.relative_key else None,
+                              block.mute)).encode())
+            hash.update(collectionBytes(block.data, 'co', 'f', 3))
+
+
+def modifierFingerprint(modifier):
+    # objects a modifier reads from can change without their name changing
+    fingerprint = [rnaFingerprint(modifier)]
+    for prop in modifier.bl_rna.properties:
+        if prop.type != 'POINTER':
+            continue
+        target = getattr(modifier, prop.identifier, None)
+        if isinstance(target, bpy.types.Collection):
+            targets = sorted(target.all_objects, key=lambda o: o.name_full)
+        elif isinstance(target, bpy.types.Object):
+            targets = [target]
+        else:
+            continue
+        for other in targets:
+            fingerprint.append((other.name_full, flattenValue(other.matrix_world),
+                                rnaFingerprint(other.data) if other.data else None))
+    return repr(fingerprint)
+
+
+# export options that don't change the written files
+FINGERPRINT_IGNORED_OPTIONS = {'converter_jobs', 'incremental_export', 'cache_animations',
+                               'use_scratch_directory', 'scratch_directory'}
+
+
+def objectFingerprint(ob, export_params, meshHashes=None):
+    # everything that changes the files batch export writes for an object
+    hash = hashlib.sha1()
+    options = sorted((k, v) for k, v in export_params.items() if k not in FINGERPRINT_IGNORED_OPTIONS)
+    hash.update(repr((__version__, options)).encode())
+    if export_params["apply_transform"]:
+        hash.update(repr(flattenValue(ob.matrix_world.to_3x3())).encode())
+    # linked duplicates only hash their datablock once, unless modifiers make them differ
+    modified = export_params["apply_modifiers"] and len(ob.modifiers) > 0
+    cacheKey = ob.data.name_full if meshHashes is not None and not modified else None
+    meshHash = meshHashes.get(cacheKey) if cacheKey else None
+    if meshHash is None:
+        # the same temporary mesh bCollectMeshData exports, so curves and text work
+        # and the original data is left alone
+        tobj = ob.evaluated_get(
+            bpy.context.evaluated_depsgraph_get()) if export_params['apply_modifiers'] else ob
+        mesh = tobj.to_mesh()
+        try:
+            meshHash = hashlib.sha1()
+            meshFingerprint(meshHash, mesh)
+            meshHash = meshHash.digest()
+        finally:
+            tobj.to_mesh_clear()
+        if cacheKey:
+            meshHashes[cacheKey] = meshHash
+    hash.update(meshHash)
+    hash.update(repr([g.name for g in ob.vertex_groups]).encode())
+    if export_params["apply_modifiers"]:
+        for modifier in ob.modifiers:
+            hash.update(modifierFingerprint(modifier).encode())
+    for slot in ob.material_slots:
+        hash.update(rnaFingerprint(slot.material).encode() if slot.material else b'None')
+
+    armature = ob.find_armature()
+    if armature:
+        hash.update(repr((armature.name, skeletonFingerprint(armature))).encode())
+        if export_params["export_animation"] and armature.animation_data:
+            scene = bpy.context.scene
+            for track in armature.animation_data.nla_tracks:
+                for strip in track.strips:
+                    if strip.action:
+                        hash.update(bakeCacheKey(armature, strip.action,
+                                                 scene.render.fps, scene.frame_step))
+    return hash.hexdigest()
+
+
+def groupInstances(objects, export_params, meshHashes, uniqueSkeletons):
+    '''Groups objects that would export to identical files, either because
+    they link the same mesh datablock or because their geometry matches.
+    The first object of each group is the one that gets exported'''
+    groups = {}
+    for ob in objects:
+        key = objectFingerprint(ob, export_params, meshHashes)
+        # the mesh links a skeleton named after its own file
+        if uniqueSkeletons and ob.find_armature():
+            key = (key, ob.name)
+        groups.setdefault(key, []).append(ob)
+    return list(groups.values())
+
+
+def linkOrCopy(source, target):
+    if os.path.normcase(os.path.abspath(source)) == os.path.normcase(os.path.abspath(target)):
+        return
+    if os.path.isfile(target):
+        os.unlink(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def batchPath(directory, name, ext=".mesh"):
+    '''Where batch export writes the files of an object'''
+    return os.path.join(directory, name + ext)
+
+
+def exportInstances(operator, filepath, instances):
+    '''Produces the files of instanced objects, given by name, from the
+    exported mesh'''
+    directory = os.path.dirname(filepath)
+    base = os.path.splitext(filepath)[0]
+    for name in instances:
+        try:
+            for ext in (".mesh", ".material"):
+                if os.path.isfile(base + ext):
+                    linkOrCopy(base + ext, batchPath(directory, name, ext))
+        except OSError as e:
+            print("Could not copy", filepath, "for", name, e)
+            operator.report({'WARNING'}, "Could not write instance %s" % name)
+            return False
+    return True
+
+
+def saveInstanceMap(directory, mapping):
+    path = os.path.join(directory, "kenshi_instances.json")
+    try:
+        with open(path, 'w') as f:
+            json.dump(mapping, f, indent=1, sort_keys=True)
+    except OSError as e:
+        print("Could not write instance map", path, e)
+
+
+class ExportManifest(object):
+    '''Fingerprints of the objects batch export wrote to a directory, stored
+    in a manifest file next to the exported meshes'''
+
+    FILENAME = "kenshi_export.manifest"
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.FILENAME)
+        self.entries = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print("Ignoring invalid export manifest", self.path, e)
+
+    def unchanged(self, name, fingerprint, outputs):
+        return self.entries.get(name) == fingerprint and all(os.path.isfile(f) for f in outputs)
+
+    def put(self, name, fingerprint):
+        self.entries[name] = fingerprint
+
+    def drop(self, name):
+        self.entries.pop(name, None)
+
+    def save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+        except OSError as e:
+            print("Could not write export manifest", self.path, e)
+
+
+def bCollectSkeletonData(blenderMeshData, selectedObjects, skeletonCache=None):
     if SHOW_EXPORT_TRACE:
         print("bpy.data.armatures = %s" % bpy.data.armatures)
 
     # TODO, for now just take armature of first selected object
-    if selectedObjects[0].find_armature():
-        # creates and parses blender skeleton
-        skeleton = Skeleton(selectedObjects[0])
+    armature = selectedObjects[0].find_armature()
+    if armature:
+        if skeletonCache is None:
+            # creates and parses blender skeleton
+            skeleton = Skeleton(selectedObjects[0])
+        else:
+            # reuse the skeleton built earlier in this export session unless
+            # the armature has changed since
+            fingerprint = skeletonFingerprint(armature)
+            cached = skeletonCache.get(armature.name)
+            if cached and cached[0] == fingerprint:
+                print("Using cached skeleton", armature.name)
+                skeleton = cached[1]
+            else:
+                skeleton = Skeleton(selectedObjects[0])
+                skeletonCache[armature.name] = (fingerprint, skeleton)
         blenderMeshData['skeleton'] = skeleton
 
 
@@ -1125,8 +1902,8 @@ def bCollectMaterialData(blenderMeshData, selectedObjects):
     blenderMeshData['materials'] = allMaterials
 
     for ob in selectedObjects:
-        if ob.type == 'MESH' and len(ob.data.materials) > 0:
-            for mat in ob.data.materials:
+        if ob.type == 'MESH' and len(ob.material_slots) > 0:
+            for mat in [slot.material for slot in ob.material_slots]:
                 #mat = bpy.types.Material ##
                 if mat and mat.name not in allMaterials:
                     matInfo = {}
@@ -1147,12 +1924,17 @@ def bCollectMaterialData(blenderMeshData, selectedObjects):
                         for slot in mat.texture_slots:
                             if slot and slot.texture.type == 'IMAGE' and slot.texture.image:
                                 matInfo['texture'] = slot.texture.image.name
-                                matInfo['texture_path'] = slot.texture.image.filepath
+                                # relative to the .blend file, resolved here as writing happens off the main thread
+                                texturePath = slot.texture.image.filepath
+                                if texturePath[0:2] == "//":
+                                    print("Converting relative image name \"%s\"" % texturePath)
+                                    texturePath = os.path.join(os.path.dirname(bpy.data.filepath), texturePath[2:])
+                                matInfo['texture_path'] = texturePath
                                 break
 
 
 def XMLtoOGREConvert(blenderMeshData, filepath, ogreXMLconverter,
-                     export_skeleton, keep_xml):
+                     export_skeleton, keep_xml, keepVertexLayout=False, convertMesh=True, log=None):
 
     if ogreXMLconverter is None:
         return False
@@ -1160,38 +1942,91 @@ def XMLtoOGREConvert(blenderMeshData, filepath, ogreXMLconverter,
     # for mesh
     # use Ogre XML converter  xml -> binary mesh
     try:
-        xmlFilepath = filepath + ".xml"
-        subprocess.call([ogreXMLconverter, xmlFilepath])
-        # remove XML file if successfully converted
-        if keep_xml is False and os.path.isfile(xmlFilepath):
-            os.unlink("%s" % xmlFilepath)
-            if not os.path.isfile(filepath):#return false if the .mesh file wasn't generated
-                print("Could not find .mesh: ", filepath)
+        if convertMesh:
+            # -r stops the converter reorganising the vertex buffers
+            args = ["-r"] if keepVertexLayout else []
+            # remove XML file unless asked to keep it, fail if the .mesh file wasn't generated
+            if not OgreConverter.convertFile(ogreXMLconverter, args, filepath + ".xml", filepath, keep_xml, log):
                 return False
-        else:
-            return False
 
         if 'skeleton' in blenderMeshData and export_skeleton:
             # for skeleton
             skelFile = os.path.splitext(filepath)[0]  # removing .mesh
             skelFile = skelFile + ".skeleton"
-            xmlFilepath = skelFile + ".xml"
-            subprocess.call([ogreXMLconverter, xmlFilepath])
-            # remove XML file
-            if keep_xml is False and os.path.isfile(xmlFilepath):
-                os.unlink("%s" % xmlFilepath)
-                if not os.path.isfile(skelFile):#return false if the .skeleton file wasn't generated
-                    print("Could not find .skeleton: ", skelFile)
-                    return False
+            if not OgreConverter.convertFile(ogreXMLconverter, [], skelFile + ".xml", skelFile, keep_xml, log):
+                return False
 
         return True
 
-    except:
-        print("Error: Could not run", ogreXMLconverter)
+    except OSError as e:
+        print("Error: Could not run", ogreXMLconverter, e)
+        return False
+
+
+def placeOutputs(workpath, filepath, moveXml):
+    '''Moves the files written for workpath in the scratch directory next to filepath'''
+    if workpath == filepath:
+        return
+    workBase = os.path.splitext(workpath)[0]
+    base = os.path.splitext(filepath)[0]
+    extensions = [".mesh", ".skeleton"]
+    if moveXml:
+        extensions += [".mesh.xml", ".skeleton.xml"]
+    for ext in extensions:
+        if os.path.isfile(workBase + ext):
+            OgreConverter.moveIntoPlace(workBase + ext, base + ext)
+
+
+def writeAndConvert(operator, blenderMeshData, filepath, workpath, export_params, vertexFormats, log=None):
+    '''Writes the collected data, plain or compacted by
+    OgreMeshModel.fromExportData, and converts it. Nothing here touches bpy,
+    so it can run on the worker threads of a ConverterPool'''
+    if isinstance(blenderMeshData, OgreMeshModel.Mesh):
+        blenderMeshData = OgreMeshModel.toExportData(blenderMeshData)
+    export_skeleton = export_params["export_skeleton"]
+    binary_mesh = export_params["binary_mesh"]
+    vertex_layout = export_params["vertex_layout"]
+
+    if export_skeleton:
+        xSaveSkeletonData(blenderMeshData, workpath)
+
+    if binary_mesh:
+        linkName = skeletonLinkName(blenderMeshData, filepath, export_skeleton) if 'skeleton' in blenderMeshData else None
+        OgreBinary.writeMesh(operator, blenderMeshData, workpath, linkName, vertex_layout, vertexFormats)
+    else:
+        xSaveMeshData(blenderMeshData, workpath, export_skeleton, vertex_layout)
+
+    xSaveMaterialData(filepath, blenderMeshData,
+                      export_params["overwrite_material"], export_params["copy_textures"])
+
+    # a binary mesh only needs the skeleton converted
+    convert = not binary_mesh or (export_skeleton and 'skeleton' in blenderMeshData)
+    return convertAndPlace(blenderMeshData, workpath, filepath, export_params["xml_converter"], export_skeleton,
+                           export_params["keep_xml"], vertex_layout == 'split', not binary_mesh, convert, log)
+
+
+def objectRemoved(ob):
+    try:
+        ob.name
         return False
+    except ReferenceError:
+        return True
+
 
+def convertAndPlace(blenderMeshData, workpath, filepath, ogreXMLconverter, export_skeleton, keep_xml,
+                    keepVertexLayout, convertMesh, convert=True, log=None):
+    success = not convert or XMLtoOGREConvert(blenderMeshData, workpath, ogreXMLconverter, export_skeleton,
+                                              keep_xml, keepVertexLayout, convertMesh, log)
+    # XML that couldn't be converted is kept so it can be converted by hand
+    try:
+        placeOutputs(workpath, filepath, keep_xml or not success)
+    except OSError as e:
+        print("Could not move", workpath, "to", filepath, e)
+        return False
+    return success
 
-def save(operator, context, filepath,
+
+def exportSteps(operator, context, filepath,
          xml_converter=None,
          keep_xml=False,
          export_tangents=False,
@@ -1200,6 +2035,24 @@ def save(operator, context, filepath,
          tangent_parity=False,
          apply_transform=True,
          apply_modifiers=True,
+         shared_geometry=False,
+         vertex_layout='interleaved',
+         binary_mesh=False,
+         normal_format='float3',
+         uv_format='float2',
+         colour_format='float4',
+         split_large_submeshes=False,
+         limit_bone_palette=False,
+         bone_palette_size=64,
+         optimize_vertex_cache=False,
+         optimize_overdraw=False,
+         overdraw_threshold=1.05,
+         generate_lod=False,
+         lod_levels=3,
+         lod_reduction=0.5,
+         lod_strategy='distance_sphere',
+         lod_value=25.0,
+         lod_value_step=2.0,
          export_materials=False,
          overwrite_material=False,
          copy_textures=False,
@@ -1208,7 +2061,20 @@ def save(operator, context, filepath,
          export_animation=False,
          renormalize_weights=True,
          batch_export=False,
+         incremental_export=False,
+         instance_export='NONE',
+         converter_jobs=4,
+         use_scratch_directory=True,
+         scratch_directory="",
+         cache_animations=False,
+         isolate_animation_bake=True,
+         reduce_keyframes=False,
+         reduce_translation_tolerance=0.0001,
+         reduce_angle_tolerance=0.001,
+         background=False,
          ):
+    '''Export as a generator. Each step yields its progress and a job to wait
+    for, or None, so the export can be driven by a modal operator'''
 
     export_params = {
          "xml_converter" : xml_converter,
@@ -1219,6 +2085,24 @@ def save(operator, context, filepath,
          "tangent_parity" : tangent_parity,
          "apply_transform" : apply_transform,
          "apply_modifiers" : apply_modifiers,
+         "shared_geometry" : shared_geometry,
+         "vertex_layout" : vertex_layout,
+         "binary_mesh" : binary_mesh,
+         "normal_format" : normal_format,
+         "uv_format" : uv_format,
+         "colour_format" : colour_format,
+         "split_large_submeshes" : split_large_submeshes,
+         "limit_bone_palette" : limit_bone_palette,
+         "bone_palette_size" : bone_palette_size,
+         "optimize_vertex_cache" : optimize_vertex_cache,
+         "optimize_overdraw" : optimize_overdraw,
+         "overdraw_threshold" : overdraw_threshold,
+         "generate_lod" : generate_lod,
+         "lod_levels" : lod_levels,
+         "lod_reduction" : lod_reduction,
+         "lod_strategy" : lod_strategy,
+         "lod_value" : lod_value,
+         "lod_value_step" : lod_value_step,
          "export_materials" : export_materials,
          "overwrite_material" : overwrite_material,
          "copy_textures" : copy_textures,
@@ -1226,125 +2110,123 @@ def save(operator, context, filepath,
          "export_poses" : export_poses,
          "export_animation" : export_animation,
          "renormalize_weights": renormalize_weights,
-         "batch_export" : batch_export
+         "batch_export" : batch_export,
+         "incremental_export" : incremental_export,
+         "instance_export" : instance_export,
+         "converter_jobs" : converter_jobs,
+         "use_scratch_directory" : use_scratch_directory,
+         "scratch_directory" : scratch_directory,
+         "cache_animations" : cache_animations,
+         "isolate_animation_bake" : isolate_animation_bake,
+         "reduce_keyframes" : reduce_keyframes,
+         "reduce_translation_tolerance" : reduce_translation_tolerance,
+         "reduce_angle_tolerance" : reduce_angle_tolerance
     }
 
     global blender_version
 
     blender_version = bpy.app.version[0]*100 + bpy.app.version[1]
-    if(not batch_export):
-
-        # just check if there is extension - .mesh
-        if '.mesh' not in filepath.lower():
-            filepath = filepath + ".mesh"
-
-        print("saving...")
-        print(str(filepath))
-
-        # get mesh data from selected objects
-        selectedObjects = []
-        scn = bpy.context.view_layer
-        for ob in scn.objects:
-            if ob.select_get() and ob.type != 'ARMATURE':
-                selectedObjects.append(ob)
-
-        if len(selectedObjects) == 0:
-            print("No objects selected for export.")
-            operator.report({'WARNING'}, "No objects selected for export")
-            return {'CANCELLED'}
-
-        # go to the object mode
-        if context.active_object:
-            bpy.ops.object.mode_set(mode='OBJECT')
-
-        # apply transform
-        if apply_transform:
-            bpy.ops.object.transform_apply(rotation=True, scale=True)
-
-        # Save Mesh
-        blenderMeshData = {}
-
-        # skeleton
-        bCollectSkeletonData(blenderMeshData, selectedObjects)
-        # mesh
-        bCollectMeshData(operator, blenderMeshData, selectedObjects, export_params)
-        # materials
-        if export_materials:
-            bCollectMaterialData(blenderMeshData, selectedObjects)
-
-        if export_animation:
-            bCollectAnimationData(blenderMeshData)
-
-        if SHOW_EXPORT_TRACE:
-            print(blenderMeshData['materials'])
 
-        if SHOW_EXPORT_DUMPS:
-            dumpFile = filepath + ".EDump"
-            fileWr = open(dumpFile, 'w')
-            fileWr.write(str(blenderMeshData))
-            fileWr.close()
+    # vertex element types of the binary writer
+    vertexFormats = {'normal': normal_format, 'uv': uv_format, 'colour': colour_format}
+    if binary_mesh:
+        for warning in OgreBinary.versionWarnings(vertexFormats):
+            print("Warning:", warning)
+            operator.report({'WARNING'}, warning)
 
-        if export_skeleton:
-            xSaveSkeletonData(blenderMeshData, filepath)
+    # skeletons are only analysed once per armature during this export
+    skeletonCache = {}
 
-        xSaveMeshData(blenderMeshData, filepath, export_skeleton)
+    # baked animations are reused across exports
+    bakeCache = AnimationBakeCache(os.path.dirname(filepath)) if cache_animations else None
 
-        xSaveMaterialData(filepath, blenderMeshData,
-                          overwrite_material, copy_textures)
+    # exit codes and stderr of every converter run
+    conversionLog = OgreConverter.ConversionLog()
 
-        if not XMLtoOGREConvert(blenderMeshData, filepath, xml_converter, export_skeleton, keep_xml):
-            operator.report(
-                {'WARNING'}, "Failed to convert .xml files to .mesh")
-    else:
-
-        # just check if there is extension - .mesh
-        # if '.mesh' not in filepath.lower():
-        #filepath = filepath + ".mesh"
-        directory = os.path.dirname(filepath)
-
-        # get mesh data from selected objects
-        selectedObjects = []
-        scn = bpy.context.view_layer
-        for ob in scn.objects:
-            if ob.select_get() and ob.type != 'ARMATURE':
-                selectedObjects.append(ob)
-
-        if len(selectedObjects) == 0:
-            print("No objects selected for export.")
-            operator.report({'WARNING'}, "No objects selected for export")
-            return {'CANCELLED'}
-
-        # go to the object mode
-        if context.active_object:
-            bpy.ops.object.mode_set(mode='OBJECT')
+    # intermediate files are written and converted here, then moved into place
+    scratch = OgreConverter.ScratchSpace(scratch_directory) if use_scratch_directory else None
 
-        for obj in selectedObjects:
+    # files are written and converted on worker threads, reports come back to the operator here
+    pool = OgreConverter.ConverterPool(converter_jobs if batch_export else 1, background)
+    reports = OgreConverter.DeferredReports()
 
-            selectedObj = []
-            selectedObj.append(obj)
+    try:
+        if(not batch_export):
 
-            filepath = directory + "\\" + obj.name + ".mesh"
+            # just check if there is extension - .mesh
+            if '.mesh' not in filepath.lower():
+                filepath = filepath + ".mesh"
 
             print("saving...")
             print(str(filepath))
 
-            # apply transform
-            if apply_transform:
-                bpy.ops.object.transform_apply(rotation=True, scale=True)
+            # get mesh data from selected objects
+            selectedObjects = []
+            scn = bpy.context.view_layer
+            for ob in scn.objects:
+                if ob.select_get() and ob.type != 'ARMATURE':
+                    selectedObjects.append(ob)
+
+            if len(selectedObjects) == 0:
+                print("No objects selected for export.")
+                operator.report({'WARNING'}, "No objects selected for export")
+                return {'CANCELLED'}
+
+            # go to the object mode
+            if context.active_object:
+                bpy.ops.object.mode_set(mode='OBJECT')
 
             # Save Mesh
             blenderMeshData = {}
 
+            def removed():
+                # the scene can change between steps of a background export
+                objects = list(selectedObjects)
+                if 'skeleton' in blenderMeshData:
+                    objects.append(blenderMeshData['skeleton'].armature)
+                if any(objectRemoved(ob) for ob in objects):
+                    operator.report({'WARNING'}, "Objects were removed during export, nothing was written")
+                    return True
+                return False
+
             # skeleton
-            bCollectSkeletonData(blenderMeshData, selectedObj)
+            bCollectSkeletonData(blenderMeshData, selectedObjects, skeletonCache)
+            yield 0.05, None
+            if removed():
+                return {'CANCELLED'}
             # mesh
-            bCollectMeshData(blenderMeshData, selectedObj, export_params)
+            bCollectMeshData(operator, blenderMeshData, selectedObjects, export_params)
+            yield 0.2, None
+            if removed():
+                return {'CANCELLED'}
             # materials
             if export_materials:
-                bCollectMaterialData(blenderMeshData, selectedObj)
+                bCollectMaterialData(blenderMeshData, selectedObjects)
+                yield 0.25, None
+                if removed():
+                    return {'CANCELLED'}
 
             if export_animation:
-                bCollectAnimationData(blenderMeshData)
+                for progress in bCollectAnimationSteps(blenderMeshData, export_params, bakeCache):
+                    yield 0.25 + 0.15 * progress, None
+                if removed():
+                    return {'CANCELLED'}
+
+            # everything read from the scene is collected by now, the objects
+            # may be changed or removed between the steps below
+            yield 0.4, None
+            if shared_geometry:
+                OgreOptimize.shareGeometry(operator, blenderMeshData)
+            if split_large_submeshes:
+                OgreOptimize.splitLargeSubmeshes(operator, blenderMeshData)
+            if limit_bone_palette:
+                OgreOptimize.limitBonePalettes(operator, blenderMeshData, bone_palette_size)
+            if generate_lod:
+                bGenerateLevelsOfDetail(operator, blenderMeshData, export_params)
+            if optimize_vertex_cache:
+                OgreOptimize.optimizeMeshData(operator, blenderMeshData,
+                                              overdraw_threshold if optimize_overdraw else None)
+            yield 0.7, None
 
             if SHOW_EXPORT_TRACE:
                 print(blenderMeshData['materials'])
@@ -1355,18 +2237,191 @@ def save(operator, context, filepath,
                 fileWr.write(str(blenderMeshData))
                 fileWr.close()
 
-            if export_skeleton:
-                xSaveSkeletonData(blenderMeshData, filepath)
-
-            xSaveMeshData(blenderMeshData, filepath, export_skeleton)
+            workpath = scratch.path(filepath) if scratch else filepath
+            # nothing is queued behind a single file, so it isn't compacted
+            job = pool.submit(writeAndConvert, reports, blenderMeshData, filepath, workpath,
+                              export_params, vertexFormats, conversionLog)
+            yield 0.8, job
 
-            xSaveMaterialData(filepath, blenderMeshData,
-                              overwrite_material, copy_textures)
-
-            if not XMLtoOGREConvert(blenderMeshData, filepath, xml_converter, export_skeleton, keep_xml):
+            reports.flush(operator)
+            if not job.result():
                 operator.report(
                     {'WARNING'}, "Failed to convert .xml files to .mesh")
+        else:
+
+            # just check if there is extension - .mesh
+            # if '.mesh' not in filepath.lower():
+            #filepath = filepath + ".mesh"
+            directory = os.path.dirname(filepath)
+
+            # get mesh data from selected objects
+            selectedObjects = []
+            scn = bpy.context.view_layer
+            for ob in scn.objects:
+                if ob.select_get() and ob.type != 'ARMATURE':
+                    selectedObjects.append(ob)
+
+            if len(selectedObjects) == 0:
+                print("No objects selected for export.")
+                operator.report({'WARNING'}, "No objects selected for export")
+                return {'CANCELLED'}
+
+            # go to the object mode
+            if context.active_object:
+                bpy.ops.object.mode_set(mode='OBJECT')
+
+            # objects that haven't changed since the last batch export are skipped
+            manifest = ExportManifest(directory) if incremental_export else None
+            skipped = []
+            rebuilt = []
+
+            # objects with identical output are exported once
+            meshHashes = {}
+            if instance_export != 'NONE':
+                groups = groupInstances(selectedObjects, export_params, meshHashes,
+                                        export_skeleton and instance_export == 'COPY')
+            else:
+                groups = [[ob] for ob in selectedObjects]
+            instanceMap = {}
+
+            # files are written and converted in the background while the next objects are collected
+            pending = []
+            removedObjects = 0
+
+            for index, group in enumerate(groups):
+
+                # the scene can change between steps of a background export
+                if any(objectRemoved(ob) for ob in group):
+                    print("Objects were removed during export, skipping a group of", len(group))
+                    removedObjects += len(group)
+                    continue
+
+                obj = group[0]
+                selectedObj = []
+                selectedObj.append(obj)
+
+                filepath = batchPath(directory, obj.name)
+                for ob in group:
+                    instanceMap[ob.name] = obj.name + ".mesh"
+                if len(group) > 1:
+                    print("Instances of", obj.name, ":", [ob.name for ob in group[1:]])
+
+                if manifest:
+                    fingerprints = [objectFingerprint(ob, export_params, meshHashes) for ob in group]
+                    outputs = [filepath]
+                    if export_skeleton and obj.find_armature():
+                        outputs.append(batchPath(directory, obj.name, ".skeleton"))
+                    if instance_export == 'COPY':
+                        outputs += [batchPath(directory, ob.name) for ob in group[1:]]
+                    if all(manifest.unchanged(ob.name, fingerprint, outputs)
+                           for ob, fingerprint in zip(group, fingerprints)):
+                        print("Unchanged, skipping", obj.name)
+                        skipped += [ob.name for ob in group]
+                        continue
+                    for ob in group:
+                        manifest.drop(ob.name)
+
+                print("saving...")
+                print(str(filepath))
+
+                # Save Mesh
+                blenderMeshData = {}
+
+                # skeleton
+                bCollectSkeletonData(blenderMeshData, selectedObj, skeletonCache)
+                # mesh
+                bCollectMeshData(operator, blenderMeshData, selectedObj, export_params)
+                if shared_geometry:
+                    OgreOptimize.shareGeometry(operator, blenderMeshData)
+                if split_large_submeshes:
+                    OgreOptimize.splitLargeSubmeshes(operator, blenderMeshData)
+                if limit_bone_palette:
+                    OgreOptimize.limitBonePalettes(operator, blenderMeshData, bone_palette_size)
+                if generate_lod:
+                    bGenerateLevelsOfDetail(operator, blenderMeshData, export_params)
+                if optimize_vertex_cache:
+                    OgreOptimize.optimizeMeshData(operator, blenderMeshData,
+                                                  overdraw_threshold if optimize_overdraw else None)
+                # materials
+                if export_materials:
+                    bCollectMaterialData(blenderMeshData, selectedObj)
+
+                if export_animation:
+                    bCollectAnimationData(blenderMeshData, export_params, bakeCache)
+
+                if SHOW_EXPORT_TRACE:
+                    print(blenderMeshData['materials'])
+
+                if SHOW_EXPORT_DUMPS:
+                    dumpFile = filepath + ".EDump"
+                    fileWr = open(dumpFile, 'w')
+                    fileWr.write(str(blenderMeshData))
+                    fileWr.close()
+
+                # queued data is kept compact until a writer thread gets to it
+                mesh = OgreMeshModel.fromExportData(blenderMeshData)
+                if SHOW_EXPORT_TRACE:
+                    print("Compacted mesh data: %d bytes" % mesh.nbytes())
+                del blenderMeshData
+
+                workpath = scratch.path(filepath) if scratch else filepath
+                conversion = pool.submit(writeAndConvert, reports, mesh, filepath, workpath,
+                                         export_params, vertexFormats, conversionLog)
+                # names only, the objects may be gone by the time the job is done
+                pending.append(([ob.name for ob in group], filepath, conversion, fingerprints if manifest else None))
+                rebuilt += [ob.name for ob in group]
+
+                # don't let collected data pile up faster than it is written
+                running = [p[2] for p in pending if not p[2].done()]
+                yield 0.8 * (index + 1) / len(groups), running[0] if len(running) > 2 * converter_jobs else None
+
+            for index, (names, filepath, conversion, fingerprints) in enumerate(pending):
+                yield 0.8 + 0.2 * index / len(pending), conversion
+                if not conversion.result():
+                    operator.report(
+                        {'WARNING'}, "Failed to convert .xml files to .mesh for %s" % names[0])
+                elif instance_export != 'COPY' or exportInstances(operator, filepath, names[1:]):
+                    if manifest:
+                        for name, fingerprint in zip(names, fingerprints):
+                            manifest.put(name, fingerprint)
+            reports.flush(operator)
+
+            if removedObjects:
+                operator.report({'WARNING'}, "Batch export: %d objects were removed during export and skipped" %
+                                removedObjects)
+            if instance_export == 'MAP':
+                saveInstanceMap(directory, instanceMap)
+            if instance_export != 'NONE':
+                operator.report({'INFO'}, "Batch export: %d objects share %d meshes" %
+                                (len(selectedObjects), len(groups)))
+            if manifest:
+                manifest.save()
+                operator.report({'INFO'}, "Batch export: %d rebuilt, %d unchanged and skipped" %
+                                (len(rebuilt), len(skipped)))
+
+        conversionLog.report(operator)
+
+        if bakeCache is not None:
+            bakeCache.save()
+
+    finally:
+        # also runs when a background export is cancelled, queued jobs are dropped
+        pool.shutdown(cancel=True)
+        if scratch:
+            scratch.cleanup()
 
     print("done.")
 
     return {'FINISHED'}
+
+
+def save(operator, context, filepath, **keywords):
+    '''Runs the whole export, waiting on the background jobs as it goes'''
+    steps = exportSteps(operator, context, filepath, **keywords)
+    while True:
+        try:
+            progress, job = next(steps)
+        except StopIteration as done:
+            return done.value
+        if job is not None:
+            futures.wait([job])
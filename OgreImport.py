@@ -136,13 +136,18 @@ Note: Bones store their OGREID as a custom variable so they are consistent when
 
 """
 
-import subprocess
 import os
 import math
+import threading
+from concurrent.futures import Future
 from mathutils import Vector, Matrix
 import bpy
 import bmesh
+import numpy as np
 from xml.dom import minidom
+from . import OgreConverter
+from . import OgreMeshModel
+from . import OgreWorker
 
 #from Blender import *
 
@@ -328,6 +333,18 @@ def xCollectMeshData(meshData, xmldoc, meshname, dirname, useNormals):
     return meshData
 
 
+def xCollectMeshArrays(meshData, info, arrays, useShapekeys):
+    '''Same as xCollectMeshData and xCollectPoseData, from the arrays parsed
+    by OgreWorker'''
+    mesh = OgreMeshModel.fromArrays(info, arrays, meshData.get('boneIDs'), useShapekeys)
+    for submesh in mesh.submeshes:
+        # to avoid Blender naming limit problems
+        submesh.materialOrg = str(submesh.material)
+        submesh.material = GetValidBlenderName(submesh.materialOrg)
+
+    return OgreMeshModel.toImportData(mesh, meshData)
+
+
 def xCollectMaterialData(meshData, materialFiles, folder):
 
     data = None
@@ -433,11 +450,18 @@ def xCollectPoseData(meshData, xmldoc):
 
 
 def xGetSkeletonLink(xmldoc, folder, operator):
-    skeletonFile = "None"
+    skeletonName = None
     if(len(xmldoc.getElementsByTagName("skeletonlink")) > 0):
         # get the skeleton link of the mesh
         skeletonLink = xmldoc.getElementsByTagName("skeletonlink")[0]
         skeletonName = skeletonLink.getAttribute("name")
+
+    return skeletonLinkFile(skeletonName, folder, operator)
+
+
+def skeletonLinkFile(skeletonName, folder, operator):
+    skeletonFile = "None"
+    if skeletonName:
         skeletonFile = os.path.join(folder, skeletonName)
         # check for existence of skeleton file
         if not os.path.isfile(skeletonFile):
@@ -500,8 +524,7 @@ def xCollectBoneData(meshData, xDoc):
     # update Ogre bones with head positions
     calcBoneHeadPositions(OGRE_Bones)
 
-    # update Ogre bones with rotation matrices
-    calcBoneRotations(OGRE_Bones)
+    # rotation matrices need bpy, they are calculated by buildScene
 
     return OGRE_Bones
 
@@ -724,7 +747,7 @@ def xAnalyseFPS(xDoc):
     return round(fps, 2)
 
 
-def xCollectAnimations(meshData, xDoc, integerFrames=True):
+def xCollectAnimations(meshData, xDoc, integerFrames=True, fps=None):
     if not 'animations' in meshData:
         meshData['animations'] = {}
     for container in xDoc.getElementsByTagName('animations'):
@@ -735,12 +758,13 @@ def xCollectAnimations(meshData, xDoc, integerFrames=True):
                 # read action data
                 action = {}
                 tracks = xGetChild(animation, 'tracks')
-                xReadAnimation(action, tracks.childNodes, integerFrames)
+                xReadAnimation(action, tracks.childNodes, integerFrames, fps)
                 meshData['animations'][name] = action
 
 
-def xReadAnimation(action, tracks, integerFrames=True):
-    fps = bpy.context.scene.render.fps
+def xReadAnimation(action, tracks, integerFrames=True, fps=None):
+    if fps is None:
+        fps = bpy.context.scene.render.fps
     for track in tracks:
         if track.nodeType != 1:
             continue
@@ -1119,21 +1143,16 @@ def bCreateSubMeshes(meshData, meshName, import_params):
         me.vertices.add(VertLength)
         me.loops.add(FaceLength * 3)
         me.polygons.add(FaceLength)
-        for i in range(VertLength):
-            me.vertices[i].co = verts[i]
-            #if hasNormals:#Blender assigns normals based on windings
-                #me.vertices[i].normal = Vector(
-                    #(normals[i][0], normals[i][1], normals[i][2]))
-
-        #me.vertices[VertLength].co = verts[0]
-        for i in range(FaceLength):
-            me.loops[i*3].vertex_index = faces[i][0]
-            me.loops[i*3+1].vertex_index = faces[i][1]
-            me.loops[i*3+2].vertex_index = faces[i][2]
-            me.polygons[i].loop_start = i*3
-            #me.polygons[i].loop_total = 3
-            if import_params['normal_mode'] != 'flat':
-                me.polygons[i].use_smooth = True
+        # whole arrays at once, element by element access is slow for large meshes
+        me.vertices.foreach_set("co", np.asarray(verts, dtype=np.float32).ravel())
+        #if hasNormals:#Blender assigns normals based on windings
+
+        loopVertices = np.asarray(faces, dtype=np.int32).ravel()
+        me.loops.foreach_set("vertex_index", loopVertices)
+        me.polygons.foreach_set("loop_start", np.arange(0, FaceLength * 3, 3, dtype=np.int32))
+        #me.polygons[i].loop_total = 3
+        if import_params['normal_mode'] != 'flat':
+            me.polygons.foreach_set("use_smooth", np.ones(FaceLength, dtype=bool))
 
         #meshFaces = me.tessfaces
         #meshUV_textures = me.tessface_uv_textures
@@ -1199,40 +1218,22 @@ def bCreateSubMeshes(meshData, meshName, import_params):
 
         # texture coordinates
         if 'texcoordsets' in geometry and 'uvsets' in geometry:
-            uvsets = geometry['uvsets']
+            uvsets = np.asarray(geometry['uvsets'], dtype=np.float32)
             for j in range(geometry['texcoordsets']):
                 uvData = me.uv_layers.new(name='UVLayer'+str(j)).data
-                loopIndex = 0
-                for face in faces:
-                    for v in face:
-                        uvData[loopIndex].uv = uvsets[v][j]
-                        loopIndex += 1
+                uvData.foreach_set("uv", uvsets[loopVertices, j].ravel())
 
         # vertex colors
         if 'vertexcolors' in geometry:
             colourData = me.vertex_colors.new(name='Colour'+str(j)).data
-            vcolors = geometry['vertexcolors']
-            loopIndex = 0
-            for face in faces:
-                for v in face:
-                    colourData[loopIndex].color = vcolors[v]
-                    loopIndex += 1
+            vcolors = np.asarray(geometry['vertexcolors'], dtype=np.float32)
+            loopColors = vcolors[loopVertices]
+            colourData.foreach_set("color", loopColors.ravel())
 
             # Vertex Alpha
-            for c in vcolors:
-                if c[3] != 1.0:
-                    alphaData = me.vertex_colors.new(name='Alpha'+str(j)).data
-                    loopIndex = 0
-                    for face in faces:
-                        for v in face:
-                            colourData[loopIndex].color[3] = vcolors[v][3]
-
-                            alphaData[loopIndex].color[0] = vcolors[v][3]
-                            alphaData[loopIndex].color[1] = vcolors[v][3]
-                            alphaData[loopIndex].color[2] = vcolors[v][3]
-                            alphaData[loopIndex].color[3] = vcolors[v][3]
-                            loopIndex += 1
-                    break
+            if (vcolors[:, 3] != 1.0).any():
+                alphaData = me.vertex_colors.new(name='Alpha'+str(j)).data
+                alphaData.foreach_set("color", np.repeat(loopColors[:, 3], 4))
 
         # bone assignments:
         if 'boneIDs' in meshData:
@@ -1265,13 +1266,17 @@ def bCreateSubMeshes(meshData, meshName, import_params):
                     if base == None:
                         # must have base shape
                         base = ob.shape_key_add(name='Basis')
+                        baseCoords = np.empty(len(base.data) * 3, dtype=np.float32)
+                        base.data.foreach_get("co", baseCoords)
+                        baseCoords = baseCoords.reshape(-1, 3)
                     name = pose['name']
                     print('creating pose', name)
                     shape = ob.shape_key_add(name=name)
-                    for vkey in pose['data']:
-                        b = base.data[vkey[0]].co
-                        me.shape_keys.key_blocks[name].data[vkey[0]].co = [
-                            vkey[1] + b[0], vkey[2] + b[1], vkey[3] + b[2]]
+                    # rows of (vertex, x, y, z) offsets from the base shape
+                    data = np.asarray(pose['data'], dtype=np.float64).reshape(-1, 4)
+                    coords = baseCoords.copy()
+                    coords[data[:, 0].astype(np.int64)] += data[:, 1:]
+                    shape.data.foreach_set("co", coords.ravel())
 
         # Update mesh with new data
         me.update(calc_edges=True)
@@ -1331,13 +1336,17 @@ def bCreateSubMeshes(meshData, meshName, import_params):
                 noChange = len(me.loops) == len(faces)*3
                 if not noChange:
                     print('Removed',  len(faces) - len(me.loops)/3, 'faces')
-                split = []
-                polyIndex = 0
-                for face in faces:
-                    if noChange or matchFace(face, verts, me, polyIndex):
-                        polyIndex += 1
-                        for vx in face:
-                            split.append(normals[vx])
+                if noChange:
+                    split = np.asarray(normals, dtype=np.float32)[loopVertices]
+                    polyIndex = len(faces)
+                else:
+                    split = []
+                    polyIndex = 0
+                    for face in faces:
+                        if matchFace(face, verts, me, polyIndex):
+                            polyIndex += 1
+                            for vx in face:
+                                split.append(normals[vx])
 
                 if len(split) == len(me.loops):
                     me.normals_split_custom_set(split)
@@ -1376,22 +1385,53 @@ def matchFace(face, vertices, mesh, index):
     return True
 
 
-def convertXML(convertor, filename, use_existing=True):
+def convertXML(convertor, filename, use_existing=True, scratch=None):
+    # returns the path of the xml file, or None if it could not be converted
     print('create xml', filename)
     if filename.endswith('.xml'):
-        return True
+        return filename
     elif use_existing and os.path.isfile(filename + '.xml'):
-        return True
+        return filename + '.xml'
     elif convertor is None:
-        return False
+        return None
     else:
+        xmlFile = scratch.path(filename + '.xml') if scratch else None
         print("Execute: ", convertor, filename)
-        try:
-            subprocess.call([convertor, filename])
-            return os.path.isfile(filename + '.xml')
-        except:
-            print("Error: Could not run", convertor)
-            return False
+        result = OgreConverter.runConverter(convertor, [], filename, destination=xmlFile)
+        print("Converted in %.2fs, exit code %s" % (result.seconds, result.returncode))
+        if result.stderr:
+            print(result.stderr.rstrip())
+        xmlFile = xmlFile or filename + '.xml'
+        return xmlFile if os.path.isfile(xmlFile) else None
+
+
+class SharedConversions(object):
+    '''Converts each file once for all the parseFile jobs of an import, so
+    meshes linking the same skeleton don't write and delete one .xml at the
+    same time. The files are removed once the whole import is done'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def convert(self, convertor, filename):
+        key = os.path.normcase(os.path.abspath(filename))
+        with self.lock:
+            future = self.files.get(key)
+            converting = future is None
+            if converting:
+                future = self.files[key] = Future()
+        if converting:
+            try:
+                future.set_result(convertXML(convertor, filename))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def removeFiles(self):
+        for future in self.files.values():
+            if future.done() and future.exception() is None and future.result():
+                OgreConverter.removeFile(future.result())
 
 
 def getBoneNameMapFromArmature(arm):
@@ -1407,48 +1447,44 @@ def getBoneNameMapFromArmature(arm):
     return boneMap
 
 
-def load(operator,
-         context,
-         filepath,
-         xml_converter=None,
-         keep_xml=True,
-         import_normals=True,
-         normal_mode="custom",
-         import_shapekeys=True,
-         import_animations=False,
-         round_frames=False,
-         use_selected_skeleton=False,
-         import_materials=True):
-    
-    import_params = {
-        "xml_converter" : xml_converter,
-        "keep_xml" : keep_xml,
-        "import_normals" : import_normals,
-        "normal_mode" : normal_mode,
-        "import_shapekeys" : import_shapekeys,
-        "import_animations" : import_animations,
-        "round_frames" : round_frames,
-        "use_selected_skeleton" : use_selected_skeleton,
-        "import_materials" : import_materials
-    }
-
-    global blender_version
-
-    blender_version = bpy.app.version[0]*100 + bpy.app.version[1]
-
-    print("loading", str(filepath))
+def selectedSkeleton(operator, context, use_selected_skeleton):
+    '''The active armature and its Ogre bone ids when importing onto the
+    selected skeleton, (None, None) otherwise'''
+    armature = context.active_object if use_selected_skeleton and context.active_object and context.active_object.type == 'ARMATURE' else None
+    if not armature:
+        return None, None
+    map = getBoneNameMapFromArmature(armature)
+    if not map:
+        operator.report(
+            {'WARNING'}, "Selected armature has no OGRE data.")
+    return armature, map
+
+
+def parseFile(operator, filepath, import_params, boneIDs=None, fps=None, processes=None,
+              skeletons=None):
+    '''Converts and parses a mesh and its linked skeleton. Nothing here touches
+    bpy, so it can run on a worker thread. Mesh geometry is parsed by
+    processes when given, skeletons converted through the SharedConversions
+    of the import when given. Returns what buildScene needs, or None if the
+    mesh could not be read'''
+    xml_converter = import_params['xml_converter']
+    use_scratch_directory = import_params['use_scratch_directory']
+
+    # converted .xml files are written here and only kept if asked for
+    scratch = OgreConverter.ScratchSpace(import_params['scratch_directory']) if use_scratch_directory else None
 
     filepath = filepath
     pathMeshXml = filepath
     # get the mesh as .xml file
     if filepath.lower().endswith(".mesh"):
-        if convertXML(xml_converter, filepath):
-            pathMeshXml = filepath + ".xml"
-        else:
+        pathMeshXml = convertXML(xml_converter, filepath, scratch=scratch)
+        if not pathMeshXml:
             operator.report({'ERROR'}, "Failed to convert .mesh files to .xml")
-            return {'CANCELLED'}
+            if scratch:
+                scratch.cleanup()
+            return None
     else:
-        return {'CANCELLED'}
+        return None
 
     folder = os.path.split(filepath)[0]
     nameDotMeshDotXml = os.path.split(pathMeshXml)[1]
@@ -1470,29 +1506,56 @@ def load(operator,
     else:
         meshMaterials.append(pathMaterial)
 
+    parsed = {
+        'filepath': filepath,
+        'scratch': scratch,
+        'folder': folder,
+        'onlyName': onlyName,
+        'pathMeshXml': pathMeshXml,
+        'pathMaterial': pathMaterial,
+        'skeletonFile': "None",
+        'skeletonFileXml': None,
+        # converted for several meshes, removed by importSteps
+        'sharedSkeleton': False,
+        'fps': None,
+        'meshData': None,
+    }
+
     # try to parse xml file
-    xDocMeshData = xOpenFile(pathMeshXml)
+    meshArrays = None
+    xDocMeshData = "None"
+    if processes:
+        # the skeleton needs mathutils, only the geometry is parsed in another process
+        try:
+            meshArrays = processes.parse(pathMeshXml, import_params['import_normals'])
+        except Exception as e:
+            print("File not valid!", e)
+    else:
+        xDocMeshData = xOpenFile(pathMeshXml)
 
     meshData = {}
-    if xDocMeshData != "None":
+    if meshArrays or xDocMeshData != "None":
         # skeleton data
         # get the mesh as .xml file
-        skeletonFile = xGetSkeletonLink(xDocMeshData, folder, operator)
+        if meshArrays:
+            skeletonFile = skeletonLinkFile(meshArrays[0]['skeletonlink'], folder, operator)
+        else:
+            skeletonFile = xGetSkeletonLink(xDocMeshData, folder, operator)
+        parsed['skeletonFile'] = skeletonFile
         # use selected skeleton
-        selectedSkeleton = context.active_object if use_selected_skeleton and context.active_object and context.active_object.type == 'ARMATURE' else None
-        if selectedSkeleton:
-            map = getBoneNameMapFromArmature(selectedSkeleton)
-            if map:
-                meshData['boneIDs'] = map
-                meshData['armature'] = selectedSkeleton
-            else:
-                operator.report(
-                    {'WARNING'}, "Selected armature has no OGRE data.")
+        if boneIDs is not None:
+            if boneIDs:
+                meshData['boneIDs'] = boneIDs
 
         # there is valid skeleton link and existing file
         elif skeletonFile != "None":
-            if convertXML(xml_converter, skeletonFile):
-                skeletonFileXml = skeletonFile + ".xml"
+            if skeletons is not None and scratch is None:
+                skeletonFileXml = skeletons.convert(xml_converter, skeletonFile)
+                parsed['sharedSkeleton'] = True
+            else:
+                skeletonFileXml = convertXML(xml_converter, skeletonFile, scratch=scratch)
+            parsed['skeletonFileXml'] = skeletonFileXml
+            if skeletonFileXml:
 
                 # parse .xml skeleton file
                 xDocSkeletonData = xOpenFile(skeletonFileXml)
@@ -1502,14 +1565,13 @@ def load(operator,
                         skeletonFile[:-9])
 
                     # parse animations
-                    if import_animations:
-                        fps = xAnalyseFPS(xDocSkeletonData)
-                        if(fps and round_frames):
-                            print("Setting FPS to", fps)
-                            bpy.context.scene.render.fps = int(
-                                fps)  # fps # hack idk why
+                    if import_params['import_animations']:
+                        skeletonFps = xAnalyseFPS(xDocSkeletonData)
+                        if(skeletonFps and import_params['round_frames']):
+                            # the scene is set to this fps when the file is added
+                            fps = parsed['fps'] = int(skeletonFps)  # fps # hack idk why
                         xCollectAnimations(
-                            meshData, xDocSkeletonData, round_frames)
+                            meshData, xDocSkeletonData, import_params['round_frames'], fps)
 
             else:
                 operator.report({'WARNING'}, "Failed to load linked skeleton")
@@ -1517,34 +1579,153 @@ def load(operator,
 
         # collect mesh data
         print("collecting mesh data...")
-        xCollectMeshData(meshData, xDocMeshData,
-                         onlyName, folder, import_normals)
-        xCollectMaterialData(meshData, meshMaterials, folder)
+        if meshArrays:
+            xCollectMeshArrays(meshData, meshArrays[0], meshArrays[1], import_params['import_shapekeys'])
+            xCollectMaterialData(meshData, meshMaterials, folder)
+        else:
+            xCollectMeshData(meshData, xDocMeshData,
+                             onlyName, folder, import_params['import_normals'])
+            xCollectMaterialData(meshData, meshMaterials, folder)
+
+            if import_params['import_shapekeys']:
+                xCollectPoseData(meshData, xDocMeshData)
+
+        parsed['meshData'] = meshData
 
-        if import_shapekeys:
-            xCollectPoseData(meshData, xDocMeshData)
+    return parsed
+
+
+def buildScene(operator, parsed, import_params, armature=None):
+    '''Creates the skeleton, mesh and animations parsed by parseFile'''
+    meshData = parsed['meshData']
+    scratch = parsed['scratch']
+    filepath = parsed['filepath']
+    pathMeshXml = parsed['pathMeshXml']
+    skeletonFile = parsed['skeletonFile']
+    skeletonFileXml = parsed['skeletonFileXml']
+
+    if meshData is not None:
+        if armature and 'boneIDs' in meshData:
+            meshData['armature'] = armature
+        if 'skeleton' in meshData:
+            # update Ogre bones with rotation matrices
+            calcBoneRotations(meshData['skeleton'])
+        if parsed['fps']:
+            print("Setting FPS to", parsed['fps'])
+            bpy.context.scene.render.fps = parsed['fps']
 
         # after collecting is done, start creating stuff#
         # create skeleton (if any) and mesh from parsed data
 
 
 
-        bCreateMesh(meshData, folder, onlyName, pathMeshXml, import_params)
+        bCreateMesh(meshData, parsed['folder'], parsed['onlyName'], pathMeshXml, import_params)
         bCreateAnimations(meshData)
-        if not keep_xml:
+        if not import_params['keep_xml']:
             # cleanup by deleting the XML file we created
-            os.unlink("%s" % pathMeshXml)
-            if 'skeleton' in meshData:
-                os.unlink("%s" % skeletonFileXml)
+            OgreConverter.removeFile(pathMeshXml)
+            if 'skeleton' in meshData and not parsed['sharedSkeleton']:
+                OgreConverter.removeFile(skeletonFileXml)
+        elif scratch:
+            # kept XML goes next to the files it was converted from
+            if scratch.contains(pathMeshXml):
+                OgreConverter.moveIntoPlace(pathMeshXml, filepath + ".xml")
+            if 'skeleton' in meshData and scratch.contains(skeletonFileXml):
+                OgreConverter.moveIntoPlace(skeletonFileXml, skeletonFile + ".xml")
+
+    if scratch:
+        scratch.cleanup()
 
     if SHOW_IMPORT_TRACE:
-        print("folder: %s" % folder)
-        print("nameDotMesh: %s" % nameDotMesh)
-        print("nameDotMeshDotXml: %s" % nameDotMeshDotXml)
-        print("onlyName: %s" % onlyName)
-        print("nameDotMaterial: %s" % nameDotMaterial)
-        print("pathMaterial: %s" % pathMaterial)
-        print("ogreXMLconverter: %s" % xml_converter)
+        print("folder: %s" % parsed['folder'])
+        print("onlyName: %s" % parsed['onlyName'])
+        print("pathMeshXml: %s" % pathMeshXml)
+        print("pathMaterial: %s" % parsed['pathMaterial'])
+        print("ogreXMLconverter: %s" % import_params['xml_converter'])
 
     print("done.")
     return {'FINISHED'}
+
+
+def load(operator,
+         context,
+         filepath,
+         xml_converter=None,
+         keep_xml=True,
+         import_normals=True,
+         normal_mode="custom",
+         import_shapekeys=True,
+         import_animations=False,
+         round_frames=False,
+         use_selected_skeleton=False,
+         import_materials=True,
+         use_scratch_directory=True,
+         scratch_directory=""):
+    
+    import_params = {
+        "xml_converter" : xml_converter,
+        "keep_xml" : keep_xml,
+        "import_normals" : import_normals,
+        "normal_mode" : normal_mode,
+        "import_shapekeys" : import_shapekeys,
+        "import_animations" : import_animations,
+        "round_frames" : round_frames,
+        "use_selected_skeleton" : use_selected_skeleton,
+        "import_materials" : import_materials,
+        "use_scratch_directory" : use_scratch_directory,
+        "scratch_directory" : scratch_directory
+    }
+
+    global blender_version
+
+    blender_version = bpy.app.version[0]*100 + bpy.app.version[1]
+
+    print("loading", str(filepath))
+
+    armature, boneIDs = selectedSkeleton(operator, context, use_selected_skeleton)
+    parsed = parseFile(operator, filepath, import_params, boneIDs, bpy.context.scene.render.fps)
+    if parsed is None:
+        return {'CANCELLED'}
+    return buildScene(operator, parsed, import_params, armature)
+
+
+def importSteps(operator, context, filepaths, import_params, jobs=4, use_processes=False):
+    '''Import of several files as a generator, like OgreExport.exportSteps.
+    Files are converted and parsed on worker threads and added to the scene
+    in order as they become ready. With use_processes the mesh geometry is
+    parsed in worker processes instead'''
+    global blender_version
+
+    blender_version = bpy.app.version[0]*100 + bpy.app.version[1]
+
+    armature, boneIDs = selectedSkeleton(operator, context, import_params['use_selected_skeleton'])
+    fps = bpy.context.scene.render.fps
+    pool = OgreConverter.ConverterPool(jobs, True)
+    processes = OgreWorker.ParserProcesses(jobs) if use_processes else None
+    reports = OgreConverter.DeferredReports()
+    skeletons = SharedConversions()
+    pending = [pool.submit(parseFile, reports, filepath, import_params, boneIDs, fps, processes,
+                           skeletons)
+               for filepath in filepaths]
+    result = {'CANCELLED'}
+    try:
+        while pending:
+            yield 1 - len(pending) / len(filepaths), pending[0]
+            job = pending.pop(0)
+            parsed = job.result()
+            reports.flush(operator)
+            if parsed is not None:
+                print("loading", parsed['filepath'])
+                result = buildScene(operator, parsed, import_params, armature)
+    finally:
+        # cancelled, drop whatever was parsed but not added
+        pool.shutdown(cancel=True)
+        if processes:
+            processes.shutdown(cancel=True)
+        for job in pending:
+            if job.done() and not job.cancelled() and job.exception() is None and job.result():
+                if job.result()['scratch']:
+                    job.result()['scratch'].cleanup()
+        if not import_params['keep_xml']:
+            skeletons.removeFiles()
+    return result
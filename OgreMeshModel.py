@@ -0,0 +1,383 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8-80 compliant>
+
+"""
+Compact storage for meshData while it is queued between stages. Vertex
+attributes, faces, bone weights, poses and animation keys are held in
+contiguous numpy arrays instead of lists of lists, which take about ten times
+the memory.
+
+No stage works on this form. The importer passes the arrays parsed by
+OgreWorker through a Mesh on the way to bCreateSubMeshes, the batch exporter
+compacts each collected meshData while it waits for a writer thread and
+expands it again before the optimizer and writer run. Everything is in
+Blender's coordinate system, swizzling to Ogre's happens when the files are
+read or written.
+
+Values keep their precision: collected floats are stored as float64, so a
+queued export writes the same file as a direct one, and arrays from OgreWorker
+keep the dtype they were parsed with. Skeletons are kept as they are: the exporter's Skeleton refers to the
+armature and the importer adds mathutils matrices to its bones later.
+"""
+
+import numpy as np
+
+
+def vertexArray(values, width, dtype=None):
+    # parsed arrays keep their dtype, collected values are stored as float64
+    if dtype is None and not isinstance(values, np.ndarray):
+        dtype = np.float64
+    return np.asarray(values, dtype=dtype).reshape(-1, width)
+
+
+class Geometry(object):
+    '''Vertex attributes of a submesh or of shared geometry. Bone weights are
+    sparse, one entry per vertex and bone'''
+
+    def __init__(self, positions):
+        self.positions = vertexArray(positions, 3)
+        self.normals = None
+        self.texcoordsets = None
+        self.uvs = None
+        self.colours = None
+        self.tangents = None
+        self.parity = None
+        self.binormals = None
+        # index into Mesh.boneNames
+        self.weightVertices = None
+        self.weightBones = None
+        self.weights = None
+
+    @property
+    def vertexCount(self):
+        return len(self.positions)
+
+    def setWeights(self, vertices, bones, weights):
+        self.weightVertices = np.asarray(vertices, dtype=np.int32)
+        self.weightBones = np.asarray(bones, dtype=np.int32)
+        self.weights = vertexArray(weights, 1).ravel()
+
+    def arrays(self):
+        return [a for a in (self.positions, self.normals, self.uvs, self.colours, self.tangents,
+                            self.binormals, self.weightVertices, self.weightBones, self.weights)
+                if a is not None]
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays())
+
+
+class Pose(object):
+    '''Offsets of the vertices a shape key moves. submesh is None for poses
+    of the shared geometry'''
+
+    def __init__(self, name, submesh, vertices, offsets):
+        self.name = name
+        self.submesh = submesh
+        self.vertices = np.asarray(vertices, dtype=np.int32)
+        self.offsets = vertexArray(offsets, 3)
+
+    def nbytes(self):
+        return self.vertices.nbytes + self.offsets.nbytes
+
+
+class Submesh(object):
+
+    def __init__(self, material, indices=None, geometry=None):
+        self.material = material
+        self.materialOrg = None
+        # triangles, None if the submesh has no faces
+        self.indices = vertexArray(indices, 3, np.int32) if indices is not None else None
+        # None when the shared geometry is used
+        self.geometry = geometry
+        self.lodIndices = None
+
+    def nbytes(self):
+        arrays = [self.indices] + (self.lodIndices or [])
+        size = sum(a.nbytes for a in arrays if a is not None)
+        return size + (self.geometry.nbytes() if self.geometry else 0)
+
+
+class Track(object):
+    '''Keys of one bone: times and values of the translation, rotation and
+    scale channels, None for channels without keys'''
+
+    def __init__(self, channels):
+        self.channels = []
+        for keys in channels:
+            if not keys:
+                self.channels.append(None)
+                continue
+            times = np.array([key[0] for key in keys], dtype=np.float64)
+            values = vertexArray([key[1] for key in keys], len(keys[0][1]))
+            self.channels.append((times, values))
+
+    def keyframes(self):
+        return [list(zip(times.tolist(), map(tuple, values.tolist()))) if times is not None else []
+                for times, values in (c or (None, None) for c in self.channels)]
+
+    def nbytes(self):
+        return sum(t.nbytes + v.nbytes for t, v in filter(None, self.channels))
+
+
+def compactKeyframes(keyframes):
+    '''{bone: [translations, rotations, scales]} of (time, value) keys, as
+    used by both sides, to {bone: Track}'''
+    return {bone: Track(data) for bone, data in keyframes.items()}
+
+
+def expandKeyframes(tracks):
+    return {bone: track.keyframes() for bone, track in tracks.items()}
+
+
+class Mesh(object):
+    '''Compact meshData. extra holds the keys that aren't geometry, like the
+    skeleton, materials and levels of detail'''
+
+    def __init__(self):
+        self.sharedgeometry = None
+        self.submeshes = []
+        self.poses = []
+        # bone names are stored once, weights refer to them by index
+        self.boneNames = []
+        self.boneIndices = {}
+        self.animations = None
+        self.extra = {}
+
+    def boneIndex(self, name):
+        index = self.boneIndices.get(name)
+        if index is None:
+            index = self.boneIndices[name] = len(self.boneNames)
+            self.boneNames.append(name)
+        return index
+
+    def nbytes(self):
+        size = self.sharedgeometry.nbytes() if self.sharedgeometry else 0
+        size += sum(s.nbytes() for s in self.submeshes)
+        size += sum(p.nbytes() for p in self.poses)
+        for animation in self.animations or []:
+            size += sum(t.nbytes() for t in animation['tracks'].values())
+        return size
+
+
+###############################################################################
+# exporter layout, see OgreExport.bCollectMeshData
+
+def geometryFromExport(mesh, geometry):
+    compact = Geometry(geometry['positions'])
+    if 'normals' in geometry:
+        compact.normals = vertexArray(geometry['normals'], 3)
+    compact.texcoordsets = geometry.get('texcoordsets')
+    if 'uvsets' in geometry:
+        uvsets = geometry['uvsets']
+        sets = len(uvsets[0]) if len(uvsets) else 1
+        compact.uvs = vertexArray(uvsets, sets * 2).reshape(-1, sets, 2)
+    if 'colours' in geometry:
+        compact.colours = vertexArray(geometry['colours'], 4)
+    if 'tangents' in geometry:
+        tangents = geometry['tangents']
+        compact.tangents = vertexArray(tangents, len(tangents[0]) if len(tangents) else 4)
+        compact.parity = geometry.get('parity')
+    if 'binormals' in geometry:
+        compact.binormals = vertexArray(geometry['binormals'], 3)
+    if 'boneassignments' in geometry:
+        # per vertex lists of [bone name, weight]
+        entries = [(v, mesh.boneIndex(name), weight)
+                   for v, assignments in enumerate(geometry['boneassignments'])
+                   for name, weight in assignments]
+        if entries:
+            compact.setWeights(*zip(*entries))
+        else:
+            compact.setWeights([], [], [])
+    return compact
+
+
+def geometryToExport(mesh, compact):
+    geometry = {'positions': compact.positions.tolist()}
+    if compact.normals is not None:
+        geometry['normals'] = compact.normals.tolist()
+    if compact.texcoordsets is not None:
+        geometry['texcoordsets'] = compact.texcoordsets
+    if compact.uvs is not None:
+        geometry['uvsets'] = compact.uvs.tolist()
+    if compact.colours is not None:
+        geometry['colours'] = compact.colours.tolist()
+    if compact.tangents is not None:
+        geometry['tangents'] = compact.tangents.tolist()
+        geometry['parity'] = compact.parity
+    if compact.binormals is not None:
+        geometry['binormals'] = compact.binormals.tolist()
+    if compact.weights is not None:
+        assignments = [[] for i in range(compact.vertexCount)]
+        for v, bone, weight in zip(compact.weightVertices.tolist(), compact.weightBones.tolist(),
+                                   compact.weights.tolist()):
+            assignments[v].append([mesh.boneNames[bone], weight])
+        geometry['boneassignments'] = assignments
+    return geometry
+
+
+def posesFromExport(poses, submesh):
+    return [Pose(name, submesh, [p[0] for p in pose], [p[1:] for p in pose])
+            for name, pose in (poses or {}).items()]
+
+
+def posesToExport(poses):
+    return {pose.name: [(v,) + tuple(offset) for v, offset in
+                        zip(pose.vertices.tolist(), pose.offsets.tolist())]
+            for pose in poses}
+
+
+def fromExportData(meshData):
+    '''Compacts the meshData collected by OgreExport'''
+    mesh = Mesh()
+    for key, value in meshData.items():
+        if key not in ('sharedgeometry', 'submeshes', 'poses', 'animations'):
+            mesh.extra[key] = value
+    if 'sharedgeometry' in meshData:
+        mesh.sharedgeometry = geometryFromExport(mesh, meshData['sharedgeometry'])
+    mesh.poses = posesFromExport(meshData.get('poses'), None)
+    for index, submesh in enumerate(meshData['submeshes']):
+        compact = Submesh(submesh['material'], submesh.get('faces'))
+        if 'geometry' in submesh:
+            compact.geometry = geometryFromExport(mesh, submesh['geometry'])
+        if submesh.get('lodfaces'):
+            compact.lodIndices = [vertexArray(faces, 3, np.int32) for faces in submesh['lodfaces']]
+        mesh.poses += posesFromExport(submesh.get('poses'), index)
+        mesh.submeshes.append(compact)
+    if 'animations' in meshData:
+        mesh.animations = [{'name': a['name'], 'length': a['length'],
+                            'tracks': compactKeyframes(a['keyframes'])}
+                           for a in meshData['animations']]
+    return mesh
+
+
+def toExportData(mesh):
+    '''meshData for OgreExport's writers'''
+    meshData = dict(mesh.extra)
+    if mesh.sharedgeometry is not None:
+        meshData['sharedgeometry'] = geometryToExport(mesh, mesh.sharedgeometry)
+    shared = [p for p in mesh.poses if p.submesh is None]
+    if shared:
+        meshData['poses'] = posesToExport(shared)
+    submeshes = []
+    for index, compact in enumerate(mesh.submeshes):
+        submesh = {'material': compact.material}
+        if compact.indices is not None:
+            submesh['faces'] = compact.indices.tolist()
+        if compact.geometry is not None:
+            submesh['geometry'] = geometryToExport(mesh, compact.geometry)
+        poses = [p for p in mesh.poses if p.submesh == index]
+        submesh['poses'] = posesToExport(poses) if poses else None
+        if compact.lodIndices:
+            submesh['lodfaces'] = [faces.tolist() for faces in compact.lodIndices]
+        submeshes.append(submesh)
+    meshData['submeshes'] = submeshes
+    if mesh.animations is not None:
+        meshData['animations'] = [{'name': a['name'], 'length': a['length'],
+                                   'keyframes': expandKeyframes(a['tracks'])}
+                                  for a in mesh.animations]
+    return meshData
+
+
+###############################################################################
+# importer layout, see the description at the top of OgreImport
+
+def geometryFromArrays(mesh, info, arrays, prefix, boneIDs):
+    '''Geometry from the arrays parsed by OgreWorker, bone assignments are
+    only kept when boneIDs is given'''
+    compact = Geometry(arrays.get(prefix + 'positions', ()))
+    if prefix + 'normals' in arrays:
+        compact.normals = arrays[prefix + 'normals']
+    if prefix + 'vertexcolors' in arrays:
+        compact.colours = arrays[prefix + 'vertexcolors']
+    if prefix + 'uvsets' in arrays:
+        compact.uvs = arrays[prefix + 'uvsets']
+    compact.texcoordsets = info.get('texcoordsets')
+    if boneIDs is not None and prefix + 'boneindices' in arrays:
+        indices = arrays[prefix + 'boneindices']
+        # unknown bone ids get vertex groups of their own
+        bones = [mesh.boneIndex(boneIDs.get(str(b), 'Group %d' % b)) for b in indices[:, 1].tolist()]
+        compact.setWeights(indices[:, 0], bones, arrays[prefix + 'boneweights'])
+    return compact
+
+
+def fromArrays(info, arrays, boneIDs=None, usePoses=True):
+    '''Mesh from the description and arrays returned by OgreWorker'''
+    mesh = Mesh()
+    if info['sharedgeometry'] is not None:
+        mesh.sharedgeometry = geometryFromArrays(mesh, info['sharedgeometry'], arrays, 'shared/', boneIDs)
+    for index, submesh in enumerate(info['submeshes']):
+        prefix = '%d/' % index
+        compact = Submesh(submesh['material'], arrays.get(prefix + 'faces'))
+        if submesh['geometry'] is not None:
+            compact.geometry = geometryFromArrays(mesh, submesh['geometry'], arrays, prefix, boneIDs)
+        mesh.submeshes.append(compact)
+    if usePoses and info['poses']:
+        mesh.extra['has_poses'] = True
+        for index, (name, target, submesh) in enumerate(info['poses']):
+            if target == 'submesh':
+                offsets = arrays['pose/%d' % index]
+                # Ogre to Blender axes, like the vertex positions
+                mesh.poses.append(Pose(name, int(submesh), offsets[:, 0],
+                                       offsets[:, [1, 3, 2]] * (1, -1, 1)))
+    return mesh
+
+
+def geometryToImport(mesh, compact):
+    # vertex attributes stay arrays, bCreateSubMeshes hands them to foreach_set
+    geometry = {}
+    if len(compact.positions):
+        geometry['positions'] = compact.positions
+    if compact.normals is not None:
+        geometry['normals'] = compact.normals
+    if compact.colours is not None:
+        geometry['vertexcolors'] = compact.colours
+    if compact.uvs is not None:
+        geometry['uvsets'] = compact.uvs
+    if compact.texcoordsets is not None:
+        geometry['texcoordsets'] = compact.texcoordsets
+    if compact.weights is not None:
+        # {bone name: [[vertex, weight], ...]}, vertex groups are filled one vertex at a time anyway
+        groups = {}
+        for v, bone, weight in zip(compact.weightVertices.tolist(), compact.weightBones.tolist(),
+                                   compact.weights.tolist()):
+            groups.setdefault(mesh.boneNames[bone], []).append([v, weight])
+        geometry['boneassignments'] = groups
+    return geometry
+
+
+def toImportData(mesh, meshData):
+    '''Adds the geometry and poses to the meshData of OgreImport'''
+    if mesh.sharedgeometry is not None:
+        meshData['sharedgeometry'] = geometryToImport(mesh, mesh.sharedgeometry)
+    submeshes = []
+    for compact in mesh.submeshes:
+        submesh = {'material': compact.material, 'materialOrg': compact.materialOrg}
+        if compact.indices is not None:
+            submesh['faces'] = compact.indices
+        if compact.geometry is not None:
+            submesh['geometry'] = geometryToImport(mesh, compact.geometry)
+        submeshes.append(submesh)
+    meshData['submeshes'] = submeshes
+    if mesh.extra.get('has_poses'):
+        # data rows are (vertex, x, y, z) like the lists xCollectPoseData builds
+        meshData['poses'] = [{'name': pose.name, 'submesh': pose.submesh,
+                              'data': np.column_stack((pose.vertices, pose.offsets))}
+                             for pose in mesh.poses]
+    return meshData
@@ -0,0 +1,760 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8-80 compliant>
+
+"""
+Optimisation passes run on the collected export data (the meshData
+dictionary built by OgreExport.bCollectMeshData) before it is written.
+
+Nothing in here touches bpy, the passes only reorder or rebuild the
+per-vertex lists and face lists of each submesh.
+"""
+
+import numpy as np
+
+# geometry entries that hold one item per vertex
+PER_VERTEX_KEYS = ('positions', 'normals', 'uvsets', 'colours',
+                   'tangents', 'binormals', 'boneassignments')
+
+# cache size used when reporting ACMR, a typical post transform cache
+ANALYSIS_CACHE_SIZE = 16
+
+# cache size the triangle order is optimised for
+OPTIMIZE_CACHE_SIZE = 32
+
+# most vertices a submesh can have and still use 16 bit indexes
+MAX_16BIT_VERTICES = 65535
+
+# resolution of the views overdraw is estimated from
+OVERDRAW_RESOLUTION = 64
+
+# also measures overdraw before and after sorting, which is slower than the sort
+SHOW_OPTIMIZE_TRACE = False
+
+
+def remapGeometry(geometry, order):
+    '''Rebuilds a vertex buffer so that new vertex i is old vertex order[i].
+    Vertices not in order are removed. Returns the new index of every old
+    vertex, -1 for removed ones.'''
+    remap = [-1] * len(geometry['positions'])
+    for new, old in enumerate(order):
+        remap[old] = new
+
+    for key in PER_VERTEX_KEYS:
+        if key in geometry:
+            values = geometry[key]
+            geometry[key] = [values[old] for old in order]
+    return remap
+
+
+def remapFaces(submesh, remap):
+    submesh['faces'] = [[remap[v] for v in face] for face in submesh['faces']]
+    if submesh.get('lodfaces'):
+        submesh['lodfaces'] = [[[remap[v] for v in face] for face in faces]
+                               for faces in submesh['lodfaces']]
+
+
+def remapPoses(poses, remap):
+    for name, pose in poses.items():
+        moved = [(remap[v[0]],) + tuple(v[1:]) for v in pose if remap[v[0]] >= 0]
+        poses[name] = sorted(moved)
+
+
+def remapVertices(submesh, order):
+    '''Rebuilds the submesh vertex buffer so that new vertex i is old vertex
+    order[i]. Vertices not in order are removed.'''
+    remap = remapGeometry(submesh['geometry'], order)
+    remapFaces(submesh, remap)
+    if submesh.get('poses'):
+        remapPoses(submesh['poses'], remap)
+
+
+def freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def vertexKey(key, value):
+    if key == 'boneassignments':
+        # bone order doesn't matter
+        return tuple(sorted(freeze(value)))
+    return freeze(value)
+
+
+def shareGeometry(operator, meshData):
+    '''Merges the vertex buffers of all submeshes into one deduplicated
+    sharedgeometry buffer that every submesh indexes. Poses move to the
+    mesh. Returns False, leaving meshData alone, when the submeshes don't
+    have the same vertex layout.'''
+    submeshes = meshData['submeshes']
+    if not submeshes:
+        return False
+    keys = [key for key in PER_VERTEX_KEYS if key in submeshes[0]['geometry']]
+    for submesh in submeshes:
+        if [key for key in PER_VERTEX_KEYS if key in submesh['geometry']] != keys:
+            operator.report({'WARNING'}, "Submeshes have different vertex data, exporting without shared geometry")
+            return False
+
+    shared = {key: [] for key in keys}
+    shared['texcoordsets'] = max(s['geometry']['texcoordsets'] for s in submeshes)
+    if 'tangents' in keys:
+        shared['parity'] = any(s['geometry']['parity'] for s in submeshes)
+
+    index = {}
+    sharedPoses = {}
+    separate = 0
+    for submesh in submeshes:
+        geometry = submesh['geometry']
+        vertexCount = len(geometry['positions'])
+        separate += vertexCount
+        offsets = {}
+        for name, pose in (submesh['poses'] or {}).items():
+            for v in pose:
+                offsets.setdefault(v[0], []).append((name,) + tuple(v[1:]))
+
+        remap = []
+        for v in range(vertexCount):
+            # vertices only merge if their shape key offsets match as well
+            key = tuple(vertexKey(k, geometry[k][v]) for k in keys)
+            key += (tuple(sorted(offsets.get(v, ()))),)
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(index)
+                for k in keys:
+                    shared[k].append(geometry[k][v])
+                for offset in offsets.get(v, ()):
+                    sharedPoses.setdefault(offset[0], []).append((i,) + offset[1:])
+            remap.append(i)
+
+        remapFaces(submesh, remap)
+        del submesh['geometry']
+        submesh['poses'] = None
+
+    meshData['sharedgeometry'] = shared
+    if sharedPoses:
+        meshData['poses'] = {name: sorted(pose) for name, pose in sharedPoses.items()}
+
+    print("Shared geometry: %d vertices, %d in separate buffers" % (len(index), separate))
+    operator.report({'INFO'}, "Shared geometry: %d vertices instead of %d" % (len(index), separate))
+    return True
+
+
+def calcACMR(faces, cacheSize=ANALYSIS_CACHE_SIZE):
+    '''Average cache miss ratio (vertex shader runs per triangle) of a
+    FIFO post transform cache'''
+    if not faces:
+        return 0.0
+    cache = []
+    cached = set()
+    misses = 0
+    for face in faces:
+        for v in face:
+            if v not in cached:
+                misses += 1
+                cache.append(v)
+                cached.add(v)
+                if len(cache) > cacheSize:
+                    cached.discard(cache.pop(0))
+    return misses / len(faces)
+
+
+def vertexScore(cachePosition, remaining, cacheSize):
+    # Tom Forsyth, Linear-Speed Vertex Cache Optimisation
+    if remaining == 0:
+        return -1.0
+    score = 0.0
+    if cachePosition >= 0:
+        if cachePosition < 3:
+            # the last triangle's vertices, don't favour them too much
+            score = 0.75
+        else:
+            score = (1.0 - (cachePosition - 3) / (cacheSize - 3)) ** 1.5
+    # favour vertices with few triangles left to finish them off
+    return score + 2.0 * remaining ** -0.5
+
+
+def optimizeVertexCache(faces, vertexCount, cacheSize=OPTIMIZE_CACHE_SIZE):
+    '''Reorders triangles for post transform cache locality, returns the new
+    face list'''
+    triangleCount = len(faces)
+    if triangleCount == 0:
+        return []
+
+    # vertex -> triangles
+    adjacency = [[] for i in range(vertexCount)]
+    for t, face in enumerate(faces):
+        for v in face:
+            adjacency[v].append(t)
+    remaining = [len(a) for a in adjacency]
+
+    cachePosition = [-1] * vertexCount
+    score = [vertexScore(-1, remaining[v], cacheSize) for v in range(vertexCount)]
+    triangleScore = [score[a] + score[b] + score[c] for a, b, c in faces]
+    added = [False] * triangleCount
+
+    cache = []
+    result = []
+    best = max(range(triangleCount), key=triangleScore.__getitem__)
+    scan = 0
+    while best >= 0:
+        added[best] = True
+        face = faces[best]
+        result.append(face)
+
+        # move the triangle's vertices to the front of the cache
+        for v in face:
+            remaining[v] -= 1
+            adjacency[v].remove(best)
+        cache = list(face) + [v for v in cache if v not in face]
+        evicted = cache[cacheSize:]
+        del cache[cacheSize:]
+        for v in evicted:
+            cachePosition[v] = -1
+
+        # update scores of everything that was touched
+        touched = set(evicted)
+        for position, v in enumerate(cache):
+            cachePosition[v] = position
+            touched.add(v)
+        for v in touched:
+            newScore = vertexScore(cachePosition[v], remaining[v], cacheSize)
+            delta = newScore - score[v]
+            score[v] = newScore
+            for t in adjacency[v]:
+                triangleScore[t] += delta
+
+        # best next triangle is next to something in the cache
+        best = -1
+        bestScore = -1.0
+        for v in cache:
+            for t in adjacency[v]:
+                if triangleScore[t] > bestScore:
+                    best = t
+                    bestScore = triangleScore[t]
+
+        # nothing left around the cache, continue with the next unused one
+        if best < 0:
+            while scan < triangleCount and added[scan]:
+                scan += 1
+            if scan < triangleCount:
+                best = scan
+
+    return result
+
+
+def cacheClusters(faces, cacheSize=ANALYSIS_CACHE_SIZE):
+    '''Splits a cache optimised face list where the optimiser restarted,
+    i.e. at triangles whose vertices all miss the cache'''
+    boundaries = [0]
+    cache = []
+    cached = set()
+    for i, face in enumerate(faces):
+        misses = 0
+        for v in face:
+            if v not in cached:
+                misses += 1
+                cache.append(v)
+                cached.add(v)
+                if len(cache) > cacheSize:
+                    cached.discard(cache.pop(0))
+        if misses == 3 and i > 0:
+            boundaries.append(i)
+    return boundaries
+
+
+def splitClusters(faces, boundaries, threshold, cacheSize=ANALYSIS_CACHE_SIZE):
+    '''Splits clusters further wherever doing so keeps the cluster ACMR
+    within threshold times the ACMR of the whole cluster'''
+    result = []
+    ends = boundaries[1:] + [len(faces)]
+    for start, end in zip(boundaries, ends):
+        limit = threshold * calcACMR(faces[start:end], cacheSize)
+        result.append(start)
+        clusterStart = start
+        cache = []
+        cached = set()
+        misses = 0
+        for i in range(start, end - 1):
+            for v in faces[i]:
+                if v not in cached:
+                    misses += 1
+                    cache.append(v)
+                    cached.add(v)
+                    if len(cache) > cacheSize:
+                        cached.discard(cache.pop(0))
+            if misses / (i + 1 - clusterStart) <= limit:
+                # a new cluster starts with a cold cache
+                clusterStart = i + 1
+                result.append(clusterStart)
+                cache = []
+                cached = set()
+                misses = 0
+    return result
+
+
+def optimizeOverdraw(faces, positions, threshold=1.05):
+    '''Reorders clusters of a cache optimised face list so that clusters on
+    the outside of the mesh, facing away from its centre, are drawn first.
+    threshold is how much worse than the cache optimised ACMR a cluster may
+    get for being split into smaller, better sortable, clusters'''
+    if len(faces) < 2:
+        return list(faces)
+
+    boundaries = splitClusters(faces, cacheClusters(faces), threshold)
+    ends = boundaries[1:] + [len(faces)]
+
+    points = np.asarray(positions, dtype=np.float64)
+    corners = points[np.asarray(faces, dtype=np.int64)]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1)
+    centres = corners.mean(axis=1)
+    meshCentre = points.mean(axis=0)
+
+    keys = []
+    for start, end in zip(boundaries, ends):
+        area = areas[start:end].sum()
+        if area > 0:
+            centre = (centres[start:end] * areas[start:end, None]).sum(axis=0) / area
+        else:
+            centre = centres[start:end].mean(axis=0)
+        # normals are area weighted already
+        normal = normals[start:end].sum(axis=0)
+        length = np.linalg.norm(normal)
+        if length > 0:
+            normal /= length
+        keys.append(float(np.dot(centre - meshCentre, normal)))
+
+    order = sorted(range(len(boundaries)), key=lambda c: -keys[c])
+    result = []
+    for c in order:
+        result.extend(faces[boundaries[c]:ends[c]])
+    return result
+
+
+def calcOverdraw(faces, positions, resolution=OVERDRAW_RESOLUTION):
+    '''Estimated overdraw, shaded pixels per covered pixel, averaged over
+    the six axis aligned views of the mesh. Backfaces are culled and
+    triangles are drawn in order with a depth test.'''
+    if not faces:
+        return 0.0
+    points = np.asarray(positions, dtype=np.float64)
+    low = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - low, 1e-9)
+    # scale into [0, resolution) keeping a margin for rounding
+    points = (points - low) / extent * (resolution - 1)
+    corners = points[np.asarray(faces, dtype=np.int64)]
+
+    shaded = covered = 0
+    for axis in range(3):
+        u = (axis + 1) % 3
+        v = (axis + 2) % 3
+        for sign in (1.0, -1.0):
+            # look down -axis (or +axis), keeping the view right handed
+            x = corners[:, :, u] * sign
+            if sign < 0:
+                x += resolution - 1
+            y = corners[:, :, v]
+            z = corners[:, :, axis] * -sign
+            area = ((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) -
+                    (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0]))
+            depth = np.full((resolution, resolution), np.inf)
+            for t in np.flatnonzero(area > 0):
+                tx, ty, tz = x[t], y[t], z[t]
+                x0 = max(int(np.ceil(tx.min() - 0.5)), 0)
+                x1 = min(int(np.floor(tx.max() - 0.5)), resolution - 1)
+                y0 = max(int(np.ceil(ty.min() - 0.5)), 0)
+                y1 = min(int(np.floor(ty.max() - 0.5)), resolution - 1)
+                if x0 > x1 or y0 > y1:
+                    continue
+                px, py = np.meshgrid(np.arange(x0, x1 + 1) + 0.5,
+                                     np.arange(y0, y1 + 1) + 0.5)
+                w0 = (tx[2] - tx[1]) * (py - ty[1]) - (ty[2] - ty[1]) * (px - tx[1])
+                w1 = (tx[0] - tx[2]) * (py - ty[2]) - (ty[0] - ty[2]) * (px - tx[2])
+                w2 = area[t] - w0 - w1
+                inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+                pz = (w0 * tz[0] + w1 * tz[1] + w2 * tz[2]) / area[t]
+                region = depth[y0:y1 + 1, x0:x1 + 1]
+                passed = inside & (pz < region)
+                shaded += int(passed.sum())
+                region[passed] = pz[passed]
+            covered += int(np.isfinite(depth).sum())
+
+    return shaded / covered if covered else 0.0
+
+
+def firstUseOrder(submeshes):
+    order = []
+    seen = set()
+    for submesh in submeshes:
+        for face in submesh['faces']:
+            for v in face:
+                if v not in seen:
+                    seen.add(v)
+                    order.append(v)
+    return order
+
+
+def optimizeVertexFetch(submesh):
+    '''Renumbers vertices in the order the faces first use them'''
+    remapVertices(submesh, firstUseOrder([submesh]))
+
+
+def optimizeSharedVertexFetch(meshData):
+    '''Renumbers the shared vertices in the order the faces of all
+    submeshes first use them'''
+    remap = remapGeometry(meshData['sharedgeometry'], firstUseOrder(meshData['submeshes']))
+    for submesh in meshData['submeshes']:
+        remapFaces(submesh, remap)
+    if meshData.get('poses'):
+        remapPoses(meshData['poses'], remap)
+
+
+def extractSubmesh(submesh, faces):
+    '''New submesh with the given faces of submesh and only the vertices
+    they use'''
+    chunk = dict(submesh)
+    chunk['geometry'] = dict(submesh['geometry'])
+    if submesh.get('poses'):
+        chunk['poses'] = dict(submesh['poses'])
+    chunk.pop('lodfaces', None)
+    chunk['faces'] = faces
+    optimizeVertexFetch(chunk)
+    return chunk
+
+
+def splitFaces(faces, positions, maxVertices):
+    '''Halves the faces along the longest axis of their centres until every
+    part uses at most maxVertices vertices'''
+    if len(set(v for face in faces for v in face)) <= maxVertices:
+        return [faces]
+    centres = positions[np.asarray(faces, dtype=np.int64)].mean(axis=1)
+    axis = int(np.argmax(centres.max(axis=0) - centres.min(axis=0)))
+    order = np.argsort(centres[:, axis], kind='stable')
+    half = len(faces) // 2
+    return (splitFaces([faces[i] for i in order[:half]], positions, maxVertices) +
+            splitFaces([faces[i] for i in order[half:]], positions, maxVertices))
+
+
+def splitLargeSubmeshes(operator, meshData, maxVertices=MAX_16BIT_VERTICES):
+    '''Splits submeshes with more vertices than 16 bit indexes can address
+    into spatially coherent chunks. Vertices on the borders between chunks
+    are duplicated.'''
+    if 'sharedgeometry' in meshData:
+        if len(meshData['sharedgeometry']['positions']) > maxVertices:
+            operator.report({'WARNING'}, "Shared geometry can't be split, it keeps 32 bit indexes")
+        return
+    submeshes = []
+    for index, submesh in enumerate(meshData['submeshes']):
+        positions = submesh['geometry']['positions']
+        if len(positions) <= maxVertices:
+            submeshes.append(submesh)
+            continue
+        parts = splitFaces(submesh['faces'], np.asarray(positions), maxVertices)
+        chunks = [extractSubmesh(submesh, faces) for faces in parts]
+        counts = [len(chunk['geometry']['positions']) for chunk in chunks]
+        print("Submesh %d with %d vertices split into %d chunks: %s vertices" %
+              (index, len(positions), len(chunks), " / ".join(str(c) for c in counts)))
+        operator.report({'INFO'}, "Split submesh %d (%s) into %d chunks with 16 bit indexes" %
+                        (index, submesh['material'], len(chunks)))
+        submeshes.extend(chunks)
+    meshData['submeshes'] = submeshes
+
+
+def paletteFaces(faces, weights, maxBones):
+    '''Groups faces so no group uses more than maxBones bones. Each face goes
+    to the group it adds the fewest new bones to.'''
+    groups = []
+    for face in faces:
+        bones = set(bone for v in face for bone, weight in weights[v])
+        best = None
+        bestAdded = maxBones + 1
+        for group in groups:
+            added = len(bones - group[0])
+            if added < bestAdded and len(group[0]) + added <= maxBones:
+                best = group
+                bestAdded = added
+                if added == 0:
+                    break
+        if best is None:
+            best = (set(), [])
+            groups.append(best)
+        best[0].update(bones)
+        best[1].append(face)
+    return groups
+
+
+def limitBonePalettes(operator, meshData, maxBones):
+    '''Splits skinned submeshes that use more than maxBones bones into
+    partitions that each use at most maxBones, so they can be skinned in
+    hardware'''
+    if 'sharedgeometry' in meshData:
+        operator.report({'WARNING'}, "Bone palettes can't be limited with shared geometry")
+        return
+    submeshes = []
+    for index, submesh in enumerate(meshData['submeshes']):
+        weights = submesh['geometry'].get('boneassignments') or []
+        bones = set(bone for vertex in weights for bone, weight in vertex)
+        if len(bones) <= maxBones:
+            submeshes.append(submesh)
+            continue
+        groups = paletteFaces(submesh['faces'], weights, maxBones)
+        for group in groups:
+            if len(group[0]) > maxBones:
+                operator.report({'WARNING'}, "Submesh %d (%s) has triangles using more than %d bones" %
+                                (index, submesh['material'], maxBones))
+            submeshes.append(extractSubmesh(submesh, group[1]))
+        print("Submesh %d with %d bones split into %d partitions:" % (index, len(bones), len(groups)))
+        for part, group in enumerate(groups):
+            print("    partition %d: %d bones, %d faces" % (part, len(group[0]), len(group[1])))
+        operator.report({'INFO'}, "Split submesh %d (%s) into %d partitions of at most %d bones (%s)" %
+                        (index, submesh['material'], len(groups), maxBones,
+                         " / ".join(str(len(group[0])) for group in groups)))
+    meshData['submeshes'] = submeshes
+
+
+def optimizeMeshData(operator, meshData, overdrawThreshold=None):
+    '''Cache optimises triangle and vertex order of every submesh and
+    reports the ACMR before and after. With an overdrawThreshold the
+    triangles are then also sorted to reduce overdraw.'''
+    before = after = triangles = 0
+    overdrawBefore = overdrawAfter = 0.0
+    shared = meshData.get('sharedgeometry')
+    for index, submesh in enumerate(meshData['submeshes']):
+        faces = submesh['faces']
+        if not faces:
+            continue
+        positions = (shared or submesh['geometry'])['positions']
+        vertexCount = len(positions)
+        acmr = calcACMR(faces)
+        optimizedFaces = optimizeVertexCache(faces, vertexCount)
+        if overdrawThreshold is not None:
+            optimizedFaces = optimizeOverdraw(optimizedFaces, positions, overdrawThreshold)
+            if SHOW_OPTIMIZE_TRACE:
+                overdraw = calcOverdraw(faces, positions)
+                optimizedOverdraw = calcOverdraw(optimizedFaces, positions)
+                print("Submesh %d overdraw: %.3f -> %.3f" % (index, overdraw, optimizedOverdraw))
+                overdrawBefore += overdraw * len(faces)
+                overdrawAfter += optimizedOverdraw * len(faces)
+        submesh['faces'] = optimizedFaces
+        if submesh.get('lodfaces'):
+            submesh['lodfaces'] = [optimizeVertexCache(lodFaces, vertexCount)
+                                   for lodFaces in submesh['lodfaces']]
+        if not shared:
+            optimizeVertexFetch(submesh)
+        optimized = calcACMR(submesh['faces'])
+        print("Submesh %d vertex cache: ACMR %.3f -> %.3f" % (index, acmr, optimized))
+        before += acmr * len(faces)
+        after += optimized * len(faces)
+        triangles += len(faces)
+
+    if shared:
+        optimizeSharedVertexFetch(meshData)
+
+    if triangles:
+        message = "Vertex cache optimised: ACMR %.3f -> %.3f" % (before / triangles, after / triangles)
+        if overdrawThreshold is not None and SHOW_OPTIMIZE_TRACE:
+            message += ", overdraw %.3f -> %.3f" % (overdrawBefore / triangles, overdrawAfter / triangles)
+        operator.report({'INFO'}, message)
+
+
+# largest summed difference of bone weights between two vertices that may
+# be merged by the simplifier
+LOD_WEIGHT_TOLERANCE = 0.25
+
+
+def weightDistance(a, b):
+    weights = dict(a)
+    distance = 0.0
+    for bone, weight in b:
+        distance += abs(weights.pop(bone, 0.0) - weight)
+    return distance + sum(weights.values())
+
+
+class Simplifier:
+    '''Quadric error edge collapse simplification of the faces of one submesh.
+
+    Vertices at the same position are simplified together, so a collapse of
+    a vertex on a UV or normal seam moves every copy of it along the seam.
+    Open borders, and with them the borders between submeshes, are never
+    moved. Collapses only ever remove vertices so the reduced face lists
+    keep indexing the original vertex buffer, as Ogre expects of generated
+    levels of detail.'''
+
+    def __init__(self, faces, geometry):
+        self.faces = [list(face) for face in faces]
+        self.points = np.asarray(geometry['positions'], dtype=np.float64)
+        self.weights = geometry.get('boneassignments')
+
+        # vertices at the same position share a group
+        groups = {}
+        self.group = [groups.setdefault(tuple(p), len(groups)) for p in geometry['positions']]
+        self.groupCount = len(groups)
+        self.position = np.zeros((self.groupCount, 3))
+        self.position[self.group] = self.points
+
+        # plane quadrics of the faces around each position
+        self.quadric = np.zeros((self.groupCount, 4, 4))
+        if self.faces:
+            corners = self.points[np.asarray(self.faces, dtype=np.int64)]
+            normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+            lengths = np.linalg.norm(normals, axis=1)
+            valid = lengths > 0
+            planes = np.zeros((len(self.faces), 4))
+            planes[valid, :3] = normals[valid] / lengths[valid, None]
+            planes[:, 3] = -np.einsum('ij,ij->i', planes[:, :3], corners[:, 0])
+            # weight by area so small slivers matter less
+            quadrics = np.einsum('ij,ik->ijk', planes, planes) * (lengths / 2)[:, None, None]
+            for k in range(3):
+                groupIds = np.asarray([self.group[face[k]] for face in self.faces], dtype=np.int64)
+                np.add.at(self.quadric, groupIds, quadrics)
+
+    def error(self, g, point):
+        p = np.append(point, 1.0)
+        return float(p @ self.quadric[g] @ p)
+
+    def compatible(self, u, v):
+        if not self.weights:
+            return True
+        return weightDistance(self.weights[u], self.weights[v]) <= LOD_WEIGHT_TOLERANCE
+
+    def flips(self, U, V, groupFaces):
+        '''Would moving position U onto V turn any remaining face over'''
+        target = self.position[V]
+        for f in groupFaces[U]:
+            face = self.faces[f]
+            ids = [self.group[v] for v in face]
+            if V in ids:
+                continue
+            corners = self.position[ids]
+            before = np.cross(corners[1] - corners[0], corners[2] - corners[0])
+            corners[ids.index(U)] = target
+            after = np.cross(corners[1] - corners[0], corners[2] - corners[0])
+            if np.dot(before, after) <= 1e-6 * np.dot(before, before):
+                return True
+        return False
+
+    def reduce(self, targetCount):
+        '''Collapses edges until at most targetCount faces remain or nothing
+        more can be collapsed, returns the remaining faces'''
+        while len(self.faces) > targetCount:
+            # position topology of the current faces
+            groupFaces = [[] for i in range(self.groupCount)]
+            groupWedges = [set() for i in range(self.groupCount)]
+            edgeFaces = {}
+            wedgeEdges = {}
+            for f, face in enumerate(self.faces):
+                for k in range(3):
+                    a = face[k]
+                    b = face[(k + 1) % 3]
+                    A = self.group[a]
+                    B = self.group[b]
+                    groupFaces[A].append(f)
+                    groupWedges[A].add(a)
+                    edge = (min(A, B), max(A, B))
+                    edgeFaces[edge] = edgeFaces.get(edge, 0) + 1
+                    wedgeEdges.setdefault(a, set()).add(b)
+                    wedgeEdges.setdefault(b, set()).add(a)
+
+            # borders and non manifold edges stay where they are
+            locked = [False] * self.groupCount
+            for (A, B), count in edgeFaces.items():
+                if count != 2:
+                    locked[A] = locked[B] = True
+
+            candidates = []
+            for A, B in edgeFaces:
+                for U, V in ((A, B), (B, A)):
+                    if locked[U]:
+                        continue
+                    mapping = self.wedgeMapping(groupWedges[U], groupWedges[V], wedgeEdges)
+                    if mapping is None:
+                        continue
+                    candidates.append((self.error(U, self.position[V]), U, V, mapping))
+            candidates.sort(key=lambda c: c[0])
+
+            # collapse the cheapest edges that do not touch each other
+            remap = {}
+            touched = set()
+            removed = 0
+            needed = len(self.faces) - targetCount
+            for cost, U, V, mapping in candidates:
+                if U in touched or V in touched:
+                    continue
+                if self.flips(U, V, groupFaces):
+                    continue
+                remap.update(mapping)
+                self.quadric[V] += self.quadric[U]
+                touched.add(U)
+                touched.add(V)
+                for f in groupFaces[U]:
+                    ids = [self.group[v] for v in self.faces[f]]
+                    touched.update(ids)
+                    if V in ids:
+                        removed += 1
+                if removed >= needed:
+                    break
+
+            if not remap:
+                break
+
+            faces = []
+            for face in self.faces:
+                face = [remap.get(v, v) for v in face]
+                if len(set(self.group[v] for v in face)) == 3:
+                    faces.append(face)
+            self.faces = faces
+
+        return [list(face) for face in self.faces]
+
+    def wedgeMapping(self, wedgesU, wedgesV, wedgeEdges):
+        '''Which vertex at V each vertex at U merges into, None when U can't
+        be merged into V without mixing up seams or skin weights'''
+        mapping = {}
+        used = set()
+        for u in wedgesU:
+            # two sides of a seam can't merge into one vertex
+            targets = [v for v in wedgeEdges[u] if v in wedgesV and v not in used]
+            targets = [v for v in targets if self.compatible(u, v)]
+            if not targets:
+                return None
+            used.add(targets[0])
+            mapping[u] = targets[0]
+        return mapping
+
+
+def generateLevelsOfDetail(operator, meshData, levels, reduction):
+    '''Adds a list of reduced face lists, one per level of detail, to every
+    submesh. Each level keeps reduction times the faces of the one before.'''
+    total = [0] * (levels + 1)
+    for index, submesh in enumerate(meshData['submeshes']):
+        faces = submesh['faces']
+        simplifier = Simplifier(faces, meshData.get('sharedgeometry') or submesh['geometry'])
+        lodFaces = []
+        target = len(faces)
+        for level in range(levels):
+            target = int(target * reduction)
+            lodFaces.append(simplifier.reduce(target))
+        submesh['lodfaces'] = lodFaces
+        counts = [len(faces)] + [len(f) for f in lodFaces]
+        print("Submesh %d levels of detail: %s faces" % (index, " / ".join(str(c) for c in counts)))
+        total = [t + c for t, c in zip(total, counts)]
+
+    operator.report({'INFO'}, "Generated %d levels of detail: %s faces" %
+                    (levels, " / ".join(str(c) for c in total)))
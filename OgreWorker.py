@@ -0,0 +1,198 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8-80 compliant>
+
+"""
+Parses the geometry of .mesh.xml files in separate processes, so imports of
+many files aren't limited to one core by the GIL.
+
+A worker reads vertex buffers, faces, bone assignments and poses into numpy
+arrays and hands them back in a single shared memory block instead of
+pickling lists. OgreMeshModel.fromArrays turns them into a compact Mesh.
+
+This file must not import bpy or anything from the addon package: the worker
+processes run a plain Python interpreter and import it as a top level module.
+"""
+
+import importlib
+import multiprocessing
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# on Windows, how long a worker keeps shared blocks open for the importer to copy them
+KEEP_SHARED_SECONDS = 60.0
+ARRAY_ALIGNMENT = 16
+
+_outstanding = []
+
+
+def readVertexBuffers(geometry, useNormals, arrays, prefix):
+    # same conventions as OgreImport.xCollectVertexData: y up to z up, v flipped
+    info = {}
+    for vb in geometry.findall('vertexbuffer'):
+        vertices = vb.findall('vertex')
+        if 'positions' in vb.attrib:
+            values = [(float(p.get('x')), float(p.get('y')), float(p.get('z')))
+                      for p in (v.find('position') for v in vertices)]
+            positions = np.array(values, dtype=np.float32).reshape(-1, 3)
+            arrays[prefix + 'positions'] = positions[:, [0, 2, 1]] * np.array((1, -1, 1), dtype=np.float32)
+        if 'normals' in vb.attrib and useNormals:
+            values = [(float(n.get('x')), float(n.get('y')), float(n.get('z')))
+                      for n in (v.find('normal') for v in vertices)]
+            normals = np.array(values, dtype=np.float32).reshape(-1, 3)
+            arrays[prefix + 'normals'] = normals[:, [0, 2, 1]] * np.array((1, -1, 1), dtype=np.float32)
+        if 'colours_diffuse' in vb.attrib:
+            values = [[float(c) for c in v.find('colour_diffuse').get('value').split()[:4]]
+                      for v in vertices]
+            arrays[prefix + 'vertexcolors'] = np.array(values, dtype=np.float32).reshape(-1, 4)
+        if 'texture_coord_dimensions_0' in vb.attrib:
+            sets = int(vb.get('texture_coords'))
+            info['texcoordsets'] = sets
+            values = [[(float(t.get('u')), 1.0 - float(t.get('v'))) for t in v.findall('texcoord')]
+                      for v in vertices]
+            arrays[prefix + 'uvsets'] = np.array([uv for uv in values if uv],
+                                                 dtype=np.float32).reshape(-1, sets, 2)
+    return info
+
+
+def readBoneAssignments(node, arrays, prefix):
+    assignments = node.findall('vertexboneassignment')
+    arrays[prefix + 'boneindices'] = np.array(
+        [(int(a.get('vertexindex')), int(a.get('boneindex'))) for a in assignments],
+        dtype=np.int32).reshape(-1, 2)
+    arrays[prefix + 'boneweights'] = np.array(
+        [float(a.get('weight')) for a in assignments], dtype=np.float32)
+
+
+def parseMeshXml(filepath, useNormals):
+    '''Reads the geometry of a .mesh.xml file into a description and a dict
+    of numpy arrays'''
+    root = ET.parse(filepath).getroot()
+    arrays = {}
+    info = {'sharedgeometry': None, 'submeshes': [], 'poses': [], 'skeletonlink': None}
+
+    shared = root.find('sharedgeometry')
+    if shared is not None:
+        info['sharedgeometry'] = readVertexBuffers(shared, useNormals, arrays, 'shared/')
+        boneAssignments = root.find('boneassignments')
+        if boneAssignments is not None:
+            readBoneAssignments(boneAssignments, arrays, 'shared/')
+
+    submeshes = root.find('submeshes')
+    for index, submesh in enumerate(submeshes.findall('submesh') if submeshes is not None else []):
+        prefix = '%d/' % index
+        sm = {'material': submesh.get('material'), 'geometry': None}
+        faces = submesh.find('faces')
+        if faces is not None:
+            arrays[prefix + 'faces'] = np.array(
+                [(int(f.get('v1')), int(f.get('v2')), int(f.get('v3'))) for f in faces.findall('face')],
+                dtype=np.int32).reshape(-1, 3)
+        geometry = submesh.find('geometry')
+        if geometry is not None:
+            sm['geometry'] = readVertexBuffers(geometry, useNormals, arrays, prefix)
+            boneAssignments = submesh.find('boneassignments')
+            if boneAssignments is not None and shared is None:
+                readBoneAssignments(boneAssignments, arrays, prefix)
+        info['submeshes'].append(sm)
+
+    link = root.find('skeletonlink')
+    if link is not None:
+        info['skeletonlink'] = link.get('name')
+
+    for index, pose in enumerate(root.iter('pose')):
+        info['poses'].append((pose.get('name', ''), pose.get('target', ''), pose.get('index', '')))
+        arrays['pose/%d' % index] = np.array(
+            [(int(o.get('index')), float(o.get('x')), float(o.get('y')), float(o.get('z')))
+             for o in pose.findall('poseoffset')], dtype=np.float64).reshape(-1, 4)
+
+    return info, arrays
+
+
+def shareArrays(arrays):
+    '''Copies the arrays into one shared memory block, returning its name and
+    where each array is'''
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        layout.append((key, array.dtype.str, array.shape, offset))
+        offset += -(-array.nbytes // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (key, dtype, shape, start), array in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype, block.buf, start)[...] = array
+    name = block.name
+    if os.name == 'nt':
+        # on Windows the block only lives while a handle is open, so keep it a while
+        _outstanding.append((time.monotonic(), block))
+    else:
+        # the importer unlinks the block once it has copied the arrays
+        resource_tracker.unregister(block._name, "shared_memory")
+        block.close()
+    return name, layout
+
+
+def releaseOutstanding():
+    now = time.monotonic()
+    while _outstanding and now - _outstanding[0][0] > KEEP_SHARED_SECONDS:
+        _outstanding.pop(0)[1].close()
+
+
+def parseInWorker(filepath, useNormals):
+    releaseOutstanding()
+    info, arrays = parseMeshXml(filepath, useNormals)
+    return info, shareArrays(arrays)
+
+
+def takeArrays(name, layout):
+    '''Copies the arrays out of a shared block and frees it'''
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        arrays = {key: np.ndarray(shape, dtype, block.buf, start).copy()
+                  for key, dtype, shape, start in layout}
+    finally:
+        block.close()
+        if os.name != 'nt':
+            block.unlink()
+    return arrays
+
+
+class ParserProcesses(object):
+    '''Pool of worker processes parsing mesh geometry'''
+
+    def __init__(self, jobs):
+        # workers import this file as a top level module, the addon package needs bpy
+        directory = os.path.dirname(os.path.abspath(__file__))
+        if directory not in sys.path:
+            sys.path.append(directory)
+        self.worker = importlib.import_module("OgreWorker")
+        # forking Blender isn't safe
+        self.executor = ProcessPoolExecutor(max_workers=jobs,
+                                            mp_context=multiprocessing.get_context("spawn"))
+
+    def parse(self, filepath, useNormals):
+        info, (name, layout) = self.executor.submit(self.worker.parseInWorker, filepath, useNormals).result()
+        return info, takeArrays(name, layout)
+
+    def shutdown(self, cancel=False):
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
@@ -111,7 +111,9 @@ bl_info = {
     "support": 'COMMUNITY',
     "category": "Import-Export"}
 
+import os
 import platform
+import time
 
 from bpy_extras.io_utils import (ExportHelper,
                                  ImportHelper,
@@ -120,6 +122,7 @@ from bpy_extras.io_utils import (ExportHelper,
                                  )
 from bpy.props import (BoolProperty,
                        FloatProperty,
+                       IntProperty,
                        StringProperty,
                        EnumProperty,
                        CollectionProperty,
@@ -130,12 +133,25 @@ if "bpy" in locals():
     import imp
     if "OgreImport" in locals():
         imp.reload(OgreImport)
+    if "OgreOptimize" in locals():
+        imp.reload(OgreOptimize)
+    if "OgreBinary" in locals():
+        imp.reload(OgreBinary)
+    if "OgreConverter" in locals():
+        imp.reload(OgreConverter)
+    if "OgreMeshModel" in locals():
+        imp.reload(OgreMeshModel)
+    if "OgreWorker" in locals():
+        imp.reload(OgreWorker)
     if "OgreExport" in locals():
         imp.reload(OgreExport)
     if "PhysExport" in locals():
         imp.reload(PhysExport)
 
 
+# Seconds of export work done per timer tick of a background export
+BACKGROUND_TIME_SLICE = 0.05
+
 # Path for your OgreXmlConverter
 OGRE_XML_CONVERTER_1_29 = "XML_1_29/OgreXMLConverter.exe"
 OGRE_XML_CONVERTER_1_29_Wine = "XML_1_29/OgreXMLConverter.bash"
@@ -162,7 +178,89 @@ def findConverter(p):
     return None
 
 
-class ImportOgre(bpy.types.Operator, ImportHelper):
+def resolveConverter(choice, custom):
+    from . import OgreConverter
+
+    if platform.system() == "Windows":
+        match choice:
+            case "default":
+                return findConverter(OGRE_XML_CONVERTER_1_29)
+            case "compatibility (1.10)":
+                return findConverter(OGRE_XML_CONVERTER_1_10)
+            case "custom":
+                return findConverter(custom)
+    elif platform.system() == "Linux":
+        match choice:
+            case "default":
+                # a native build of the converter needs no Wine
+                native = OgreConverter.findNativeConverter()
+                if native:
+                    print('Using native xml converter', native)
+                    return native
+                return findConverter(OGRE_XML_CONVERTER_1_29_Wine)
+            case "compatibility (1.10)":
+                return findConverter(OGRE_XML_CONVERTER_1_10_Wine)
+            case "custom":
+                return findConverter(custom)
+    return choice
+
+
+def warmUpConverter(operator):
+    '''Starts Wine while the file browser is open'''
+    from . import OgreConverter
+    converter = resolveConverter(operator.xml_converter, operator.custom_xml_converter)
+    OgreConverter.warmUpConverter(converter)
+
+
+class BackgroundOperator(object):
+    '''Runs an import or export generator on timer ticks, a slice at a time,
+    with progress in the status bar and Esc to cancel'''
+
+    def startBackground(self, context, steps, label):
+        self._steps = steps
+        self._job = None
+        self._label = label
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        self._timer = wm.event_timer_add(0.05, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.finishBackground(context)
+            self.report({'WARNING'}, "%s cancelled" % self._label)
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        # work for a short time per tick so blender stays responsive
+        deadline = time.perf_counter() + BACKGROUND_TIME_SLICE
+        while time.perf_counter() < deadline:
+            if self._job is not None and not self._job.done():
+                break
+            try:
+                progress, self._job = next(self._steps)
+            except StopIteration as done:
+                self.finishBackground(context)
+                return done.value
+            except Exception:
+                self.finishBackground(context)
+                raise
+            context.window_manager.progress_update(int(progress * 100))
+            context.workspace.status_text_set("%s: %d%%, Esc to cancel" % (self._label, progress * 100))
+        return {'PASS_THROUGH'}
+
+    def finishBackground(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        # stops the generator if it hasn't finished, running jobs are waited for
+        self._steps.close()
+
+
+class ImportOgre(BackgroundOperator, bpy.types.Operator, ImportHelper):
     '''Load an Ogre MESH File'''
     bl_idname = "import_scene.mesh"
     bl_label = "Import MESH"
@@ -170,6 +268,10 @@ class ImportOgre(bpy.types.Operator, ImportHelper):
 
     filename_ext = ".mesh"
 
+    def invoke(self, context, event):
+        warmUpConverter(self)
+        return ImportHelper.invoke(self, context, event)
+
 
     custom_xml_converter: StringProperty(
         name="Custom XML Converter",
@@ -199,12 +301,45 @@ class ImportOgre(bpy.types.Operator, ImportHelper):
         options={'HIDDEN', 'SKIP_SAVE'}
     )
 
+    background_import: BoolProperty(
+        name="Run in Background",
+        description="Convert and read the files on worker threads and add them to the scene as they become ready. Progress is shown in the status bar and Esc cancels the import",
+        default=False,
+    )
+
+    converter_jobs: IntProperty(
+        name="Jobs",
+        description="Number of files converted and read at once when running in the background",
+        default=4,
+        min=1,
+        max=64,
+    )
+
+    use_processes: BoolProperty(
+        name="Parse in Separate Processes",
+        description="Read the mesh geometry in worker processes so imports of many files use all cores. Skeletons and animations are still read on threads",
+        default=False,
+    )
+
     keep_xml: BoolProperty(
         name="Keep XML",
         description="Keeps the XML file when converting from .MESH",
         default=False,
     )
 
+    use_scratch_directory: BoolProperty(
+        name="Use Scratch Directory",
+        description="Write and convert the intermediate XML files in a scratch directory instead of next to the imported files. Only the finished files are moved into place",
+        default=True,
+    )
+
+    scratch_directory: StringProperty(
+        name="Scratch Directory",
+        description="Where intermediate XML files are written. Leave empty to use /dev/shm on Linux or the system temp folder otherwise",
+        subtype='DIR_PATH',
+        default="",
+    )
+
     import_normals: BoolProperty(
         name="Import Normals",
         description="Import custom mesh normals",
@@ -262,27 +397,14 @@ class ImportOgre(bpy.types.Operator, ImportHelper):
     def execute(self, context):
         # print("Selected: " + context.active_object.name)
         from . import OgreImport
+        from . import OgreConverter
         import os
 
         keywords = self.as_keywords(ignore=("filter_glob",))
 
         #obtain converter
-        if platform.system() == "Windows":
-            match keywords['xml_converter']:
-                case "default":
-                    keywords['xml_converter'] = findConverter(OGRE_XML_CONVERTER_1_29)
-                case "compatibility (1.10)":
-                    keywords['xml_converter'] = findConverter(OGRE_XML_CONVERTER_1_10)
-                case "custom":
-                    keywords['xml_converter'] = findConverter(keywords['custom_xml_converter'])
-        elif platform.system() == "Linux":
-            match keywords['xml_converter']:
-                case "default":
-                    keywords['xml_converter'] = findConverter(OGRE_XML_CONVERTER_1_29_Wine)
-                case "compatibility (1.10)":
-                    keywords['xml_converter'] = findConverter(OGRE_XML_CONVERTER_1_10_Wine)
-                case "custom":
-                    keywords['xml_converter'] = findConverter(keywords['custom_xml_converter'])
+        keywords['xml_converter'] = resolveConverter(keywords['xml_converter'], keywords['custom_xml_converter'])
+        OgreConverter.warmUpConverter(keywords['xml_converter'])
         
 
         print('converter = ', keywords['xml_converter'])
@@ -302,12 +424,21 @@ class ImportOgre(bpy.types.Operator, ImportHelper):
             "import_animations" : keywords['import_animations'],
             "round_frames" : keywords['round_frames'],
             "use_selected_skeleton" : keywords['use_selected_skeleton'],
-            "import_materials" : keywords['import_materials']
+            "import_materials" : keywords['import_materials'],
+            "use_scratch_directory" : keywords['use_scratch_directory'],
+            "scratch_directory" : keywords['scratch_directory']
         }
 
         print(import_params)
 
 
+        if self.background_import:
+            import_params.pop('filepath')
+            filepaths = [directory + "/" + meshpath.name for meshpath in self.files]
+            steps = OgreImport.importSteps(self, context, filepaths, import_params, self.converter_jobs,
+                                           self.use_processes)
+            return self.startBackground(context, steps, "Importing %d files" % len(filepaths))
+
         bpy.context.window.cursor_set("WAIT")
         for meshpath in self.files:
             import_params['filepath'] = directory + "/" + meshpath.name
@@ -323,6 +454,15 @@ class ImportOgre(bpy.types.Operator, ImportHelper):
         layout.prop(self, "custom_xml_converter")
         layout.prop(self, "xml_converter")
         layout.prop(self, "keep_xml")
+        layout.prop(self, "background_import")
+        jobs = layout.column()
+        jobs.enabled = self.background_import
+        jobs.prop(self, "converter_jobs")
+        jobs.prop(self, "use_processes")
+        layout.prop(self, "use_scratch_directory")
+        scratch = layout.column()
+        scratch.enabled = self.use_scratch_directory
+        scratch.prop(self, "scratch_directory")
         layout.prop(self, "import_normals")
         layout.prop(self, "normal_mode")
         layout.prop(self, "import_shapekeys")
@@ -343,7 +483,7 @@ class ImportOgre(bpy.types.Operator, ImportHelper):
 ##############################################################################################################################
 
 
-class ExportOgre(bpy.types.Operator, ExportHelper):
+class ExportOgre(BackgroundOperator, bpy.types.Operator, ExportHelper):
     '''Export a Kenshi MESH File'''
 
     bl_idname = "export_scene.mesh"
@@ -398,9 +538,30 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
         default=False,
     )
 
+    use_scratch_directory: BoolProperty(
+        name="Use Scratch Directory",
+        description="Write and convert the intermediate XML files in a scratch directory instead of next to the exported files. Only the finished files are moved into place",
+        default=True,
+    )
+
+    scratch_directory: StringProperty(
+        name="Scratch Directory",
+        description="Where intermediate XML files are written. Leave empty to use /dev/shm on Linux or the system temp folder otherwise",
+        subtype='DIR_PATH',
+        default="",
+    )
+
+    converter_jobs: IntProperty(
+        name="Converter Jobs",
+        description="Number of converter processes run at once during batch export",
+        default=4,
+        min=1,
+        max=64,
+    )
+
     apply_transform: BoolProperty(
         name="Apply Transform",
-        description="Applies object's transformation to its data",
+        description="Applies object's rotation and scale to the exported data. The scene is not modified",
         default=False,
     )
 
@@ -416,6 +577,134 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
         default=False,
     )
 
+    shared_geometry: BoolProperty(
+        name="Shared Geometry",
+        description="Write one vertex buffer shared by all submeshes instead of one per submesh.\nVertices used by several submeshes are only stored once",
+        default=False,
+    )
+
+    vertex_layout: EnumProperty(
+        items = [
+            ("interleaved", "Interleaved", "All vertex attributes in one buffer", 1),
+            ("split", "Separate Positions", "Positions in their own buffer (stream 0), everything else in a second one. Shadow and depth passes only read positions", 2)
+        ],
+        name = "Vertex Buffer Layout",
+        description = "How vertex attributes are laid out in vertex buffers",
+        default = "interleaved"
+    )
+
+    binary_mesh: BoolProperty(
+        name="Write Binary Mesh",
+        description="Write the .mesh file directly instead of converting XML, allowing compact vertex formats.\nLevels of detail are only written to XML",
+        default=False,
+    )
+
+    normal_format: EnumProperty(
+        items = [
+            ("float3", "Float", "32 bit floats", 1),
+            ("short4n", "Normalized Shorts", "16 bit signed normalized. Needs Ogre 1.12 or later", 2),
+            ("byte4n", "Normalized Bytes", "8 bit signed normalized. Needs Ogre 1.12 or later", 3),
+            ("int1010102n", "10:10:10:2", "10 bit signed normalized packed in 32 bits. Needs Ogre 1.12 or later", 4)
+        ],
+        name = "   Normal Format",
+        description = "Vertex format of normals, tangents and binormals in binary meshes",
+        default = "float3"
+    )
+
+    uv_format: EnumProperty(
+        items = [
+            ("float2", "Float", "32 bit floats", 1),
+            ("half2", "Half Float", "16 bit floats. Needs Ogre 13 or later", 2),
+            ("short2n", "Normalized Shorts", "16 bit signed normalized, UVs must lie between -1 and 1. Needs Ogre 1.12 or later", 3)
+        ],
+        name = "   UV Format",
+        description = "Vertex format of texture coordinates in binary meshes",
+        default = "float2"
+    )
+
+    colour_format: EnumProperty(
+        items = [
+            ("float4", "Float", "32 bit floats", 1),
+            ("colour_abgr", "Packed Colour", "8 bit per channel packed colour, loads in all Ogre versions", 2)
+        ],
+        name = "   Colour Format",
+        description = "Vertex format of vertex colours in binary meshes",
+        default = "float4"
+    )
+
+    split_large_submeshes: BoolProperty(
+        name="Split Large Submeshes",
+        description="Split submeshes with more than 65535 vertices into chunks that can use 16 bit indexes",
+        default=False,
+    )
+
+    optimize_vertex_cache: BoolProperty(
+        name="Optimize Vertex Cache",
+        description="Reorder triangles and vertices so the GPU transforms fewer vertices per triangle.\nThe shape of the mesh is not changed",
+        default=False,
+    )
+
+    optimize_overdraw: BoolProperty(
+        name="Optimize Overdraw",
+        description="Also sort groups of triangles so outer, outward facing parts of the mesh are drawn first and hide what is behind them",
+        default=False,
+    )
+
+    overdraw_threshold: FloatProperty(
+        name="   Overdraw Threshold",
+        description="How much vertex cache efficiency may be traded for less overdraw. 1.0 allows no loss of vertex cache efficiency",
+        default=1.05,
+        min=1.0,
+        max=3.0,
+    )
+
+    generate_lod: BoolProperty(
+        name="Generate LOD",
+        description="Generate reduced levels of detail for the mesh. UV seams, skin weights and submesh borders are kept",
+        default=False,
+    )
+
+    lod_levels: IntProperty(
+        name="   LOD Levels",
+        description="Number of reduced levels of detail to generate",
+        default=3,
+        min=1,
+        max=8,
+    )
+
+    lod_reduction: FloatProperty(
+        name="   LOD Reduction",
+        description="Fraction of the triangles of the previous level each level keeps",
+        default=0.5,
+        min=0.05,
+        max=0.95,
+        subtype='FACTOR',
+    )
+
+    lod_strategy: EnumProperty(
+        items = [
+            ("distance_sphere", "Distance", "Switch levels by camera distance", 1),
+            ("pixel_count", "Pixel Count", "Switch levels by the number of pixels the mesh covers on screen", 2)
+        ],
+        name = "   LOD Strategy",
+        description = "What the LOD usage values are measured in",
+        default = "distance_sphere"
+    )
+
+    lod_value: FloatProperty(
+        name="   LOD Value",
+        description="Distance (or pixel count) at which the first reduced level is used",
+        default=25.0,
+        min=0.0,
+    )
+
+    lod_value_step: FloatProperty(
+        name="   LOD Value Step",
+        description="Each following level is used at this many times the distance (or this many times fewer pixels) of the one before",
+        default=2.0,
+        min=1.0,
+    )
+
     export_materials: BoolProperty(
         name="Export materials",
         description="Export material files. Kenshi does not use these",
@@ -446,18 +735,88 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
         default=False,
     )
 
+    cache_animations: BoolProperty(
+        name="Cache Animations",
+        description="Reuse previously baked animations that have not changed since the last export.\nBakes are stored in a .bakecache file next to the exported mesh",
+        default=False,
+    )
+
+    isolate_animation_bake: BoolProperty(
+        name="Isolate Animation Bake",
+        description="Bake animations in a temporary scene that only contains the armature and the objects its constraints and drivers depend on.\nMuch faster in large scenes, turn off if baked animations look different",
+        default=True,
+    )
+
+    reduce_keyframes: BoolProperty(
+        name="Reduce Keyframes",
+        description="Remove animation channels that stay at rest and keyframes that interpolation reproduces within the tolerances below",
+        default=False,
+    )
+
+    reduce_translation_tolerance: FloatProperty(
+        name="   Translation Tolerance",
+        description="Maximum translation (and scale) error allowed when removing keyframes",
+        default=0.0001,
+        min=0.0,
+        precision=5,
+    )
+
+    reduce_angle_tolerance: FloatProperty(
+        name="   Angle Tolerance",
+        description="Maximum rotation error allowed when removing keyframes",
+        default=0.001,
+        min=0.0,
+        subtype='ANGLE',
+    )
+
+    limit_bone_palette: BoolProperty(
+        name="Limit Bone Palette",
+        description="Split skinned submeshes so that none uses more bones than the palette size, allowing hardware skinning",
+        default=False,
+    )
+
+    bone_palette_size: IntProperty(
+        name="   Bone Palette Size",
+        description="Most bones a single submesh may use",
+        default=64,
+        min=4,
+        max=256,
+    )
+
     renormalize_weights: BoolProperty(
         name="Renormalize Weights",
         description="Kenshi only supports 4 weights. IO_Contined exports the 4 highest weights and renormalizes them. Toggle off to disable renormalization.",
         default=True,
     )
 
+    background_export: BoolProperty(
+        name="Run in Background",
+        description="Keep Blender responsive while exporting. Progress is shown in the status bar and Esc cancels the export",
+        default=False,
+    )
+
     batch_export: BoolProperty(
         name="Batch Export",
         description="Export individual meshes as unique files based on blender object name",
         default=False,
     )
 
+    incremental_export: BoolProperty(
+        name="Incremental",
+        description="Skip objects that have not changed since the last batch export to the same folder.\nChanges are tracked in a kenshi_export.manifest file next to the exported meshes",
+        default=False,
+    )
+
+    instance_export: EnumProperty(
+        name="Instances",
+        description="How objects that would export identical meshes are handled",
+        items=(('NONE', "Export Each", "Export every object separately"),
+               ('COPY', "Copy", "Export each unique mesh once and hardlink or copy it for the other objects"),
+               ('MAP', "Map", "Export each unique mesh once and write the object to mesh mapping to kenshi_instances.json"),
+               ),
+        default='NONE',
+    )
+
     filter_glob: StringProperty(
         default="*.mesh;*.MESH;.xml;.XML",
         options={'HIDDEN'},
@@ -467,11 +826,13 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
         # if not self.filepath:
         #    self.filepath = bpy.path.ensure_ext(bpy.data.filepath, ".bm")
 
+        warmUpConverter(self)
         context.window_manager.fileselect_add(self)
         return {'RUNNING_MODAL'}
 
     def execute(self, context):
         from . import OgreExport
+        from . import OgreConverter
         from mathutils import Matrix
 
         print("Exporting using github version")
@@ -479,22 +840,8 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
         keywords = self.as_keywords(ignore=("check_existing", "filter_glob"))
         
         #obtain converter
-        if platform.system() == "Windows":
-            match keywords['xml_converter']:
-                case "default":
-                    keywords['xml_converter'] = findConverter(OGRE_XML_CONVERTER_1_29)
-                case "compatibility (1.10)":
-                    keywords['xml_converter'] = findConverter(OGRE_XML_CONVERTER_1_10)
-                case "custom":
-                    keywords['xml_converter'] = findConverter(keywords['custom_xml_converter'])
-        elif platform.system() == "Linux":
-            match keywords['xml_converter']:
-                case "default":
-                    keywords['xml_converter'] = findConverter(OGRE_XML_CONVERTER_1_29_Wine)
-                case "compatibility (1.10)":
-                    keywords['xml_converter'] = findConverter(OGRE_XML_CONVERTER_1_10_Wine)
-                case "custom":
-                    keywords['xml_converter'] = findConverter(keywords['custom_xml_converter'])
+        keywords['xml_converter'] = resolveConverter(keywords['xml_converter'], keywords['custom_xml_converter'])
+        OgreConverter.warmUpConverter(keywords['xml_converter'])
         
 
         print('converter = ', keywords['xml_converter'])
@@ -504,12 +851,31 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
             "filepath" : keywords['filepath'],
             "xml_converter" : keywords['xml_converter'],
             "keep_xml" : keywords['keep_xml'],
+            "converter_jobs" : keywords['converter_jobs'],
+            "use_scratch_directory" : keywords['use_scratch_directory'],
+            "scratch_directory" : keywords['scratch_directory'],
             "export_tangents" : keywords['export_tangents'],
             "export_binormals" : keywords['export_binormals'],
             "export_colour" : keywords['export_colour'],
             "tangent_parity" : keywords['tangent_parity'],
             "apply_transform" : keywords['apply_transform'],
             "apply_modifiers" : keywords['apply_modifiers'],
+            "shared_geometry" : keywords['shared_geometry'],
+            "vertex_layout" : keywords['vertex_layout'],
+            "binary_mesh" : keywords['binary_mesh'],
+            "normal_format" : keywords['normal_format'],
+            "uv_format" : keywords['uv_format'],
+            "colour_format" : keywords['colour_format'],
+            "split_large_submeshes" : keywords['split_large_submeshes'],
+            "optimize_vertex_cache" : keywords['optimize_vertex_cache'],
+            "optimize_overdraw" : keywords['optimize_overdraw'],
+            "overdraw_threshold" : keywords['overdraw_threshold'],
+            "generate_lod" : keywords['generate_lod'],
+            "lod_levels" : keywords['lod_levels'],
+            "lod_reduction" : keywords['lod_reduction'],
+            "lod_strategy" : keywords['lod_strategy'],
+            "lod_value" : keywords['lod_value'],
+            "lod_value_step" : keywords['lod_value_step'],
             "export_materials" : keywords['export_materials'],
             "overwrite_material" : keywords['overwrite_material'],
             "copy_textures" : keywords['copy_textures'],
@@ -517,9 +883,22 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
             "export_poses" : keywords['export_poses'],
             "export_animation" : keywords['export_animation'],
             "renormalize_weights": keywords['renormalize_weights'],
-            "batch_export" : keywords['batch_export']
+            "limit_bone_palette" : keywords['limit_bone_palette'],
+            "bone_palette_size" : keywords['bone_palette_size'],
+            "batch_export" : keywords['batch_export'],
+            "incremental_export" : keywords['incremental_export'],
+            "instance_export" : keywords['instance_export'],
+            "cache_animations" : keywords['cache_animations'],
+            "isolate_animation_bake" : keywords['isolate_animation_bake'],
+            "reduce_keyframes" : keywords['reduce_keyframes'],
+            "reduce_translation_tolerance" : keywords['reduce_translation_tolerance'],
+            "reduce_angle_tolerance" : keywords['reduce_angle_tolerance']
         }
 
+        if self.background_export:
+            steps = OgreExport.exportSteps(self, context, background=True, **export_params)
+            return self.startBackground(context, steps, "Exporting " + os.path.basename(self.filepath))
+
         bpy.context.window.cursor_set("WAIT")
         result = OgreExport.save(self, context, **export_params)
         bpy.context.window.cursor_set("DEFAULT")
@@ -532,6 +911,19 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
         xml.prop(self, "custom_xml_converter")
         xml.prop(self, "xml_converter")
         xml.prop(self, "keep_xml")
+        xml.prop(self, "use_scratch_directory")
+        scratch = xml.column()
+        scratch.enabled = self.use_scratch_directory
+        scratch.prop(self, "scratch_directory")
+        jobs = xml.column()
+        jobs.enabled = self.batch_export
+        jobs.prop(self, "converter_jobs")
+        xml.prop(self, "binary_mesh")
+        formats = xml.column()
+        formats.enabled = self.binary_mesh
+        formats.prop(self, "normal_format")
+        formats.prop(self, "uv_format")
+        formats.prop(self, "colour_format")
 
         mesh = layout.box()
         mesh.prop(self, "export_tangents")
@@ -540,6 +932,24 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
         mesh.prop(self, "export_poses")
         mesh.prop(self, "apply_transform")
         mesh.prop(self, "apply_modifiers")
+        mesh.prop(self, "shared_geometry")
+        mesh.prop(self, "vertex_layout")
+        mesh.prop(self, "split_large_submeshes")
+        mesh.prop(self, "optimize_vertex_cache")
+        overdraw = mesh.column()
+        overdraw.enabled = self.optimize_vertex_cache
+        overdraw.prop(self, "optimize_overdraw")
+        threshold = overdraw.column()
+        threshold.enabled = self.optimize_overdraw
+        threshold.prop(self, "overdraw_threshold")
+        mesh.prop(self, "generate_lod")
+        lod = mesh.column()
+        lod.enabled = self.generate_lod
+        lod.prop(self, "lod_levels")
+        lod.prop(self, "lod_reduction")
+        lod.prop(self, "lod_strategy")
+        lod.prop(self, "lod_value")
+        lod.prop(self, "lod_value_step")
 
         material = layout.box()
         material.prop(self, "export_materials")
@@ -551,10 +961,28 @@ class ExportOgre(bpy.types.Operator, ExportHelper):
         skeleton = layout.box()
         skeleton.prop(self, "export_skeleton")
         skeleton.prop(self, "export_animation")
+        cache = skeleton.column()
+        cache.enabled = self.export_animation
+        cache.prop(self, "cache_animations")
+        cache.prop(self, "isolate_animation_bake")
+        cache.prop(self, "reduce_keyframes")
+        tolerance = cache.column()
+        tolerance.enabled = self.reduce_keyframes
+        tolerance.prop(self, "reduce_translation_tolerance")
+        tolerance.prop(self, "reduce_angle_tolerance")
         skeleton.prop(self, "renormalize_weights")
+        skeleton.prop(self, "limit_bone_palette")
+        palette = skeleton.column()
+        palette.enabled = self.limit_bone_palette
+        palette.prop(self, "bone_palette_size")
 
         batch = layout.box()
         batch.prop(self, "batch_export")
+        batchOptions = batch.column()
+        batchOptions.enabled = self.batch_export
+        batchOptions.prop(self, "incremental_export")
+        batchOptions.prop(self, "instance_export")
+        batch.prop(self, "background_export")
 
 
 
@@ -639,6 +1067,8 @@ def register():
 
 def unregister():
     from bpy.utils import unregister_class
+    from . import OgreConverter
+    OgreConverter.wineServer.stop()
     for cls in reversed(classes):
         unregister_class(cls)
 